@@ -10,6 +10,8 @@
 #include <vector>
 #include <mutex>
 #include <future>
+#include <atomic>
+#include <chrono>
 
 #include "2048.h"
 
@@ -34,6 +36,17 @@
 #undef min
 #endif
 
+/* CPU-specific builds (see Makefile.in) are compiled with -mbmi2 -mpopcnt: columns are then
+ * gathered with PEXT instead of transposing the board, and empty cells counted with POPCNT. */
+#if defined(__BMI2__)
+#include <immintrin.h>
+
+// Column c of a board, packed like a row (top cell in the lowest nibble)
+static inline row_t get_col(board_t board, int c) {
+    return (row_t)_pext_u64(board, COL_MASK << (4 * c));
+}
+#endif
+
 // Transpose rows/columns in a board:
 //   0123       048c
 //   4567  -->  159d
@@ -61,12 +74,16 @@ static int count_empty(board_t x)
     // At this point each nibble is:
     //  0 if the original nibble was non-zero
     //  1 if the original nibble was zero
+#if defined(__POPCNT__)
+    return __builtin_popcountll(x);
+#else
     // Next sum them all
     x += x >> 32;
     x += x >> 16;
     x += x >>  8;
     x += x >>  4; // this can overflow to the next nibble if there were 16 empty positions
     return x & 0xf;
+#endif
 }
 
 /* We can perform state lookups one row at a time by using arrays with 65536 entries. */
@@ -82,6 +99,10 @@ static board_t col_down_table[65536];
 static float heur_score_table[65536];
 static float score_table[65536];
 
+/* Best heuristic row score among rows holding a tile of rank >= r, for bounding the heuristic
+ * in the pruned search. */
+static float heur_row_max[16];
+
 // Heuristic scoring settings
 static const float SCORE_LOST_PENALTY = 200000.0f;
 static const float SCORE_MONOTONICITY_POWER = 4.0f;
@@ -187,25 +208,48 @@ void init_tables() {
         col_up_table   [    row] = unpack_col(    row) ^ unpack_col(    result);
         col_down_table [rev_row] = unpack_col(rev_row) ^ unpack_col(rev_result);
     }
+
+    for (int rank = 0; rank < 16; ++rank)
+        heur_row_max[rank] = -INFINITY;
+    for (unsigned row = 0; row < 65536; ++row) {
+        int maxrank = std::max(std::max(row & 0xf, (row >> 4) & 0xf), std::max((row >> 8) & 0xf, row >> 12));
+        heur_row_max[maxrank] = std::max(heur_row_max[maxrank], heur_score_table[row]);
+    }
+    for (int rank = 14; rank >= 0; --rank)
+        heur_row_max[rank] = std::max(heur_row_max[rank], heur_row_max[rank + 1]);
 }
 
 static inline board_t execute_move_0(board_t board) {
     board_t ret = board;
+#if defined(__BMI2__)
+    ret ^= col_up_table[get_col(board, 0)] <<  0;
+    ret ^= col_up_table[get_col(board, 1)] <<  4;
+    ret ^= col_up_table[get_col(board, 2)] <<  8;
+    ret ^= col_up_table[get_col(board, 3)] << 12;
+#else
     board_t t = transpose(board);
     ret ^= col_up_table[(t >>  0) & ROW_MASK] <<  0;
     ret ^= col_up_table[(t >> 16) & ROW_MASK] <<  4;
     ret ^= col_up_table[(t >> 32) & ROW_MASK] <<  8;
     ret ^= col_up_table[(t >> 48) & ROW_MASK] << 12;
+#endif
     return ret;
 }
 
 static inline board_t execute_move_1(board_t board) {
     board_t ret = board;
+#if defined(__BMI2__)
+    ret ^= col_down_table[get_col(board, 0)] <<  0;
+    ret ^= col_down_table[get_col(board, 1)] <<  4;
+    ret ^= col_down_table[get_col(board, 2)] <<  8;
+    ret ^= col_down_table[get_col(board, 3)] << 12;
+#else
     board_t t = transpose(board);
     ret ^= col_down_table[(t >>  0) & ROW_MASK] <<  0;
     ret ^= col_down_table[(t >> 16) & ROW_MASK] <<  4;
     ret ^= col_down_table[(t >> 32) & ROW_MASK] <<  8;
     ret ^= col_down_table[(t >> 48) & ROW_MASK] << 12;
+#endif
     return ret;
 }
 
@@ -272,6 +316,99 @@ static inline int count_distinct_tiles(board_t board) {
 
 /* Optimizing the game */
 
+/* Leaf evaluators. The search scores the boards at its horizon (after a move, before the tile
+ * spawn) with evaluate; a lost board scores 0. upper_bound(board) must bound the value of board and
+ * of every board reachable from it, for the pruned search. */
+struct evaluator_t {
+    float (*evaluate)(board_t board);
+    float (*upper_bound)(board_t board);
+};
+
+// score a single board heuristically
+static float score_heur_board(board_t board);
+
+// The largest tile on a board never shrinks, so every board reachable from it has one row and one
+// column holding a tile at least that large, and six other lines.
+static float heur_upper_bound(board_t board) {
+    return std::max(0.0f, 6 * heur_row_max[0] + 2 * heur_row_max[get_max_rank(board)]);
+}
+
+static const evaluator_t heuristic_evaluator = {score_heur_board, heur_upper_bound};
+
+// Evaluator used by searches started from now on (see set_evaluator)
+static const evaluator_t *current_evaluator = &heuristic_evaluator;
+
+/* Cancellation tokens.
+ *
+ * A search given a token looks at it every SEARCH_CHECK_INTERVAL chance nodes, and unwinds as soon
+ * as the token is cancelled or past its deadline; the search then returns SEARCH_CANCELLED. Tokens
+ * can be cancelled from any thread while searches are using them. */
+static const unsigned SEARCH_CHECK_INTERVAL = 1024;
+
+struct search_token_t {
+    std::atomic<bool> cancelled;
+    std::atomic<int64_t> deadline; // steady clock, in nanoseconds; 0: none
+};
+
+static inline int64_t steady_now_ns() {
+    return std::chrono::duration_cast<std::chrono::nanoseconds>(std::chrono::steady_clock::now().time_since_epoch()).count();
+}
+
+search_token_t *search_token_new() {
+    search_token_t *token = new search_token_t;
+    token->cancelled = false;
+    token->deadline = 0;
+    return token;
+}
+
+void search_token_free(search_token_t *token) {
+    delete token;
+}
+
+void search_token_cancel(search_token_t *token) {
+    token->cancelled = true;
+}
+
+void search_token_set_deadline(search_token_t *token, double seconds) {
+    token->deadline = seconds < 0 ? 0 : steady_now_ns() + (int64_t)(seconds * 1e9);
+}
+
+int search_token_stopped(const search_token_t *token) {
+    int64_t deadline = token->deadline;
+    return token->cancelled || (deadline && steady_now_ns() >= deadline);
+}
+
+/* Search progress, see score_toplevel_moves_deepening. Node counts are published live (every
+ * SEARCH_CHECK_INTERVAL chance nodes), everything else under the lock once per iteration. */
+struct search_progress_t {
+    std::mutex lock;
+    search_progress_info_t info;
+    std::atomic<uint64_t> nodes;
+};
+
+search_progress_t *search_progress_new() {
+    search_progress_t *progress = new search_progress_t;
+    progress->info.depth = 0;
+    progress->info.best_move = -1;
+    for (int move = 0; move < 4; ++move)
+        progress->info.scores[move] = 0;
+    progress->info.nodes = 0;
+    progress->info.done = 0;
+    progress->info.version = 0;
+    progress->nodes = 0;
+    return progress;
+}
+
+void search_progress_free(search_progress_t *progress) {
+    delete progress;
+}
+
+void search_progress_read(search_progress_t *progress, search_progress_info_t *info) {
+    std::lock_guard<std::mutex> guard(progress->lock);
+    *info = progress->info;
+    info->nodes = progress->nodes;
+}
+
 struct eval_state {
     trans_table_t trans_table; // transposition table, to cache previously-seen moves
     int maxdepth;
@@ -279,13 +416,37 @@ struct eval_state {
     int cachehits;
     unsigned long moves_evaled;
     int depth_limit;
-
-    eval_state() : maxdepth(0), curdepth(0), cachehits(0), moves_evaled(0), depth_limit(0) {
+    const evaluator_t *evaluator;
+    const search_token_t *token;
+    search_progress_t *progress;
+    unsigned long nodes_published; // moves_evaled already added to progress
+    unsigned check_countdown;
+    bool stopped;
+
+    eval_state(const search_token_t *token = NULL, search_progress_t *progress = NULL) :
+        maxdepth(0), curdepth(0), cachehits(0), moves_evaled(0), depth_limit(0), evaluator(current_evaluator),
+        token(token), progress(progress), nodes_published(0), check_countdown(SEARCH_CHECK_INTERVAL), stopped(false) {
     }
 };
 
-// score a single board heuristically
-static float score_heur_board(board_t board);
+// Add the nodes searched since the last call to the progress count (several searches may share it)
+static inline void publish_nodes(eval_state &state) {
+    state.progress->nodes.fetch_add(state.moves_evaled - state.nodes_published, std::memory_order_relaxed);
+    state.nodes_published = state.moves_evaled;
+}
+
+// True once the search has to stop; the token itself is only looked at every SEARCH_CHECK_INTERVAL calls
+static inline bool search_stopped(eval_state &state) {
+    if ((state.token || state.progress) && --state.check_countdown == 0) {
+        state.check_countdown = SEARCH_CHECK_INTERVAL;
+        if (state.progress)
+            publish_nodes(state);
+        if (state.token)
+            state.stopped = search_token_stopped(state.token);
+    }
+    return state.stopped;
+}
+
 // score a single board actually (adding in the score from spawned 4 tiles)
 static float score_board(board_t board);
 // score over all possible moves
@@ -302,14 +463,167 @@ static float score_helper(board_t board, const float* table) {
 }
 
 static float score_heur_board(board_t board) {
+#if defined(__BMI2__)
+    return score_helper(board, heur_score_table) +
+           (heur_score_table[get_col(board, 0)] + heur_score_table[get_col(board, 1)] +
+            heur_score_table[get_col(board, 2)] + heur_score_table[get_col(board, 3)]);
+#else
     return score_helper(          board , heur_score_table) +
            score_helper(transpose(board), heur_score_table);
+#endif
 }
 
 static float score_board(board_t board) {
     return score_helper(board, score_table);
 }
 
+/* N-tuple network evaluator.
+ *
+ * Each tuple is a list of cells; its weight table has one float per combination of ranks in
+ * those cells (16^ncells entries). A board is scored by summing, over the 8 symmetries of the
+ * board and over all tuples, the weight indexed by the ranks in the tuple's cells (the rank in
+ * cell j of the tuple is nibble j of the index). Weights are trained offline, see ntuple_train.py.
+ *
+ * The network predicts the score still to be gained from a board. The search compares boards
+ * several moves apart, so the evaluator adds the score already implied by the board's tiles
+ * (score_board): the difference between two boards then includes the merges made in between.
+ *
+ * Weight file format (little-endian):
+ *   "NTW1", uint32 ntuples,
+ *   for each tuple: uint32 ncells, uint8 cells[ncells] (cell index 4*row + col),
+ *   for each tuple: float weights[16^ncells]
+ */
+static const int NTUPLE_MAX_CELLS = 7;
+
+struct ntuple_t {
+    int ncells;
+    int shifts[NTUPLE_MAX_CELLS];
+    std::vector<float> weights;
+};
+
+static std::vector<ntuple_t> ntuples;
+static float ntuple_bound; // 8 * sum of the largest weight of each tuple
+
+// score_board of a board full of the largest tile: no reachable board scores more
+static const float SCORE_BOARD_MAX = 16 * 14 * 32768.0f;
+
+static inline board_t flip_rows(board_t x) {
+    x = (x << 32) | (x >> 32);
+    return ((x & 0x0000FFFF0000FFFFULL) << 16) | ((x >> 16) & 0x0000FFFF0000FFFFULL);
+}
+
+static inline board_t flip_cols(board_t x) {
+    x = ((x & 0x00FF00FF00FF00FFULL) << 8) | ((x >> 8) & 0x00FF00FF00FF00FFULL);
+    return ((x & 0x0F0F0F0F0F0F0F0FULL) << 4) | ((x >> 4) & 0x0F0F0F0F0F0F0F0FULL);
+}
+
+static float score_ntuple_board(board_t board) {
+    board_t syms[8];
+    syms[0] = board;
+    syms[1] = flip_cols(board);
+    syms[2] = flip_rows(board);
+    syms[3] = flip_rows(syms[1]);
+    for (int i = 0; i < 4; ++i)
+        syms[i + 4] = transpose(syms[i]);
+
+    float res = 0.0f;
+    for (const ntuple_t &t : ntuples) {
+        const float *weights = t.weights.data();
+        for (int i = 0; i < 8; ++i) {
+            unsigned index = 0;
+            for (int j = 0; j < t.ncells; ++j)
+                index |= ((syms[i] >> t.shifts[j]) & 0xf) << (4 * j);
+            res += weights[index];
+        }
+    }
+    return res + score_board(board);
+}
+
+static float ntuple_upper_bound(board_t) {
+    return ntuple_bound + SCORE_BOARD_MAX;
+}
+
+static const evaluator_t ntuple_evaluator = {score_ntuple_board, ntuple_upper_bound};
+
+int load_ntuple_weights(const char *path) {
+    FILE *f = fopen(path, "rb");
+    if (!f)
+        return -1;
+
+    std::vector<ntuple_t> loaded;
+    char magic[4];
+    uint32_t count;
+    bool ok = fread(magic, 4, 1, f) == 1 && memcmp(magic, "NTW1", 4) == 0 &&
+              fread(&count, sizeof(count), 1, f) == 1 && count > 0 && count <= 256;
+    for (uint32_t i = 0; ok && i < count; ++i) {
+        uint32_t ncells;
+        uint8_t cells[NTUPLE_MAX_CELLS];
+        ok = fread(&ncells, sizeof(ncells), 1, f) == 1 && ncells > 0 && ncells <= (uint32_t)NTUPLE_MAX_CELLS &&
+             fread(cells, 1, ncells, f) == ncells;
+        ntuple_t t;
+        t.ncells = ncells;
+        for (uint32_t j = 0; ok && j < ncells; ++j) {
+            ok = cells[j] < 16;
+            t.shifts[j] = 4 * cells[j];
+        }
+        if (ok)
+            loaded.push_back(t);
+    }
+    for (ntuple_t &t : loaded) {
+        if (!ok)
+            break;
+        t.weights.resize(size_t(1) << (4 * t.ncells));
+        ok = fread(t.weights.data(), sizeof(float), t.weights.size(), f) == t.weights.size();
+    }
+    fclose(f);
+    if (!ok)
+        return -1;
+
+    float bound = 0.0f;
+    for (const ntuple_t &t : loaded)
+        bound += 8 * *std::max_element(t.weights.begin(), t.weights.end());
+    ntuples.swap(loaded);
+    ntuple_bound = std::max(0.0f, bound);
+    return ntuples.size();
+}
+
+int set_evaluator(int evaluator) {
+    switch (evaluator) {
+    case EVALUATOR_HEURISTIC:
+        current_evaluator = &heuristic_evaluator;
+        return 0;
+    case EVALUATOR_NTUPLE:
+        if (ntuples.empty())
+            return -1;
+        current_evaluator = &ntuple_evaluator;
+        return 0;
+    default:
+        return -1;
+    }
+}
+
+void evaluate_boards(const board_t *boards, float *values, int n) {
+    const evaluator_t *evaluator = current_evaluator;
+    for (int i = 0; i < n; ++i)
+        values[i] = evaluator->evaluate(boards[i]);
+}
+
+/* Bump whenever a change alters the scores searches return (leaf evaluation, probability cutoffs,
+ * the endgame filter, ...), so that scores stored by older builds (see poscache.py) are rejected. */
+static const int SCORING_REVISION = 2;
+
+int engine_scoring_revision() {
+    return SCORING_REVISION;
+}
+
+const char *engine_variant() {
+#if defined(__BMI2__) && defined(__POPCNT__)
+    return "bmi2";
+#else
+    return "baseline";
+#endif
+}
+
 // Statistics and controls
 // cprob: cumulative probability
 // don't recurse into a node with a cprob less than this threshold
@@ -317,9 +631,11 @@ static const float CPROB_THRESH_BASE = 0.0001f;
 static const int CACHE_DEPTH_LIMIT  = 15;
 
 static float score_tilechoose_node(eval_state &state, board_t board, float cprob) {
+    if (search_stopped(state))
+        return 0.0f;
     if (cprob < CPROB_THRESH_BASE || state.curdepth >= state.depth_limit) {
         state.maxdepth = std::max(state.curdepth, state.maxdepth);
-        return score_heur_board(board);
+        return state.evaluator->evaluate(board);
     }
     if (state.curdepth < CACHE_DEPTH_LIMIT) {
         const trans_table_t::iterator &i = state.trans_table.find(board);
@@ -356,7 +672,7 @@ static float score_tilechoose_node(eval_state &state, board_t board, float cprob
     res = res / num_open;
 
     if (state.curdepth < CACHE_DEPTH_LIMIT) {
-        trans_table_entry_t entry = {static_cast<uint8_t>(state.curdepth), res};
+        trans_table_entry_t entry = {static_cast<uint8_t>(state.curdepth), 0, res};
         state.trans_table[board] = entry;
     }
 
@@ -379,6 +695,119 @@ static float score_move_node(eval_state &state, board_t board, float cprob) {
     return best;
 }
 
+/* Endgame solver.
+ *
+ * With few empty cells, the heuristic can't tell a cramped position from a lost one. For such
+ * boards, the exact probability of surviving the next ENDGAME_HORIZON moves (playing only to
+ * survive, over every possible spawn) is computed for each move, and moves that survive clearly
+ * less often than the best one are not searched at all.
+ *
+ * The solver needs no cutoffs: a move never reduces the number of empty cells, so an afterstate
+ * with more empty cells than the remaining horizon survives it for certain. Results are memoized
+ * in a small direct-mapped table keyed by board and remaining horizon. A survival probability
+ * depends on nothing else, so each thread keeps its table from one position to the next. */
+static const int ENDGAME_MAX_EMPTY = 3;
+static const int ENDGAME_HORIZON = 6;
+static const float ENDGAME_TOLERANCE = 0.01f;
+static const size_t ENDGAME_TABLE_SIZE = 1 << 16;
+
+// Murmur3 finalizer: every bit of the board affects every bit of the hash
+static inline uint64_t hash_board(board_t board) {
+    board ^= board >> 33;
+    board *= 0xff51afd7ed558ccdULL;
+    board ^= board >> 33;
+    board *= 0xc4ceb9fe1a85ec53ULL;
+    return board ^ (board >> 33);
+}
+
+struct endgame_entry_t {
+    board_t board;
+    int horizon; // 0: empty slot
+    float survival;
+};
+
+struct endgame_state {
+    std::vector<endgame_entry_t> table;
+    unsigned long moves_evaled;
+
+    endgame_state() : table(ENDGAME_TABLE_SIZE, endgame_entry_t{0, 0, 0.0f}), moves_evaled(0) {
+    }
+};
+
+// Allocated on a thread's first crowded board, then reused
+static thread_local endgame_state endgame_tables;
+
+static float survival_move_node(endgame_state &state, board_t board, int horizon);
+
+// Probability of making horizon more moves from an afterstate (a board before its tile spawns)
+static float survival_chance_node(endgame_state &state, board_t board, int horizon) {
+    int num_open = count_empty(board);
+    if (horizon <= 0 || num_open > horizon)
+        return 1.0f;
+
+    endgame_entry_t &entry = state.table[hash_board(board) & (ENDGAME_TABLE_SIZE - 1)];
+    if (entry.board == board && entry.horizon == horizon)
+        return entry.survival;
+
+    float res = 0.0f;
+    board_t tmp = board;
+    board_t tile_2 = 1;
+    while (tile_2) {
+        if ((tmp & 0xf) == 0) {
+            res += survival_move_node(state, board |  tile_2      , horizon) * 0.9f;
+            res += survival_move_node(state, board | (tile_2 << 1), horizon) * 0.1f;
+        }
+        tmp >>= 4;
+        tile_2 <<= 4;
+    }
+    res = res / num_open;
+
+    entry = endgame_entry_t{board, horizon, res};
+    return res;
+}
+
+static float survival_move_node(endgame_state &state, board_t board, int horizon) {
+    float best = 0.0f;
+    for (int move = 0; move < 4 && best < 1.0f; ++move) {
+        board_t newboard = execute_move(move, board);
+        state.moves_evaled++;
+
+        if (board != newboard) {
+            best = std::max(best, survival_chance_node(state, newboard, horizon - 1));
+        }
+    }
+    return best;
+}
+
+float survival_probability(board_t board, int move, int horizon) {
+    board_t newboard = execute_move(move, board);
+    if (board == newboard)
+        return 0;
+    return survival_chance_node(endgame_tables, newboard, horizon - 1);
+}
+
+int endgame_candidates(board_t board, float survival[4]) {
+    if (count_empty(board) > ENDGAME_MAX_EMPTY)
+        return 0xf;
+    endgame_state &state = endgame_tables;
+    float best = 0.0f;
+    for (int move = 0; move < 4; ++move) {
+        board_t newboard = execute_move(move, board);
+        survival[move] = newboard == board ? 0.0f : survival_chance_node(state, newboard, ENDGAME_HORIZON - 1);
+        best = std::max(best, survival[move]);
+    }
+    int candidates = 0;
+    for (int move = 0; move < 4; ++move)
+        if (survival[move] >= best - ENDGAME_TOLERANCE)
+            candidates |= 1 << move;
+    return candidates;
+}
+
+// Score of a legal move left out by endgame_candidates: positive, but below any searched score
+static inline float endgame_score(float survival) {
+    return 1e-6f * (1.0f + survival);
+}
+
 static float _score_toplevel_move(eval_state &state, board_t board, int move) {
     //int maxrank = get_max_rank(board);
     board_t newboard = execute_move(move, board);
@@ -389,16 +818,42 @@ static float _score_toplevel_move(eval_state &state, board_t board, int move) {
     return score_tilechoose_node(state, newboard, 1.0f) + 1e-6;
 }
 
+int default_search_depth(board_t board) {
+    return std::max(3, count_distinct_tiles(board) - 2);
+}
+
 float score_toplevel_move(board_t board, int move) {
+    return score_toplevel_move_depth(board, move, 0);
+}
+
+float score_toplevel_move_depth(board_t board, int move, int depth) {
+    return score_toplevel_move_token(board, move, depth, NULL);
+}
+
+float score_toplevel_move_token(board_t board, int move, int depth, search_token_t *token) {
+    return score_toplevel_move_candidates(board, move, depth, -1, 0.0f, token);
+}
+
+float score_toplevel_move_candidates(board_t board, int move, int depth, int candidates, float survival, search_token_t *token) {
     float res;
     struct timeval start, finish;
     double elapsed;
-    eval_state state;
-    state.depth_limit = std::max(3, count_distinct_tiles(board) - 2);
+    if (candidates < 0) {
+        float survivals[4];
+        candidates = endgame_candidates(board, survivals);
+        survival = survivals[move];
+    }
+    if (!(candidates & (1 << move)))
+        return endgame_score(survival);
+
+    eval_state state(token);
+    state.depth_limit = depth > 0 ? depth : default_search_depth(board);
 
     gettimeofday(&start, NULL);
     res = _score_toplevel_move(state, board, move);
     gettimeofday(&finish, NULL);
+    if (state.stopped)
+        return SEARCH_CANCELLED;
 
     elapsed = (finish.tv_sec - start.tv_sec);
     elapsed += (finish.tv_usec - start.tv_usec) / 1000000.0;
@@ -409,6 +864,579 @@ float score_toplevel_move(board_t board, int move) {
     return res;
 }
 
+/* Pruned search (Star1).
+ *
+ * The evaluator bounds the value of every board reachable from a given board. Once the children of a chance node seen so
+ * far plus the upper bound for the rest can no longer beat alpha (the best alternative of the max
+ * node above it), the remaining children need not be searched. Each child is itself searched with
+ * the alpha it must beat for its parent to still matter. Such cut values are only upper bounds:
+ * they are flagged inexact, and go into the transposition table as bounds that can cut a later
+ * visit but never stand in for its value. Move nodes try their children in order of static
+ * evaluation so that a good alpha is found early.
+ *
+ * Without pruning, the search below computes the same values as score_move_node and
+ * score_tilechoose_node, in the same order. Cuts are made with a small relative margin so that
+ * float rounding cannot turn a cut into a different result. However, the transposition table
+ * reuses values found at shallower depths, so values depend on the order in which nodes are first
+ * visited; cuts change that order, and on near-ties the two searches can disagree on the move. */
+static const float PRUNE_MARGIN = 1e-5f;
+
+static float score_move_node_pruned(eval_state &state, board_t board, float cprob, float alpha, bool &exact);
+
+// Remember that board was cut with the given upper bound
+static float store_bound(eval_state &state, board_t board, float bound) {
+    if (state.curdepth < CACHE_DEPTH_LIMIT) {
+        trans_table_entry_t entry = {static_cast<uint8_t>(state.curdepth), 1, bound};
+        state.trans_table[board] = entry;
+    }
+    return bound;
+}
+
+static float score_tilechoose_node_pruned(eval_state &state, board_t board, float cprob, float alpha, bool &exact) {
+    exact = true;
+    if (search_stopped(state))
+        return 0.0f;
+    if (cprob < CPROB_THRESH_BASE || state.curdepth >= state.depth_limit) {
+        state.maxdepth = std::max(state.curdepth, state.maxdepth);
+        return state.evaluator->evaluate(board);
+    }
+    if (state.curdepth < CACHE_DEPTH_LIMIT) {
+        const trans_table_t::iterator &i = state.trans_table.find(board);
+        if (i != state.trans_table.end()) {
+            trans_table_entry_t entry = i->second;
+            if(entry.depth <= state.curdepth && (!entry.is_bound || entry.heuristic < alpha - fabsf(alpha) * PRUNE_MARGIN))
+            {
+                // An upper bound below alpha cuts this node again
+                state.cachehits++;
+                exact = !entry.is_bound;
+                return entry.heuristic;
+            }
+        }
+    }
+
+    int num_open = count_empty(board);
+    cprob /= num_open;
+
+    // res accumulates the children's values weighted by 0.9/0.1; the node value is res / num_open.
+    // To beat alpha, res must end above target.
+    const float upper = state.evaluator->upper_bound(board);
+    const float target = (alpha - fabsf(alpha) * PRUNE_MARGIN) * num_open;
+    float remaining = num_open; // total weight of the children not searched yet
+
+    float res = 0.0f;
+    board_t tmp = board;
+    board_t tile_2 = 1;
+    while (tile_2) {
+        if ((tmp & 0xf) == 0) {
+            for (int four = 0; four < 2; ++four) {
+                float weight = four ? 0.1f : 0.9f;
+                remaining -= weight;
+                if (res + remaining * upper + weight * upper < target) {
+                    // Even if every remaining child scored the upper bound, alpha can't be beaten
+                    exact = false;
+                    return store_bound(state, board, (res + (remaining + weight) * upper) / num_open);
+                }
+                float child_alpha = (target - res - remaining * upper) / weight;
+                bool child_exact;
+                float v = score_move_node_pruned(state, board | (tile_2 << four), cprob * weight, child_alpha, child_exact);
+                res += v * weight;
+                if (!child_exact) {
+                    // v is an upper bound below child_alpha, so this node can't beat alpha either
+                    exact = false;
+                    return store_bound(state, board, (res + remaining * upper) / num_open);
+                }
+            }
+        }
+        tmp >>= 4;
+        tile_2 <<= 4;
+    }
+    res = res / num_open;
+
+    if (state.curdepth < CACHE_DEPTH_LIMIT) {
+        trans_table_entry_t entry = {static_cast<uint8_t>(state.curdepth), 0, res};
+        state.trans_table[board] = entry;
+    }
+
+    return res;
+}
+
+// Order the legal moves of board by static evaluation of the resulting boards, best first.
+// Returns the number of legal moves.
+static int order_moves(const evaluator_t *evaluator, board_t board, int moves[4], board_t newboards[4]) {
+    float evals[4];
+    int n = 0;
+    for (int move = 0; move < 4; ++move) {
+        board_t newboard = execute_move(move, board);
+        if (newboard == board)
+            continue;
+        float eval = evaluator->evaluate(newboard);
+        int i = n++;
+        for (; i > 0 && evals[i-1] < eval; --i) {
+            moves[i] = moves[i-1];
+            newboards[i] = newboards[i-1];
+            evals[i] = evals[i-1];
+        }
+        moves[i] = move;
+        newboards[i] = newboard;
+        evals[i] = eval;
+    }
+    return n;
+}
+
+static float score_move_node_pruned(eval_state &state, board_t board, float cprob, float alpha, bool &exact) {
+    int moves[4];
+    board_t newboards[4];
+    int n = order_moves(state.evaluator, board, moves, newboards);
+    state.moves_evaled += 4;
+
+    float best = 0.0f;        // best exact child value (0: no move, the game is lost)
+    float best_bound = 0.0f;  // highest upper bound among cut children
+    state.curdepth++;
+    for (int i = 0; i < n; ++i) {
+        bool child_exact;
+        float v = score_tilechoose_node_pruned(state, newboards[i], cprob, std::max(alpha, best), child_exact);
+        if (child_exact)
+            best = std::max(best, v);
+        else
+            best_bound = std::max(best_bound, v);
+    }
+    state.curdepth--;
+
+    exact = best >= best_bound;
+    return std::max(best, best_bound);
+}
+
+int score_toplevel_moves_pruned(board_t board, float *scores, uint64_t *nodes, search_token_t *token) {
+    int moves[4];
+    board_t newboards[4];
+    int n = order_moves(current_evaluator, board, moves, newboards);
+    float survival[4];
+    int candidates = endgame_candidates(board, survival);
+
+    for (int move = 0; move < 4; ++move)
+        scores[move] = 0;
+    if (nodes)
+        *nodes = 0;
+
+    int bestmove = -1;
+    float best = -INFINITY; // search the first move without pruning
+    for (int i = 0; i < n; ++i) {
+        if (!(candidates & (1 << moves[i]))) {
+            scores[moves[i]] = endgame_score(survival[moves[i]]);
+            continue;
+        }
+        // Separate state per move, as in score_toplevel_move
+        eval_state state(token);
+        state.depth_limit = default_search_depth(board);
+        bool exact;
+        float v = score_tilechoose_node_pruned(state, newboards[i], 1.0f, best, exact);
+        if (state.stopped)
+            return SEARCH_CANCELLED;
+        // Cut moves are reported with their upper bound, which is below the best move's score
+        scores[moves[i]] = v + 1e-6;
+        if (exact && v > best) {
+            best = v;
+            bestmove = moves[i];
+        }
+        if (nodes)
+            *nodes += state.moves_evaled;
+    }
+    return bestmove;
+}
+
+int score_toplevel_moves(board_t board, float *scores, uint64_t *nodes, search_token_t *token) {
+    int bestmove = -1;
+    float best = 0;
+    float survival[4];
+    int candidates = endgame_candidates(board, survival);
+    if (nodes)
+        *nodes = 0;
+    for (int move = 0; move < 4; ++move) {
+        if (!(candidates & (1 << move)) && execute_move(move, board) != board) {
+            scores[move] = endgame_score(survival[move]);
+            if (scores[move] > best) {
+                best = scores[move];
+                bestmove = move;
+            }
+            continue;
+        }
+        eval_state state(token);
+        state.depth_limit = default_search_depth(board);
+        scores[move] = _score_toplevel_move(state, board, move);
+        if (state.stopped)
+            return SEARCH_CANCELLED;
+        if (scores[move] > best) {
+            best = scores[move];
+            bestmove = move;
+        }
+        if (nodes)
+            *nodes += state.moves_evaled;
+    }
+    return bestmove;
+}
+
+/* Iterative deepening: search depth 1, 2, ..., maxdepth, so that a usable answer exists early and
+ * improves as the search goes on. Each iteration starts afresh (the transposition table is only
+ * valid for one depth limit); the shallower iterations add a fraction of the cost of the last. */
+struct move_search_t {
+    float score;
+    unsigned long nodes;
+    bool stopped;
+};
+
+int score_toplevel_moves_deepening(board_t board, float *scores, int maxdepth, search_progress_t *progress, search_token_t *token) {
+    int bestmove = SEARCH_CANCELLED;
+    uint64_t nodes = 0;
+    float survival[4];
+    int candidates = endgame_candidates(board, survival);
+    if (maxdepth <= 0)
+        maxdepth = default_search_depth(board);
+
+    for (int depth = 1; depth <= maxdepth; ++depth) {
+        float iter_scores[4];
+        int iter_best = -1;
+        float best = 0;
+        bool stopped = false;
+        // Search the moves of each iteration in parallel, as score_moves does without progress
+        std::future<move_search_t> futures[4];
+        for (int move = 0; move < 4; ++move) {
+            iter_scores[move] = 0;
+            if (execute_move(move, board) == board)
+                continue;
+            if (!(candidates & (1 << move))) {
+                iter_scores[move] = endgame_score(survival[move]);
+                continue;
+            }
+            futures[move] = std::async(std::launch::async, [board, move, depth, progress, token]() -> move_search_t {
+                eval_state state(token, progress);
+                state.depth_limit = depth;
+                float score = _score_toplevel_move(state, board, move);
+                if (progress)
+                    publish_nodes(state);
+                return {score, state.moves_evaled, state.stopped};
+            });
+        }
+        for (int move = 0; move < 4; ++move) {
+            if (futures[move].valid()) {
+                move_search_t result = futures[move].get();
+                iter_scores[move] = result.score;
+                nodes += result.nodes;
+                stopped |= result.stopped;
+            }
+            if (iter_scores[move] > best) {
+                best = iter_scores[move];
+                iter_best = move;
+            }
+        }
+        if (stopped)
+            break;
+
+        for (int move = 0; move < 4; ++move)
+            scores[move] = iter_scores[move];
+        bestmove = iter_best;
+        if (progress) {
+            std::lock_guard<std::mutex> guard(progress->lock);
+            progress->info.depth = depth;
+            progress->info.best_move = bestmove;
+            for (int move = 0; move < 4; ++move)
+                progress->info.scores[move] = scores[move];
+            progress->info.version++;
+            progress->nodes = nodes;
+        }
+        // Nothing to deepen once no move is legal
+        if (bestmove < 0)
+            break;
+    }
+
+    if (progress) {
+        std::lock_guard<std::mutex> guard(progress->lock);
+        progress->info.done = 1;
+        progress->info.version++;
+        progress->nodes = nodes;
+    }
+    return bestmove;
+}
+
+/* Level-synchronous batched search.
+ *
+ * Instead of a depth-first walk, the tree is expanded one level at a time. Each level is an array
+ * of distinct boards, so a board reached along several paths is expanded and evaluated once
+ * (its cumulative probability is the largest over those paths). Edges are stored as contiguous
+ * segments of child indices per parent, so values are backed up level by level with segmented
+ * reductions, evaluating leaves as they are reached. Every step is split across threads.
+ *
+ * This is slower than the depth-first search (about 1.7x on one core): building and deduplicating
+ * the frontiers costs more than the transposition table lookups it replaces. Leaf evaluation is a
+ * negligible part of its time, so vectorizing it (e.g. with gathers) would not close the gap.
+ * It is experimental and not offered as a 2048.py --engine: no gain on several cores has been
+ * measured yet, a level past BATCH_MAX_LEVEL edges silently makes the search shallower, and the
+ * token is only checked between levels.
+ *
+ * Levels alternate: chance levels hold boards after a move (before the spawn), move levels hold
+ * boards after the spawn. A chance node is a leaf at the depth limit or when its probability drops
+ * below CPROB_THRESH_BASE, as in score_tilechoose_node. Since there is no transposition table
+ * reusing shallower results, values can differ slightly from score_toplevel_move. */
+
+// Stop expanding (making the last chance level all leaves) before a level grows past this
+static const size_t BATCH_MAX_LEVEL = (size_t)1 << 25;
+
+struct batch_level_t {
+    std::vector<board_t> boards;      // distinct
+    std::vector<float> cprob;
+    std::vector<uint32_t> child_start; // children of node i: child_start[i] .. child_start[i+1]
+    std::vector<uint32_t> child_index; // index into the next level
+    std::vector<float> child_weight;   // chance levels: spawn probability weight (0.9 or 0.1)
+    std::vector<float> value;
+};
+
+// Run fn(begin, end) over [0, n) split across nthreads threads.
+template<typename F>
+static void parallel_for(size_t n, int nthreads, F fn) {
+    const size_t MIN_CHUNK = 4096;
+    size_t nchunks = std::min<size_t>(nthreads, (n + MIN_CHUNK - 1) / MIN_CHUNK);
+    if (nchunks <= 1) {
+        fn((size_t)0, n);
+        return;
+    }
+    std::vector<std::thread> threads;
+    for (size_t c = 1; c < nchunks; ++c)
+        threads.emplace_back(fn, n * c / nchunks, n * (c + 1) / nchunks);
+    fn((size_t)0, n / nchunks);
+    for (auto &thread : threads)
+        thread.join();
+}
+
+// Run fn(task) for every task in [0, ntasks) on up to nthreads threads.
+template<typename F>
+static void parallel_tasks(size_t ntasks, int nthreads, F fn) {
+    std::atomic<size_t> next_task(0);
+    auto worker = [&]() {
+        size_t task;
+        while ((task = next_task++) < ntasks)
+            fn(task);
+    };
+    std::vector<std::thread> threads;
+    for (size_t t = 1; t < std::min<size_t>(nthreads, ntasks); ++t)
+        threads.emplace_back(worker);
+    worker();
+    for (auto &thread : threads)
+        thread.join();
+}
+
+struct batch_edge_t {
+    board_t board;
+    float cprob;
+};
+
+/* Deduplicate the edges of parent into the next level: distinct child boards with the largest
+ * incoming cprob, and each edge pointing at its child's index.
+ *
+ * Boards are split into one shard per thread by the top bits of their hash, and each shard is
+ * deduplicated with its own open-addressing hash table, so there is no sorting and no locking. */
+static void batch_link(batch_level_t &parent, const std::vector<batch_edge_t> &edges, batch_level_t &child, int nthreads) {
+    size_t n = edges.size();
+    size_t nshards = n >= 65536 ? nthreads : 1;
+    parent.child_index.resize(n);
+
+    std::vector<std::vector<board_t>> boards(nshards);
+    std::vector<std::vector<float>> cprob(nshards);
+    parallel_tasks(nshards, nthreads, [&](size_t s) {
+        size_t tablesize = 16;
+        while (tablesize < 2 * n / nshards + 16)
+            tablesize *= 2;
+        std::vector<uint32_t> table(tablesize, 0); // local index + 1, 0 if empty
+        boards[s].reserve(n / nshards);
+        cprob[s].reserve(n / nshards);
+        for (size_t e = 0; e < n; ++e) {
+            uint64_t h = hash_board(edges[e].board);
+            if (nshards > 1 && (h >> 32) * nshards >> 32 != s)
+                continue;
+            size_t slot = h & (tablesize - 1);
+            while (table[slot] && boards[s][table[slot] - 1] != edges[e].board)
+                slot = (slot + 1) & (tablesize - 1);
+            if (!table[slot]) {
+                boards[s].push_back(edges[e].board);
+                cprob[s].push_back(edges[e].cprob);
+                table[slot] = boards[s].size();
+            } else {
+                cprob[s][table[slot] - 1] = std::max(cprob[s][table[slot] - 1], edges[e].cprob);
+            }
+            parent.child_index[e] = table[slot] - 1;
+        }
+    });
+
+    // Concatenate the shards, and turn shard-local indices into level indices
+    std::vector<uint32_t> offset(nshards + 1, 0);
+    for (size_t s = 0; s < nshards; ++s)
+        offset[s + 1] = offset[s] + boards[s].size();
+    child.boards.resize(offset[nshards]);
+    child.cprob.resize(offset[nshards]);
+    for (size_t s = 0; s < nshards; ++s) {
+        std::copy(boards[s].begin(), boards[s].end(), child.boards.begin() + offset[s]);
+        std::copy(cprob[s].begin(), cprob[s].end(), child.cprob.begin() + offset[s]);
+    }
+    if (nshards > 1) {
+        parallel_for(n, nthreads, [&](size_t begin, size_t end) {
+            for (size_t e = begin; e < end; ++e)
+                parent.child_index[e] += offset[(hash_board(edges[e].board) >> 32) * nshards >> 32];
+        });
+    }
+}
+
+int score_toplevel_moves_batched(board_t board, float *scores, uint64_t *nodes, int nthreads, search_token_t *token) {
+    if (nthreads <= 0)
+        nthreads = std::max(1u, std::thread::hardware_concurrency());
+    const evaluator_t *evaluator = current_evaluator;
+    const int depth_limit = default_search_depth(board);
+    if (nodes)
+        *nodes = 0;
+
+    // levels[2k] are chance levels at depth k, levels[2k+1] the move levels below them
+    std::vector<batch_level_t> levels(1);
+    board_t afterstates[4];
+    float survival[4];
+    int candidates = endgame_candidates(board, survival);
+    std::vector<batch_edge_t> edges;
+    for (int move = 0; move < 4; ++move) {
+        afterstates[move] = execute_move(move, board);
+        if (afterstates[move] != board && (candidates & (1 << move)))
+            edges.push_back({afterstates[move], 1.0f});
+    }
+    if (edges.empty()) {
+        for (int move = 0; move < 4; ++move)
+            scores[move] = 0;
+        return -1;
+    }
+    batch_level_t root;
+    batch_link(root, edges, levels[0], nthreads);
+
+    // Expand downwards. The token is checked once per level.
+    for (int depth = 0; ; ++depth) {
+        if (token && search_token_stopped(token))
+            return SEARCH_CANCELLED;
+        batch_level_t &chance = levels.back();
+        size_t n = chance.boards.size();
+        chance.child_start.assign(n + 1, 0);
+        parallel_for(n, nthreads, [&](size_t begin, size_t end) {
+            for (size_t i = begin; i < end; ++i) {
+                bool leaf = depth >= depth_limit || chance.cprob[i] < CPROB_THRESH_BASE;
+                chance.child_start[i + 1] = leaf ? 0 : 2 * count_empty(chance.boards[i]);
+            }
+        });
+        for (size_t i = 0; i < n; ++i)
+            chance.child_start[i + 1] += chance.child_start[i];
+        size_t nedges = chance.child_start[n];
+        if (nedges == 0 || nedges > BATCH_MAX_LEVEL) {
+            chance.child_start.assign(n + 1, 0);
+            break;
+        }
+
+        edges.resize(nedges);
+        chance.child_weight.resize(nedges);
+        parallel_for(n, nthreads, [&](size_t begin, size_t end) {
+            for (size_t i = begin; i < end; ++i) {
+                uint32_t e = chance.child_start[i];
+                if (e == chance.child_start[i + 1])
+                    continue;
+                board_t b = chance.boards[i];
+                float cprob = chance.cprob[i] / count_empty(b);
+                board_t tmp = b;
+                for (board_t tile_2 = 1; tile_2; tile_2 <<= 4, tmp >>= 4) {
+                    if ((tmp & 0xf) != 0)
+                        continue;
+                    edges[e] = {b | tile_2, cprob * 0.9f};
+                    chance.child_weight[e++] = 0.9f;
+                    edges[e] = {b | (tile_2 << 1), cprob * 0.1f};
+                    chance.child_weight[e++] = 0.1f;
+                }
+            }
+        });
+        levels.emplace_back();
+        batch_link(levels[levels.size() - 2], edges, levels.back(), nthreads);
+
+        batch_level_t &moves = levels.back();
+        size_t nmoves = moves.boards.size();
+        if (nodes)
+            *nodes += 4 * nmoves;
+        std::vector<board_t> next(4 * nmoves);
+        moves.child_start.assign(nmoves + 1, 0);
+        parallel_for(nmoves, nthreads, [&](size_t begin, size_t end) {
+            for (size_t i = begin; i < end; ++i) {
+                int k = 0;
+                for (int move = 0; move < 4; ++move) {
+                    board_t newboard = execute_move(move, moves.boards[i]);
+                    if (newboard != moves.boards[i])
+                        next[4 * i + k++] = newboard;
+                }
+                moves.child_start[i + 1] = k;
+            }
+        });
+        for (size_t i = 0; i < nmoves; ++i)
+            moves.child_start[i + 1] += moves.child_start[i];
+        edges.resize(moves.child_start[nmoves]);
+        parallel_for(nmoves, nthreads, [&](size_t begin, size_t end) {
+            for (size_t i = begin; i < end; ++i)
+                for (uint32_t e = moves.child_start[i]; e < moves.child_start[i + 1]; ++e)
+                    edges[e] = {next[4 * i + (e - moves.child_start[i])], moves.cprob[i]};
+        });
+        levels.emplace_back();
+        batch_link(levels[levels.size() - 2], edges, levels.back(), nthreads);
+    }
+
+    if (token && search_token_stopped(token))
+        return SEARCH_CANCELLED;
+
+    // Back values up, deepest level first
+    for (size_t l = levels.size(); l-- > 0; ) {
+        batch_level_t &level = levels[l];
+        size_t n = level.boards.size();
+        level.value.resize(n);
+        const std::vector<float> *below = l + 1 < levels.size() ? &levels[l + 1].value : NULL;
+        if (l % 2 == 0) {
+            // Chance level: leaves are evaluated, other nodes average over the spawns
+            parallel_for(n, nthreads, [&](size_t begin, size_t end) {
+                for (size_t i = begin; i < end; ++i) {
+                    uint32_t first = level.child_start[i], last = level.child_start[i + 1];
+                    if (first == last) {
+                        level.value[i] = evaluator->evaluate(level.boards[i]);
+                        continue;
+                    }
+                    float res = 0.0f;
+                    for (uint32_t e = first; e < last; ++e)
+                        res += (*below)[level.child_index[e]] * level.child_weight[e];
+                    level.value[i] = res / ((last - first) / 2);
+                }
+            });
+        } else {
+            // Move level: best move, or 0 if the game is lost
+            parallel_for(n, nthreads, [&](size_t begin, size_t end) {
+                for (size_t i = begin; i < end; ++i) {
+                    float best = 0.0f;
+                    for (uint32_t e = level.child_start[i]; e < level.child_start[i + 1]; ++e)
+                        best = std::max(best, (*below)[level.child_index[e]]);
+                    level.value[i] = best;
+                }
+            });
+        }
+    }
+
+    int bestmove = -1;
+    float best = 0;
+    for (int move = 0; move < 4; ++move) {
+        scores[move] = 0;
+        if (afterstates[move] == board)
+            continue;
+        const std::vector<board_t> &top = levels[0].boards;
+        size_t i = std::find(top.begin(), top.end(), afterstates[move]) - top.begin();
+        scores[move] = i < top.size() ? levels[0].value[i] + 1e-6 : endgame_score(survival[move]);
+        if (scores[move] > best) {
+            best = scores[move];
+            bestmove = move;
+        }
+    }
+    return bestmove;
+}
+
 /* Find the best move for a given board. */
 int find_best_move(board_t board) {
     int bestmove = -1;
@@ -476,13 +1504,63 @@ int ask_for_move(board_t board) {
     }
 }
 
+/* Random numbers */
+
+/* Per-game RNG state (xoshiro256**). Each game or simulator owns one, so games are reproducible
+ * from their seed and parallel games don't contend on shared RNG state. */
+struct game_rng_t {
+    uint64_t s[4];
+};
+
+static inline uint64_t splitmix64(uint64_t *state) {
+    uint64_t z = (*state += 0x9E3779B97F4A7C15ULL);
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+    return z ^ (z >> 31);
+}
+
+static inline uint64_t rotl(uint64_t x, int k) {
+    return (x << k) | (x >> (64 - k));
+}
+
+static void rng_seed(game_rng_t *rng, uint64_t seed) {
+    for (int i = 0; i < 4; ++i)
+        rng->s[i] = splitmix64(&seed);
+}
+
+static inline uint64_t rng_next(game_rng_t *rng) {
+    uint64_t *s = rng->s;
+    uint64_t result = rotl(s[1] * 5, 7) * 9;
+    uint64_t t = s[1] << 17;
+    s[2] ^= s[0];
+    s[3] ^= s[1];
+    s[1] ^= s[2];
+    s[0] ^= s[3];
+    s[2] ^= t;
+    s[3] = rotl(s[3], 45);
+    return result;
+}
+
+// Uniform value in [0..n-1] (multiply-shift; the bias is negligible for small n).
+static inline unsigned rng_uniform(game_rng_t *rng, unsigned n) {
+    return (unsigned)(((rng_next(rng) >> 32) * n) >> 32);
+}
+
+// Seed for games that aren't given one, taken from the platform RNG.
+static uint64_t entropy_seed() {
+    uint64_t seed = 0;
+    for (int i = 0; i < 4; ++i)
+        seed = (seed << 16) | unif_random(65536);
+    return seed;
+}
+
 /* Playing the game */
-static board_t draw_tile() {
-    return (unif_random(10) < 9) ? 1 : 2;
+static board_t draw_tile(game_rng_t *rng) {
+    return (rng_uniform(rng, 10) < 9) ? 1 : 2;
 }
 
-static board_t insert_tile_rand(board_t board, board_t tile) {
-    int index = unif_random(count_empty(board));
+/* Place tile (1 or 2, in the lowest nibble) into the index'th empty cell, counting from the LSB. */
+static board_t insert_tile_at(board_t board, board_t tile, int index) {
     board_t tmp = board;
     while (true) {
         while ((tmp & 0xf) != 0) {
@@ -497,13 +1575,20 @@ static board_t insert_tile_rand(board_t board, board_t tile) {
     return board | tile;
 }
 
-static board_t initial_board() {
-    board_t board = draw_tile() << (4 * unif_random(16));
-    return insert_tile_rand(board, draw_tile());
+static board_t insert_tile_rand(game_rng_t *rng, board_t board, board_t tile) {
+    return insert_tile_at(board, tile, rng_uniform(rng, count_empty(board)));
+}
+
+static board_t initial_board(game_rng_t *rng) {
+    board_t board = draw_tile(rng) << (4 * rng_uniform(rng, 16));
+    return insert_tile_rand(rng, board, draw_tile(rng));
 }
 
 void play_game(get_move_func_t get_move) {
-    board_t board = initial_board();
+    game_rng_t rng;
+    rng_seed(&rng, entropy_seed());
+
+    board_t board = initial_board(&rng);
     int moveno = 0;
     int scorepenalty = 0; // "penalty" for obtaining free 4 tiles
 
@@ -531,15 +1616,128 @@ void play_game(get_move_func_t get_move) {
             continue;
         }
 
-        board_t tile = draw_tile();
+        board_t tile = draw_tile(&rng);
         if (tile == 2) scorepenalty += 4;
-        board = insert_tile_rand(newboard, tile);
+        board = insert_tile_rand(&rng, newboard, tile);
     }
 
     print_board(board);
     printf("\nGame over. Your score is %.0f. The highest rank you achieved was %d.\n", score_board(board) - scorepenalty, get_max_rank(board));
 }
 
+/* Self-play: many silent games in parallel */
+
+// Like find_best_move, but without output and without spawning threads of its own.
+static int find_best_move_quiet(board_t board) {
+    int bestmove = -1;
+    float best = 0;
+    for(int move = 0; move < 4; move++) {
+        float score = score_toplevel_move(board, move);
+        if(score > best) {
+            best = score;
+            bestmove = move;
+        }
+    }
+    return bestmove;
+}
+
+static void selfplay_game(uint64_t seed, int *score, int *maxrank, int *moves) {
+    game_rng_t rng;
+    rng_seed(&rng, seed);
+
+    board_t board = initial_board(&rng);
+    int moveno = 0;
+    int scorepenalty = 0;
+
+    while(1) {
+        int move = find_best_move_quiet(board);
+        if(move < 0)
+            break;
+        board_t tile = draw_tile(&rng);
+        if (tile == 2) scorepenalty += 4;
+        board = insert_tile_rand(&rng, execute_move(move, board), tile);
+        moveno++;
+    }
+
+    *score = (int)score_board(board) - scorepenalty;
+    *maxrank = get_max_rank(board);
+    *moves = moveno;
+}
+
+void selfplay(uint64_t seed, int ngames, int nthreads, int *scores, int *maxranks, int *moves) {
+    // Per-game seeds depend only on (seed, game index), not on which thread plays the game.
+    std::atomic<int> next_game(0);
+    auto worker = [&]() {
+        int i;
+        while((i = next_game++) < ngames) {
+            uint64_t game_seed = seed + (uint64_t)i * 0x9E3779B97F4A7C15ULL;
+            selfplay_game(splitmix64(&game_seed), &scores[i], &maxranks[i], &moves[i]);
+        }
+    };
+
+    if(nthreads <= 0)
+        nthreads = std::max(1u, std::thread::hardware_concurrency());
+    std::vector<std::thread> threads;
+    for(int t = 1; t < nthreads; t++)
+        threads.emplace_back(worker);
+    worker();
+    for(auto &thread : threads)
+        thread.join();
+}
+
+/* Game simulator API */
+
+game_rng_t *game_rng_new(uint64_t seed) {
+    game_rng_t *rng = new game_rng_t;
+    rng_seed(rng, seed);
+    return rng;
+}
+
+void game_rng_free(game_rng_t *rng) {
+    delete rng;
+}
+
+int game_legal_moves(board_t board) {
+    int mask = 0;
+    for(int move = 0; move < 4; move++) {
+        if(execute_move(move, board) != board)
+            mask |= 1 << move;
+    }
+    return mask;
+}
+
+board_t game_spawn(game_rng_t *rng, board_t board) {
+    int num_empty = board ? count_empty(board) : 16; // count_empty can't count 16 empty cells
+    if(num_empty == 0)
+        return board;
+    board_t tile = draw_tile(rng);
+    return insert_tile_at(board, tile, rng_uniform(rng, num_empty));
+}
+
+board_t game_new(game_rng_t *rng) {
+    return initial_board(rng);
+}
+
+board_t game_move(board_t board, int move, int *score_delta) {
+    board_t newboard = execute_move(move, board);
+    if(newboard == board || move < 0 || move > 3) {
+        *score_delta = 0;
+        return board;
+    }
+    /* score_board counts every tile as if it was built from 2s, so its change over a move is exactly
+     * the value of the merged tiles. */
+    *score_delta = (int)(score_board(newboard) - score_board(board));
+    return newboard;
+}
+
+board_t game_step(game_rng_t *rng, board_t board, int move, int *score_delta, int *done) {
+    board_t newboard = game_move(board, move, score_delta);
+    if(newboard != board)
+        newboard = game_spawn(rng, newboard);
+    *done = game_legal_moves(newboard) == 0;
+    return newboard;
+}
+
 int main() {
     init_tables();
     
@@ -16,8 +16,10 @@ typedef uint64_t board_t;
 typedef uint16_t row_t;
 
 //store the depth at which the heuristic was recorded as well as the actual heuristic
+//(the pruned search also stores upper bounds, flagged with is_bound)
 struct trans_table_entry_t{
     uint8_t depth;
+    uint8_t is_bound;
     float heuristic;
 };
 
@@ -61,11 +63,100 @@ DLL_PUBLIC void init_tables();
 DLL_PUBLIC board_t execute_move(int move, board_t board);
 
 typedef int (*get_move_func_t)(board_t);
+
+/* Cancellation tokens for searches. A search given a token (NULL: none) stops soon after the token
+ * is cancelled, from any thread, or its deadline (seconds from now; < 0: none) passes, and then
+ * returns SEARCH_CANCELLED. Don't free a token while a search is using it. */
+typedef struct search_token_t search_token_t;
+enum { SEARCH_CANCELLED = -2 };
+DLL_PUBLIC search_token_t *search_token_new();
+DLL_PUBLIC void search_token_free(search_token_t *token);
+DLL_PUBLIC void search_token_cancel(search_token_t *token);
+DLL_PUBLIC void search_token_set_deadline(search_token_t *token, double seconds);
+DLL_PUBLIC int search_token_stopped(const search_token_t *token);
+
 DLL_PUBLIC float score_toplevel_move(board_t board, int move);
+/* Like score_toplevel_move, but searching depth moves deep (<= 0: default_search_depth(board)). */
+DLL_PUBLIC float score_toplevel_move_depth(board_t board, int move, int depth);
+DLL_PUBLIC float score_toplevel_move_token(board_t board, int move, int depth, search_token_t *token);
+/* Like score_toplevel_move_token, given endgame_candidates(board, survivals) as candidates and
+ * survivals[move] as survival, so that scoring each move of a board solves its endgame only once
+ * (candidates < 0: compute them). */
+DLL_PUBLIC float score_toplevel_move_candidates(board_t board, int move, int depth, int candidates, float survival, search_token_t *token);
+DLL_PUBLIC int default_search_depth(board_t board);
+
+/* Probability of surviving horizon moves (this one included) after making move on board, playing
+ * only to survive, over every possible tile spawn. 0 if the move is illegal. Searches use it to
+ * skip moves that are much more likely to lose on boards with few empty cells. */
+DLL_PUBLIC float survival_probability(board_t board, int move, int horizon);
+/* Bit mask of the moves of board that should be searched. On boards with few empty cells, legal
+ * moves whose survival probability is clearly below the best are left out, and score just above
+ * 0; otherwise every move is a candidate. survival receives the probabilities if they were solved. */
+DLL_PUBLIC int endgame_candidates(board_t board, float survival[4]);
+
+/* Score all four moves of board (0: illegal) and return the best one (-1: none). nodes, if not
+ * NULL, receives the number of move nodes evaluated. The pruned variant is approximate: it usually
+ * returns the same best move with fewer nodes, but may pick another on near-ties (see the comment
+ * on the pruned search), and the scores of other moves may only be upper bounds below the best score. */
+DLL_PUBLIC int score_toplevel_moves(board_t board, float *scores, uint64_t *nodes, search_token_t *token);
+DLL_PUBLIC int score_toplevel_moves_pruned(board_t board, float *scores, uint64_t *nodes, search_token_t *token);
+/* Level-by-level search over deduplicated frontiers on nthreads threads (<= 0: one per core).
+ * Experimental: usually slower than score_toplevel_moves, searches shallower without telling when
+ * a level grows too large, and only notices a stopped token between levels. */
+DLL_PUBLIC int score_toplevel_moves_batched(board_t board, float *scores, uint64_t *nodes, int nthreads, search_token_t *token);
+
+/* Progress of an iterative-deepening search, for polling from other threads. search_progress_read
+ * copies a consistent snapshot into info. */
+typedef struct search_progress_t search_progress_t;
+typedef struct {
+    int depth;          // deepest completed iteration (0: none yet)
+    int best_move;      // best move at that depth (-1: none)
+    float scores[4];    // scores of the four moves at that depth
+    uint64_t nodes;     // move nodes searched so far, over all iterations
+    int done;           // the search has returned
+    unsigned version;   // incremented every time depth or done changes
+} search_progress_info_t;
+DLL_PUBLIC search_progress_t *search_progress_new();
+DLL_PUBLIC void search_progress_free(search_progress_t *progress);
+DLL_PUBLIC void search_progress_read(search_progress_t *progress, search_progress_info_t *info);
+
+/* Like score_toplevel_moves, but deepening one move at a time up to maxdepth (<= 0:
+ * default_search_depth(board)), publishing each completed iteration to progress (may be NULL).
+ * The moves of each iteration are searched in parallel, one thread each.
+ * If token stops the search, scores and the result are those of the deepest completed iteration,
+ * or SEARCH_CANCELLED if the first one didn't complete. */
+DLL_PUBLIC int score_toplevel_moves_deepening(board_t board, float *scores, int maxdepth, search_progress_t *progress, search_token_t *token);
+
+/* Leaf evaluators. Searches use the evaluator selected when they start; don't load weights while
+ * an n-tuple search is running. load_ntuple_weights returns the number of tuples, or -1 if the
+ * file can't be read; set_evaluator returns -1 for an unknown evaluator or if no weights are loaded. */
+enum { EVALUATOR_HEURISTIC = 0, EVALUATOR_NTUPLE = 1 };
+DLL_PUBLIC int load_ntuple_weights(const char *path);
+DLL_PUBLIC int set_evaluator(int evaluator);
+/* Evaluate n boards with the current leaf evaluator, as the search does at its leaves. */
+DLL_PUBLIC void evaluate_boards(const board_t *boards, float *values, int n);
+/* Name of the CPU-specific build of this library: "baseline" or "bmi2" (BMI2 and POPCNT). */
+DLL_PUBLIC const char *engine_variant();
+/* Revision of the search's scoring: scores stored by builds with another revision are stale. */
+DLL_PUBLIC int engine_scoring_revision();
 DLL_PUBLIC int find_best_move(board_t board);
 DLL_PUBLIC int ask_for_move(board_t board);
 DLL_PUBLIC void play_game(get_move_func_t get_move);
 
+/* Play ngames silent games with the AI on nthreads threads (<= 0: one per core). Results for game i
+ * go to scores[i], maxranks[i] and moves[i], and depend only on seed and i. */
+DLL_PUBLIC void selfplay(uint64_t seed, int ngames, int nthreads, int *scores, int *maxranks, int *moves);
+
+/* Game simulator. Boards are passed by value; a game_rng_t holds the state of a seeded RNG. */
+typedef struct game_rng_t game_rng_t;
+DLL_PUBLIC game_rng_t *game_rng_new(uint64_t seed);
+DLL_PUBLIC void game_rng_free(game_rng_t *rng);
+DLL_PUBLIC board_t game_new(game_rng_t *rng);
+DLL_PUBLIC board_t game_spawn(game_rng_t *rng, board_t board);
+DLL_PUBLIC board_t game_move(board_t board, int move, int *score_delta);
+DLL_PUBLIC board_t game_step(game_rng_t *rng, board_t board, int move, int *score_delta, int *done);
+DLL_PUBLIC int game_legal_moves(board_t board);
+
 #ifdef __cplusplus
 }
 #endif
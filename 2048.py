@@ -6,7 +6,11 @@
 from __future__ import print_function
 import time
 
-from ailib import ailib, to_c_board, from_c_index
+from ailib import ailib, to_c_board, from_c_index, score_move, endgame_candidates, score_moves_pruned, score_moves_deepening, \
+    use_ntuple_weights
+from gamerec import GameRecorder, find_spawn
+from poscache import PositionCache
+from latency import MoveProfiler
 from multiprocessing.pool import ThreadPool
 
 # Enable multithreading?
@@ -29,47 +33,99 @@ def _to_score(c):
 def to_score(m):
     return [[_to_score(c) for c in row] for row in m]
 
-pool = ThreadPool(4)
-def score_toplevel_move(args):
-    return ailib.score_toplevel_move(*args)
+# Optional PositionCache consulted before searching (see --cache)
+position_cache = None
 
-def find_best_move(m):
-    board = to_c_board(m)
+# Search engine used by score_moves (see --engine)
+search_engine = 'expectimax'
+# n-tuple weights file used by the searches, if any (see --weights)
+search_weights = None
 
-    # print_board(to_val(m))
+def search_settings():
+    ''' The settings that score_moves results depend on, as a hashable key. '''
+    return (search_engine, search_weights)
 
-    scores = pool.map(score_toplevel_move, [(board, move) for move in range(4)])
+pool = ThreadPool(4)
+def score_toplevel_move(args):
+    return score_move(*args)
+
+def score_moves(board, token=None, progress=None):
+    ''' Score all four moves on a packed board; illegal moves score 0.
+
+    A SearchToken can stop the search early, which then raises SearchCancelled. With a
+    SearchProgress, the expectimax engine deepens iteratively and reports each depth to it (a
+    cancelled search then returns the deepest completed depth); other engines don't report. '''
+    if position_cache is not None:
+        scores = position_cache.lookup(board)
+        if scores is not None:
+            return scores
+    if progress is not None and search_engine == 'expectimax':
+        return score_moves_deepening(board, 0, progress, token)
+    if search_engine == 'pruned':
+        return score_moves_pruned(board, token)
+    candidates = endgame_candidates(board)
+    return pool.map(score_toplevel_move, [(board, move, 0, token, candidates) for move in range(4)])
+
+def best_move(scores):
+    ''' Pick the best move from per-direction scores; -1 if no move is possible. '''
     bestmove, bestscore = max(enumerate(scores), key=lambda x:x[1])
     if bestscore == 0:
         return -1
     return bestmove
 
+def find_best_move(m, token=None):
+    ''' Find the best move for m, either a 4x4 list of ranks or a packed board_t. '''
+    board = m if isinstance(m, int) else to_c_board(m)
+
+    # print_board(to_val(m))
+
+    return best_move(score_moves(board, token))
+
 def movename(move):
     return ['up', 'down', 'left', 'right'][move]
 
-def play_game(gamectrl):
+def play_game(gamectrl, recorder=None, profiler=None):
+    if profiler is None:
+        profiler = MoveProfiler()
+    gamectrl.profiler = profiler
     moveno = 0
     start = time.time()
+    if recorder is not None:
+        game = recorder.new_game()
+        expected = None
     while 1:
-        state = gamectrl.get_status()
-        if state == 'ended':
-            break
-        elif state == 'won':
-            time.sleep(0.75)
-            gamectrl.continue_game()
-
-        moveno += 1
-        board = gamectrl.get_board()
-        move = find_best_move(board)
-        if move < 0:
-            break
-        # print("%010.6f: Score %d, Move %d: %s" % (time.time() - start, gamectrl.get_score(), moveno, movename(move)))
-        gamectrl.execute_move(move)
+        with profiler.move() as timing:
+            state = gamectrl.get_status()
+            if state == 'ended':
+                timing.cancel()
+                break
+            elif state == 'won':
+                time.sleep(0.75)
+                gamectrl.continue_game()
+
+            moveno += 1
+            with timing.phase('decode'):
+                board = to_c_board(gamectrl.get_board())
+            with timing.phase('search'):
+                scores = score_moves(board)
+                move = best_move(scores)
+            if recorder is not None:
+                spawn = find_spawn(expected, board) if expected is not None else None
+                recorder.record(game, moveno - 1, board, move, scores, timing.phases['search'], spawn)
+                expected = ailib.execute_move(move, board) if move >= 0 else None
+            if move < 0:
+                timing.cancel()
+                break
+            # print("%010.6f: Score %d, Move %d: %s" % (time.time() - start, gamectrl.get_score(), moveno, movename(move)))
+            with timing.phase('execute'):
+                gamectrl.execute_move(move)
 
     score = gamectrl.get_score()
     board = gamectrl.get_board()
     maxval = max(max(row) for row in to_val(board))
     # print("Game over. Final score %d; highest tile %d." % (score, maxval))
+    print("Move latency (ms) over %d moves in %.1f seconds:" % (moveno, time.time() - start))
+    print(profiler.summary())
 
 def parse_args(argv):
     import argparse
@@ -79,12 +135,43 @@ def parse_args(argv):
     parser.add_argument('-b', '--browser', help="Browser you're using. Only Firefox with remote debugging, Firefox with the Remote Control extension (deprecated), and Chrome with remote debugging, are supported right now.", default='firefox', choices=('firefox', 'firefox-rc', 'chrome', 'manual', 'gui', 'web'))
     parser.add_argument('-k', '--ctrlmode', help="Control mode to use. If the browser control doesn't seem to work, try changing this.", default='hybrid', choices=('keyboard', 'fast', 'hybrid', 'play2048co', 'gui', 'web'))
     parser.add_argument('-w', '--webport', help="Port number for the web interface (default: 5000)", type=int, default=5000)
+    parser.add_argument('-e', '--engine', help="Search engine. 'pruned' (approximate) skips subtrees that can't change the best move: it usually picks the same move as expectimax with fewer nodes, but may differ on near-ties, and scores only the best move exactly.", default='expectimax', choices=('expectimax', 'pruned'))
+    parser.add_argument('-W', '--weights', help="Evaluate search leaves with these n-tuple network weights (trained by ntuple_train.py) instead of the built-in heuristic")
+    parser.add_argument('-c', '--cache', help="Look up positions in this position cache (built by poscache.py) before searching")
+    parser.add_argument('-m', '--metrics', help="Write per-move latency histograms to this file at game end (JSON if it ends in .json, else Prometheus text)")
+    parser.add_argument('-r', '--record', help="Append a record of every turn played to this trajectory file")
 
     return parser.parse_args(argv)
 
 def main(argv):
-    args = parse_args(argv)
+    global position_cache, search_engine, search_weights
+    if argv and argv[0] == 'analyze':
+        import analyze
+        return analyze.main(argv[1:])
+    if argv and argv[0] == 'bench':
+        import bench
+        return bench.main(argv[1:])
 
+    args = parse_args(argv)
+    search_engine = args.engine
+    if args.weights:
+        use_ntuple_weights(args.weights)
+        search_weights = args.weights
+    if args.cache:
+        # Only scores searched with the same settings can stand in for a search
+        try:
+            position_cache = PositionCache(args.cache, args.engine, args.weights)
+        except ValueError as e:
+            print("Can't use --cache: %s" % e)
+            return 1
+    recorder = GameRecorder(args.record) if args.record else None
+    try:
+        return run(args, recorder)
+    finally:
+        if recorder is not None:
+            recorder.close()
+
+def run(args, recorder):
     if args.browser == 'firefox':
         from ffctrl import FirefoxDebuggerControl
         if args.port is None:
@@ -114,12 +201,12 @@ def main(argv):
         gamectrl = ManualControl()
     elif args.browser == 'gui' or args.ctrlmode == 'gui':
         from guictrl import GUIGameControl
-        gamectrl = GUIGameControl(find_best_move)
+        gamectrl = GUIGameControl(find_best_move, score_moves, recorder)
         gamectrl.setup_gui()  # 启动GUI
         return 0  # GUI模式下不进入play_game流程
     elif args.browser == 'web' or args.ctrlmode == 'web':
         from webctrl import WebGameControl
-        gamectrl = WebGameControl(find_best_move)
+        gamectrl = WebGameControl(find_best_move, score_moves, recorder, search_settings)
         gamectrl.setup_web(port=args.webport)  # 启动Web服务器
         return 0  # Web模式下不进入play_game流程
     elif args.ctrlmode == 'keyboard' and args.browser != 'manual':
@@ -140,7 +227,10 @@ def main(argv):
     if gamectrl.get_status() == 'ended':
         gamectrl.restart_game()
 
-    play_game(gamectrl)
+    profiler = MoveProfiler()
+    play_game(gamectrl, recorder, profiler)
+    if args.metrics:
+        profiler.export(args.metrics)
 
 if __name__ == '__main__':
     import sys
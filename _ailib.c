@@ -0,0 +1,227 @@
+/* Optional CPython binding for the engine library: `make ext` builds bin/_ailib.<python tag>.so.
+ *
+ * ctypes marshals every argument generically, which dominates the cost of short calls. This
+ * module calls the engine functions directly, releasing the GIL while they run. It doesn't link
+ * against the engine: ailib.py loads the best engine build with ctypes as usual, then passes the
+ * addresses of its functions to bind(), so both bindings share one library and its state (tables,
+ * evaluator, n-tuple weights).
+ *
+ * The batch functions take buffers (bytes, array.array, NumPy arrays, ...) of uint64 board_t and
+ * write float32 results, making one call per batch instead of one per board. */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+
+typedef uint64_t board_t;
+typedef struct search_token_t search_token_t;
+
+#define SEARCH_CANCELLED (-2)
+
+static float (*score_toplevel_move_candidates)(board_t board, int move, int depth, int candidates, float survival, search_token_t *token);
+static int (*score_toplevel_moves)(board_t board, float *scores, uint64_t *nodes, search_token_t *token);
+static int (*score_toplevel_moves_pruned)(board_t board, float *scores, uint64_t *nodes, search_token_t *token);
+static int (*score_toplevel_moves_batched)(board_t board, float *scores, uint64_t *nodes, int nthreads, search_token_t *token);
+static void (*evaluate_boards)(const board_t *boards, float *values, int n);
+static board_t (*execute_move)(int move, board_t board);
+
+#define CHECK_BOUND() \
+    if (!execute_move) { \
+        PyErr_SetString(PyExc_RuntimeError, "_ailib is not bound to an engine library"); \
+        return NULL; \
+    }
+
+/* The four scores as a list, or None if the search was cancelled. */
+static PyObject *scores_list(int res, const float scores[4]) {
+    if (res == SEARCH_CANCELLED)
+        Py_RETURN_NONE;
+    return Py_BuildValue("[ffff]", scores[0], scores[1], scores[2], scores[3]);
+}
+
+static PyObject *py_bind(PyObject *self, PyObject *args, PyObject *kwargs) {
+    static char *kwlist[] = {"score_toplevel_move_candidates", "score_toplevel_moves", "score_toplevel_moves_pruned",
+                             "score_toplevel_moves_batched", "evaluate_boards", "execute_move", NULL};
+    unsigned long long addr[6];
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "KKKKKK:bind", kwlist,
+                                     &addr[0], &addr[1], &addr[2], &addr[3], &addr[4], &addr[5]))
+        return NULL;
+    score_toplevel_move_candidates = (float (*)(board_t, int, int, int, float, search_token_t *))(uintptr_t)addr[0];
+    score_toplevel_moves = (int (*)(board_t, float *, uint64_t *, search_token_t *))(uintptr_t)addr[1];
+    score_toplevel_moves_pruned = (int (*)(board_t, float *, uint64_t *, search_token_t *))(uintptr_t)addr[2];
+    score_toplevel_moves_batched = (int (*)(board_t, float *, uint64_t *, int, search_token_t *))(uintptr_t)addr[3];
+    evaluate_boards = (void (*)(const board_t *, float *, int))(uintptr_t)addr[4];
+    execute_move = (board_t (*)(int, board_t))(uintptr_t)addr[5];
+    Py_RETURN_NONE;
+}
+
+/* Search tokens are passed as their address (0: none). */
+
+static PyObject *py_score_toplevel_move(PyObject *self, PyObject *args) {
+    board_t board;
+    int move, depth = 0, candidates = -1;
+    unsigned long long token = 0;
+    float survival = 0.0f, res;
+    if (!PyArg_ParseTuple(args, "Ki|iKif:score_toplevel_move", &board, &move, &depth, &token, &candidates, &survival))
+        return NULL;
+    CHECK_BOUND();
+    Py_BEGIN_ALLOW_THREADS
+    res = score_toplevel_move_candidates(board, move, depth, candidates, survival, (search_token_t *)(uintptr_t)token);
+    Py_END_ALLOW_THREADS
+    return PyFloat_FromDouble(res);
+}
+
+static PyObject *py_score_toplevel_moves(PyObject *self, PyObject *args) {
+    board_t board;
+    unsigned long long token = 0;
+    float scores[4];
+    int res;
+    if (!PyArg_ParseTuple(args, "K|K:score_toplevel_moves", &board, &token))
+        return NULL;
+    CHECK_BOUND();
+    Py_BEGIN_ALLOW_THREADS
+    res = score_toplevel_moves(board, scores, NULL, (search_token_t *)(uintptr_t)token);
+    Py_END_ALLOW_THREADS
+    return scores_list(res, scores);
+}
+
+static PyObject *py_score_toplevel_moves_pruned(PyObject *self, PyObject *args) {
+    board_t board;
+    unsigned long long token = 0;
+    float scores[4];
+    int res;
+    if (!PyArg_ParseTuple(args, "K|K:score_toplevel_moves_pruned", &board, &token))
+        return NULL;
+    CHECK_BOUND();
+    Py_BEGIN_ALLOW_THREADS
+    res = score_toplevel_moves_pruned(board, scores, NULL, (search_token_t *)(uintptr_t)token);
+    Py_END_ALLOW_THREADS
+    return scores_list(res, scores);
+}
+
+static PyObject *py_score_toplevel_moves_batched(PyObject *self, PyObject *args) {
+    board_t board;
+    int nthreads = 0;
+    unsigned long long token = 0;
+    float scores[4];
+    int res;
+    if (!PyArg_ParseTuple(args, "K|iK:score_toplevel_moves_batched", &board, &nthreads, &token))
+        return NULL;
+    CHECK_BOUND();
+    Py_BEGIN_ALLOW_THREADS
+    res = score_toplevel_moves_batched(board, scores, NULL, nthreads, (search_token_t *)(uintptr_t)token);
+    Py_END_ALLOW_THREADS
+    return scores_list(res, scores);
+}
+
+static PyObject *py_execute_move(PyObject *self, PyObject *args) {
+    int move;
+    board_t board;
+    if (!PyArg_ParseTuple(args, "iK:execute_move", &move, &board))
+        return NULL;
+    CHECK_BOUND();
+    return PyLong_FromUnsignedLongLong(execute_move(move, board));
+}
+
+/* Get a contiguous buffer of 8-byte or 4-byte items (kind 'u' for unsigned ints, 'f' for floats). */
+static int get_buffer(PyObject *obj, Py_buffer *view, int writable, Py_ssize_t itemsize, char kind, const char *name) {
+    const char *fmt;
+    char code;
+    if (PyObject_GetBuffer(obj, view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT | (writable ? PyBUF_WRITABLE : 0)) < 0)
+        return -1;
+    fmt = view->format ? view->format : "B";
+    if (*fmt == '<' || *fmt == '=' || *fmt == '@')
+        fmt++;
+    code = fmt[0];
+    if (view->itemsize != itemsize || fmt[1] != '\0' ||
+        (kind == 'u' ? (code != 'Q' && code != 'L') : code != 'f')) {
+        PyErr_Format(PyExc_TypeError, "%s must be a buffer of %s", name, kind == 'u' ? "uint64" : "float32");
+        PyBuffer_Release(view);
+        return -1;
+    }
+    return 0;
+}
+
+static PyObject *py_score_boards(PyObject *self, PyObject *args) {
+    PyObject *boards_obj, *scores_obj;
+    Py_buffer boards, scores;
+    Py_ssize_t i, n;
+    if (!PyArg_ParseTuple(args, "OO:score_boards", &boards_obj, &scores_obj))
+        return NULL;
+    CHECK_BOUND();
+    if (get_buffer(boards_obj, &boards, 0, 8, 'u', "boards") < 0)
+        return NULL;
+    if (get_buffer(scores_obj, &scores, 1, 4, 'f', "scores") < 0) {
+        PyBuffer_Release(&boards);
+        return NULL;
+    }
+    n = boards.len / 8;
+    if (scores.len / 4 < 4 * n) {
+        PyErr_SetString(PyExc_ValueError, "scores must hold 4 floats per board");
+    } else {
+        Py_BEGIN_ALLOW_THREADS
+        for (i = 0; i < n; ++i)
+            score_toplevel_moves(((const board_t *)boards.buf)[i], (float *)scores.buf + 4 * i, NULL, NULL);
+        Py_END_ALLOW_THREADS
+    }
+    PyBuffer_Release(&boards);
+    PyBuffer_Release(&scores);
+    if (PyErr_Occurred())
+        return NULL;
+    return PyLong_FromSsize_t(n);
+}
+
+static PyObject *py_evaluate_boards(PyObject *self, PyObject *args) {
+    PyObject *boards_obj, *values_obj;
+    Py_buffer boards, values;
+    Py_ssize_t n;
+    if (!PyArg_ParseTuple(args, "OO:evaluate_boards", &boards_obj, &values_obj))
+        return NULL;
+    CHECK_BOUND();
+    if (get_buffer(boards_obj, &boards, 0, 8, 'u', "boards") < 0)
+        return NULL;
+    if (get_buffer(values_obj, &values, 1, 4, 'f', "values") < 0) {
+        PyBuffer_Release(&boards);
+        return NULL;
+    }
+    n = boards.len / 8;
+    if (values.len / 4 < n || n > INT_MAX) {
+        PyErr_SetString(PyExc_ValueError, "values must hold 1 float per board");
+    } else {
+        Py_BEGIN_ALLOW_THREADS
+        evaluate_boards((const board_t *)boards.buf, (float *)values.buf, (int)n);
+        Py_END_ALLOW_THREADS
+    }
+    PyBuffer_Release(&boards);
+    PyBuffer_Release(&values);
+    if (PyErr_Occurred())
+        return NULL;
+    return PyLong_FromSsize_t(n);
+}
+
+static PyMethodDef methods[] = {
+    {"bind", (PyCFunction)(void (*)(void))py_bind, METH_VARARGS | METH_KEYWORDS,
+     "bind(**addresses): call the engine functions at these addresses."},
+    {"score_toplevel_move", py_score_toplevel_move, METH_VARARGS,
+     "score_toplevel_move(board, move, depth=0, token=0, candidates=-1, survival=0.0) -> score of one move (0: illegal, -2: cancelled)."},
+    {"score_toplevel_moves", py_score_toplevel_moves, METH_VARARGS,
+     "score_toplevel_moves(board, token=0) -> scores of the four moves, or None if cancelled."},
+    {"score_toplevel_moves_pruned", py_score_toplevel_moves_pruned, METH_VARARGS,
+     "score_toplevel_moves_pruned(board, token=0) -> scores of the four moves from the pruned search, or None if cancelled."},
+    {"score_toplevel_moves_batched", py_score_toplevel_moves_batched, METH_VARARGS,
+     "score_toplevel_moves_batched(board, nthreads=0, token=0) -> scores of the four moves from the batched search, or None if cancelled."},
+    {"execute_move", py_execute_move, METH_VARARGS,
+     "execute_move(move, board) -> board after the move, before the tile spawn."},
+    {"score_boards", py_score_boards, METH_VARARGS,
+     "score_boards(boards, scores) -> n: search every board of a uint64 buffer into a float32 buffer of 4 scores per board."},
+    {"evaluate_boards", py_evaluate_boards, METH_VARARGS,
+     "evaluate_boards(boards, values) -> n: evaluate every board of a uint64 buffer into a float32 buffer."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef module = {
+    PyModuleDef_HEAD_INIT, "_ailib", "Low-overhead binding for the 2048 engine library.", -1, methods, NULL, NULL, NULL, NULL
+};
+
+PyMODINIT_FUNC PyInit__ailib(void) {
+    return PyModule_Create(&module);
+}
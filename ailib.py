@@ -1,47 +1,471 @@
+import array
 import ctypes
+import importlib.machinery
+import importlib.util
 import os
+import random
+import subprocess
+import sys
 
-for suffix in ['so', 'dll', 'dylib']:
-    dllfn = 'bin/2048.' + suffix
-    if not os.path.isfile(dllfn):
-        continue
-    ailib = ctypes.CDLL(dllfn)
-    break
-else:
+# CPU-specific builds of the engine (see Makefile.in), best first: variant name, library name
+# under bin/, the CPU features it needs, and the (vendor, family) of CPUs that have those features
+# but run them slowly. AMD Zen 1 and 2 (family 0x17, and Hygon's 0x18) microcode pext and pdep.
+VARIANTS = [
+    ('bmi2', '2048-bmi2', ('bmi2', 'popcnt'), (('AuthenticAMD', 0x17), ('HygonGenuine', 0x18))),
+    ('baseline', '2048', (), ()),
+]
+
+# Environment variable naming the variant to load, overriding the automatic choice
+VARIANT_ENV = 'AILIB_VARIANT'
+
+def _read_cpuinfo():
+    ''' The first value of each field of /proc/cpuinfo, or an empty dict if it can't be read. '''
+    fields = {}
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                key, sep, value = line.partition(':')
+                if sep:
+                    fields.setdefault(key.strip(), value.strip())
+    except (IOError, OSError):
+        pass
+    return fields
+
+def cpu_model():
+    ''' (vendor, family) of the host CPU, e.g. ('GenuineIntel', 6), or None if unknown. '''
+    fields = _read_cpuinfo()
+    try:
+        return fields['vendor_id'], int(fields['cpu family'])
+    except (KeyError, ValueError):
+        return None
+
+def cpu_features():
+    ''' Lowercase feature flags of the host CPU, or an empty set if they can't be found out. '''
+    flags = _read_cpuinfo().get('flags')
+    if flags is not None:
+        return set(flags.split())
+    if sys.platform == 'darwin':
+        try:
+            out = subprocess.check_output(['sysctl', '-n', 'machdep.cpu.features', 'machdep.cpu.leaf7_features'], stderr=subprocess.DEVNULL)
+            return set(out.decode().lower().split())
+        except (subprocess.CalledProcessError, OSError):
+            pass
+    return set()
+
+def find_library(name):
+    ''' Path of the library bin/<name> for this platform, or None if it isn't built. '''
+    for suffix in ['so', 'dll', 'dylib']:
+        dllfn = 'bin/%s.%s' % (name, suffix)
+        if os.path.isfile(dllfn):
+            return dllfn
+    return None
+
+def available_variants():
+    ''' (variant, library path) of every built variant the host CPU can run, best first. '''
+    features = cpu_features()
+    variants = []
+    for variant, name, required, _ in VARIANTS:
+        dllfn = find_library(name)
+        if dllfn is not None and features.issuperset(required):
+            variants.append((variant, dllfn))
+    return variants
+
+def select_variant(variants):
+    ''' The (variant, library path) to load out of available_variants().
+
+    That is the variant named by $AILIB_VARIANT if set, else the best one whose instructions aren't
+    slow on the host CPU. '''
+    forced = os.environ.get(VARIANT_ENV)
+    if forced:
+        for v in variants:
+            if v[0] == forced:
+                return v
+        print("%s=%s: no such variant for this CPU (available: %s); choosing automatically"
+              % (VARIANT_ENV, forced, ', '.join(v[0] for v in variants)), file=sys.stderr)
+    model = cpu_model()
+    slow = {variant: slow_on for variant, _, _, slow_on in VARIANTS}
+    for v in variants:
+        if model not in slow[v[0]]:
+            return v
+    return variants[-1]
+
+class SearchProgressInfo(ctypes.Structure):
+    ''' Snapshot of a search's progress (search_progress_info_t). '''
+    _fields_ = [('depth', ctypes.c_int), ('best_move', ctypes.c_int), ('scores', ctypes.c_float * 4),
+                ('nodes', ctypes.c_uint64), ('done', ctypes.c_int), ('version', ctypes.c_uint)]
+
+def load_library(dllfn):
+    ''' Load an engine library, initialize its tables and declare its functions. '''
+    lib = ctypes.CDLL(dllfn)
+    lib.init_tables()
+
+    lib.find_best_move.argtypes = [ctypes.c_uint64]
+    lib.score_toplevel_move.argtypes = [ctypes.c_uint64, ctypes.c_int]
+    lib.score_toplevel_move.restype = ctypes.c_float
+    lib.score_toplevel_move_depth.argtypes = [ctypes.c_uint64, ctypes.c_int, ctypes.c_int]
+    lib.score_toplevel_move_depth.restype = ctypes.c_float
+    lib.score_toplevel_move_token.argtypes = [ctypes.c_uint64, ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+    lib.score_toplevel_move_token.restype = ctypes.c_float
+    lib.score_toplevel_move_candidates.argtypes = [ctypes.c_uint64, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_float, ctypes.c_void_p]
+    lib.score_toplevel_move_candidates.restype = ctypes.c_float
+    lib.endgame_candidates.argtypes = [ctypes.c_uint64, ctypes.POINTER(ctypes.c_float)]
+    lib.default_search_depth.argtypes = [ctypes.c_uint64]
+    lib.survival_probability.argtypes = [ctypes.c_uint64, ctypes.c_int, ctypes.c_int]
+    lib.survival_probability.restype = ctypes.c_float
+    lib.score_toplevel_moves.argtypes = [ctypes.c_uint64, ctypes.POINTER(ctypes.c_float), ctypes.POINTER(ctypes.c_uint64), ctypes.c_void_p]
+    lib.score_toplevel_moves_pruned.argtypes = [ctypes.c_uint64, ctypes.POINTER(ctypes.c_float), ctypes.POINTER(ctypes.c_uint64), ctypes.c_void_p]
+    lib.score_toplevel_moves_batched.argtypes = [ctypes.c_uint64, ctypes.POINTER(ctypes.c_float), ctypes.POINTER(ctypes.c_uint64), ctypes.c_int, ctypes.c_void_p]
+    lib.search_token_new.restype = ctypes.c_void_p
+    lib.search_token_free.argtypes = [ctypes.c_void_p]
+    lib.search_token_free.restype = None
+    lib.search_token_cancel.argtypes = [ctypes.c_void_p]
+    lib.search_token_cancel.restype = None
+    lib.search_token_set_deadline.argtypes = [ctypes.c_void_p, ctypes.c_double]
+    lib.search_token_set_deadline.restype = None
+    lib.search_token_stopped.argtypes = [ctypes.c_void_p]
+    lib.search_progress_new.restype = ctypes.c_void_p
+    lib.search_progress_free.argtypes = [ctypes.c_void_p]
+    lib.search_progress_free.restype = None
+    lib.search_progress_read.argtypes = [ctypes.c_void_p, ctypes.POINTER(SearchProgressInfo)]
+    lib.search_progress_read.restype = None
+    lib.score_toplevel_moves_deepening.argtypes = [ctypes.c_uint64, ctypes.POINTER(ctypes.c_float), ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+    lib.evaluate_boards.argtypes = [ctypes.POINTER(ctypes.c_uint64), ctypes.POINTER(ctypes.c_float), ctypes.c_int]
+    lib.evaluate_boards.restype = None
+    lib.engine_variant.restype = ctypes.c_char_p
+    lib.load_ntuple_weights.argtypes = [ctypes.c_char_p]
+    lib.set_evaluator.argtypes = [ctypes.c_int]
+    lib.execute_move.argtypes = [ctypes.c_int, ctypes.c_uint64]
+    lib.execute_move.restype = ctypes.c_uint64
+
+    lib.game_rng_new.argtypes = [ctypes.c_uint64]
+    lib.game_rng_new.restype = ctypes.c_void_p
+    lib.game_rng_free.argtypes = [ctypes.c_void_p]
+    lib.game_rng_free.restype = None
+    lib.game_new.argtypes = [ctypes.c_void_p]
+    lib.game_new.restype = ctypes.c_uint64
+    lib.game_spawn.argtypes = [ctypes.c_void_p, ctypes.c_uint64]
+    lib.game_spawn.restype = ctypes.c_uint64
+    lib.game_move.argtypes = [ctypes.c_uint64, ctypes.c_int, ctypes.POINTER(ctypes.c_int)]
+    lib.game_move.restype = ctypes.c_uint64
+    lib.game_step.argtypes = [ctypes.c_void_p, ctypes.c_uint64, ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+    lib.game_step.restype = ctypes.c_uint64
+    lib.game_legal_moves.argtypes = [ctypes.c_uint64]
+    lib.selfplay.argtypes = [ctypes.c_uint64, ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+    lib.selfplay.restype = None
+    return lib
+
+_variants = available_variants()
+if not _variants:
     print("Couldn't find 2048 library bin/2048.{so,dll,dylib}! Make sure to build it first.")
     exit()
+variant, _dllfn = select_variant(_variants)
+ailib = load_library(_dllfn)
+
+# Engine functions called through the compiled binding, when it is built
+_EXTENSION_FUNCTIONS = ('score_toplevel_move_candidates', 'score_toplevel_moves', 'score_toplevel_moves_pruned',
+                        'score_toplevel_moves_batched', 'evaluate_boards', 'execute_move')
+
+def load_extension(lib):
+    ''' Load the compiled binding bin/_ailib (see `make ext`) and bind it to the engine library lib.
+
+    Returns None if it isn't built for this Python. '''
+    for suffix in importlib.machinery.EXTENSION_SUFFIXES:
+        path = 'bin/_ailib' + suffix
+        if not os.path.isfile(path):
+            continue
+        spec = importlib.util.spec_from_file_location('_ailib', path)
+        ext = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(ext)
+        ext.bind(**{name: ctypes.cast(getattr(lib, name), ctypes.c_void_p).value for name in _EXTENSION_FUNCTIONS})
+        return ext
+    return None
+
+_ext = load_extension(ailib)
+# How the functions below call the engine: 'extension' or 'ctypes'
+binding = 'ctypes' if _ext is None else 'extension'
+
+class GameSimulator(object):
+    ''' Native game core: moves, scoring and tile spawning on packed boards.
+
+    Each simulator has its own RNG, seeded from `seed` (or randomly if None), so games
+    are reproducible and independent of each other. '''
+
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = random.getrandbits(64)
+        self._rng = ailib.game_rng_new(seed)
+        self._score_delta = ctypes.c_int()
+        self._done = ctypes.c_int()
+
+    def __del__(self):
+        if getattr(self, '_rng', None):
+            ailib.game_rng_free(self._rng)
+            self._rng = None
+
+    def new_game(self):
+        ''' Return a fresh board with two random tiles. '''
+        return ailib.game_new(self._rng)
+
+    def spawn(self, board):
+        ''' Add a random tile (2 with p=0.9, else 4) to an empty cell. '''
+        return ailib.game_spawn(self._rng, board)
+
+    def step(self, board, move):
+        ''' Play a move and spawn a tile. Returns (new board, score delta, game over?).
+
+        An illegal move leaves the board unchanged. '''
+        board = ailib.game_step(self._rng, board, move, ctypes.byref(self._score_delta), ctypes.byref(self._done))
+        return board, self._score_delta.value, bool(self._done.value)
+
+    @staticmethod
+    def move(board, move):
+        ''' Play a move without spawning a tile. Returns (new board, score delta). '''
+        score_delta = ctypes.c_int()
+        board = ailib.game_move(board, move, ctypes.byref(score_delta))
+        return board, score_delta.value
+
+    @staticmethod
+    def legal_moves(board):
+        ''' Bitmask of the moves that change the board (bit 0 = up, ..., bit 3 = right). '''
+        return ailib.game_legal_moves(board)
+
+def selfplay(seed, ngames, nthreads=0):
+    ''' Play ngames complete games with the AI in native threads (0 = one per core).
+
+    Returns a list of (score, max rank, number of moves) per game. Game i depends only on
+    (seed, i), so results are reproducible for any thread count. '''
+    scores = (ctypes.c_int * ngames)()
+    maxranks = (ctypes.c_int * ngames)()
+    moves = (ctypes.c_int * ngames)()
+    ailib.selfplay(seed, ngames, nthreads, scores, maxranks, moves)
+    return list(zip(scores, maxranks, moves))
+
+# Returned by searches stopped through their SearchToken
+SEARCH_CANCELLED = -2
+
+class SearchCancelled(Exception):
+    ''' A search was stopped by its SearchToken. '''
+
+class SearchToken(object):
+    ''' Lets other threads stop native searches in progress.
+
+    Pass the token to the search functions below; once cancel() is called, or the deadline (in
+    seconds from now) passes, they stop within a few thousand nodes and raise SearchCancelled.
+    A token stays cancelled, so use a new one for each search. '''
+
+    def __init__(self, timeout=None):
+        self._token = ailib.search_token_new()
+        if timeout is not None:
+            self.set_deadline(timeout)
 
-ailib.init_tables()
+    def __del__(self):
+        if getattr(self, '_token', None) and ailib is not None:
+            ailib.search_token_free(self._token)
+            self._token = None
 
-ailib.find_best_move.argtypes = [ctypes.c_uint64]
-ailib.score_toplevel_move.argtypes = [ctypes.c_uint64, ctypes.c_int]
-ailib.score_toplevel_move.restype = ctypes.c_float
-ailib.execute_move.argtypes = [ctypes.c_int, ctypes.c_uint64]
-ailib.execute_move.restype = ctypes.c_uint64
+    @property
+    def _as_parameter_(self):
+        return self._token
+
+    def cancel(self):
+        ailib.search_token_cancel(self._token)
+
+    def set_deadline(self, seconds):
+        ''' Stop searches seconds from now (None: no deadline). '''
+        ailib.search_token_set_deadline(self._token, -1.0 if seconds is None else max(seconds, 0.0))
+
+    @property
+    def cancelled(self):
+        ''' True once the token is cancelled or past its deadline. '''
+        return bool(ailib.search_token_stopped(self._token))
+
+def _token_address(token):
+    return token._token if token is not None else 0
+
+def endgame_candidates(board):
+    ''' The moves of board worth searching, as (bit mask, survival probabilities of the four moves).
+
+    Pass the result to score_move when scoring several moves of one board, so that its endgame is
+    solved only once. '''
+    survival = (ctypes.c_float * 4)()
+    return ailib.endgame_candidates(board, survival), list(survival)
+
+def score_move(board, move, depth=0, token=None, candidates=None):
+    ''' Score one move of board (0: illegal), searching depth moves deep (0: the engine's default).
+
+    candidates: endgame_candidates(board), or None to compute it. '''
+    mask, survival = candidates if candidates is not None else (-1, [0.0] * 4)
+    if _ext is not None:
+        score = _ext.score_toplevel_move(board, move, depth, _token_address(token), mask, survival[move])
+    else:
+        score = ailib.score_toplevel_move_candidates(board, move, depth, mask, survival[move], token)
+    if score == SEARCH_CANCELLED:
+        raise SearchCancelled()
+    return score
+
+def score_moves_pruned(board, token=None):
+    ''' Score the four moves of board with the pruned (Star1) search.
+
+    Approximate: the best move usually matches score_move's, but may differ on near-ties. Its score
+    is exact; other moves may be scored with an upper bound below it. '''
+    if _ext is not None:
+        scores = _ext.score_toplevel_moves_pruned(board, _token_address(token))
+    else:
+        scores = (ctypes.c_float * 4)()
+        if ailib.score_toplevel_moves_pruned(board, scores, None, token) == SEARCH_CANCELLED:
+            scores = None
+    if scores is None:
+        raise SearchCancelled()
+    return list(scores)
+
+def score_moves_batched(board, nthreads=0, token=None):
+    ''' Score the four moves of board with the level-synchronous batched search. '''
+    if _ext is not None:
+        scores = _ext.score_toplevel_moves_batched(board, nthreads, _token_address(token))
+    else:
+        scores = (ctypes.c_float * 4)()
+        if ailib.score_toplevel_moves_batched(board, scores, None, nthreads, token) == SEARCH_CANCELLED:
+            scores = None
+    if scores is None:
+        raise SearchCancelled()
+    return list(scores)
+
+class SearchProgress(object):
+    ''' Progress of a score_moves_deepening search, which other threads can poll with read(). '''
+
+    def __init__(self):
+        self._progress = ailib.search_progress_new()
+        self._info = SearchProgressInfo()
+
+    def __del__(self):
+        if getattr(self, '_progress', None) and ailib is not None:
+            ailib.search_progress_free(self._progress)
+            self._progress = None
+
+    @property
+    def _as_parameter_(self):
+        return self._progress
+
+    def read(self):
+        ''' Return a dict: depth (deepest completed iteration, 0: none yet), best_move (-1: none),
+        scores (at that depth), nodes (searched so far), done, and version (changes with depth or done). '''
+        info = self._info
+        ailib.search_progress_read(self._progress, ctypes.byref(info))
+        return {"depth": info.depth, "best_move": info.best_move, "scores": list(info.scores),
+                "nodes": info.nodes, "done": bool(info.done), "version": info.version}
+
+def score_moves_deepening(board, maxdepth=0, progress=None, token=None):
+    ''' Score the four moves of board by iterative deepening, up to maxdepth (0: the engine's default).
+
+    Each completed depth is published to progress (a SearchProgress). If token stops the search, the
+    scores of the deepest completed depth are returned; SearchCancelled is raised if there is none. '''
+    scores = (ctypes.c_float * 4)()
+    if ailib.score_toplevel_moves_deepening(board, scores, maxdepth, progress, token) == SEARCH_CANCELLED:
+        raise SearchCancelled()
+    return list(scores)
+
+def _c_boards(boards):
+    ''' Copy a buffer of uint64 board_t into a ctypes array. '''
+    data = memoryview(boards).cast('B')
+    return (ctypes.c_uint64 * (len(data) // 8)).from_buffer_copy(data)
+
+def score_boards(boards, scores=None):
+    ''' Search the four moves of every board in a buffer of uint64 board_t (e.g. a NumPy array).
+
+    The scores go to a writable float32 buffer holding 4 per board (allocated if None), which is
+    returned. With the compiled binding, this is a single call that releases the GIL. '''
+    nboards = len(memoryview(boards).cast('B')) // 8
+    if scores is None:
+        scores = array.array('f', bytes(16 * nboards))
+    if _ext is not None:
+        _ext.score_boards(boards, scores)
+    else:
+        for i, board in enumerate(_c_boards(boards)):
+            ailib.score_toplevel_moves(board, (ctypes.c_float * 4).from_buffer(scores, 16 * i), None, None)
+    return scores
+
+def evaluate_boards(boards, values=None):
+    ''' Evaluate every board in a buffer of uint64 board_t with the current leaf evaluator.
+
+    The values go to a writable float32 buffer (allocated if None), which is returned. '''
+    nboards = len(memoryview(boards).cast('B')) // 8
+    if values is None:
+        values = array.array('f', bytes(4 * nboards))
+    if _ext is not None:
+        _ext.evaluate_boards(boards, values)
+    else:
+        ailib.evaluate_boards(_c_boards(boards), (ctypes.c_float * nboards).from_buffer(values), nboards)
+    return values
+
+# Leaf evaluators for ailib.set_evaluator
+EVALUATOR_HEURISTIC = 0
+EVALUATOR_NTUPLE = 1
+
+def use_ntuple_weights(path):
+    ''' Load n-tuple network weights (see ntuple_train.py) and evaluate leaves with them from now on. '''
+    if ailib.load_ntuple_weights(os.fsencode(path)) < 0:
+        raise ValueError("%s is not a valid n-tuple weight file" % path)
+    ailib.set_evaluator(EVALUATOR_NTUPLE)
+
+# Tile values indexed by rank (0 = empty), and the inverse mapping.
+TILE_VALUES = [0] + [1 << rank for rank in range(1, 16)]
+RANK_OF = {value: rank for rank, value in enumerate(TILE_VALUES)}
+
+# Each byte of a board_t holds two cells; these map a byte to its (low, high) cells.
+_BYTE_RANKS = [(b & 0xf, b >> 4) for b in range(256)]
+_BYTE_VALUES = [(TILE_VALUES[b & 0xf], TILE_VALUES[b >> 4]) for b in range(256)]
 
 def to_c_board(m):
-    board = 0
-    i = 0
-    for row in m:
-        for c in row:
-            board |= int(c) << (4*i)
-            i += 1
-    return board
+    ''' Pack a 4x4 matrix of ranks into a board_t. '''
+    (c0, c1, c2, c3), (c4, c5, c6, c7), (c8, c9, c10, c11), (c12, c13, c14, c15) = m
+    return int.from_bytes(bytes((c0 | c1 << 4, c2 | c3 << 4, c4 | c5 << 4, c6 | c7 << 4,
+                                 c8 | c9 << 4, c10 | c11 << 4, c12 | c13 << 4, c14 | c15 << 4)), 'little')
 
 def from_c_board(n):
-    board = []
-    i = 0
-    for ri in range(4):
-        row = []
-        for ci in range(4):
-            row.append((n >> (4 * i)) & 0xf)
-            i += 1
-        board.append(row)
-    return board
+    ''' Unpack a board_t into a 4x4 matrix of ranks. '''
+    b0, b1, b2, b3, b4, b5, b6, b7 = n.to_bytes(8, 'little')
+    t = _BYTE_RANKS
+    return [[*t[b0], *t[b1]], [*t[b2], *t[b3]], [*t[b4], *t[b5]], [*t[b6], *t[b7]]]
+
+def to_c_board_values(m):
+    ''' Pack a 4x4 matrix of tile values (0, 2, 4, ...) into a board_t. '''
+    r = RANK_OF
+    return to_c_board([[r[c] for c in row] for row in m])
+
+def from_c_board_values(n):
+    ''' Unpack a board_t into a 4x4 matrix of tile values. '''
+    b0, b1, b2, b3, b4, b5, b6, b7 = n.to_bytes(8, 'little')
+    t = _BYTE_VALUES
+    return [[*t[b0], *t[b1]], [*t[b2], *t[b3]], [*t[b4], *t[b5]], [*t[b6], *t[b7]]]
 
 def to_c_index(n):
-    return [0, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768].index(n)
+    try:
+        return RANK_OF[n]
+    except KeyError:
+        raise ValueError("%r is not a valid tile value" % (n,))
 
 def from_c_index(c):
-    if c == 0: return 0
-    return 2**c
+    return TILE_VALUES[c]
+
+# NumPy batch variants, for converting many boards at once.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+else:
+    _NIBBLE_SHIFTS = np.arange(0, 64, 4, dtype=np.uint64)
+
+def to_c_boards(ranks):
+    ''' Pack an array of rank matrices, shape (N, 4, 4) or (N, 16), into a uint64 array of board_t. '''
+    r = np.asarray(ranks, dtype=np.uint64).reshape(-1, 16)
+    return np.bitwise_or.reduce(r << _NIBBLE_SHIFTS, axis=1)
+
+def from_c_boards(boards):
+    ''' Unpack an array of board_t into a uint8 array of rank matrices with shape (N, 4, 4). '''
+    b = np.asarray(boards, dtype=np.uint64).reshape(-1, 1)
+    return ((b >> _NIBBLE_SHIFTS) & np.uint64(0xf)).astype(np.uint8).reshape(-1, 4, 4)
+
+def values_to_ranks(values):
+    ''' Convert an array of tile values (powers of two, or 0) to ranks. '''
+    v = np.asarray(values)
+    return np.where(v > 0, np.frexp(np.maximum(v, 1))[1] - 1, 0).astype(np.uint8)
@@ -0,0 +1,137 @@
+''' Run the move searcher over a stream of positions: `2048.py analyze [options] [file]`.
+
+Each input line is a board, either a hex board_t (optionally prefixed with 0x) or 16 tile values
+(0, 2, 4, ...) in row-major order, separated by spaces or commas. Blank lines and lines starting
+with # are skipped.
+
+For every board, one tab-separated line is written, in input order:
+
+    board (hex)  best move  depth  score up  score down  score left  score right
+
+Boards are searched in parallel, with a bounded number in flight, so memory use does not depend
+on the size of the input.
+'''
+
+from __future__ import print_function
+
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from ailib import ailib, score_move, endgame_candidates, RANK_OF, SearchToken, SearchCancelled
+
+MOVE_NAMES = ['up', 'down', 'left', 'right']
+
+# Deepest search allowed when deepening under a time budget
+MAX_DEPTH = 15
+
+def parse_board(line):
+    ''' Parse one input line into a board_t. Raises ValueError if the line is malformed. '''
+    fields = line.replace(',', ' ').split()
+    if len(fields) == 1:
+        board = int(fields[0], 16)
+        if not 0 <= board < 1 << 64:
+            raise ValueError("board_t out of range: %s" % fields[0])
+        return board
+    if len(fields) != 16:
+        raise ValueError("expected a hex board_t or 16 tile values, got %d fields" % len(fields))
+    board = 0
+    for i, field in enumerate(fields):
+        rank = RANK_OF.get(int(field))
+        if rank is None:
+            raise ValueError("%s is not a valid tile value" % field)
+        board |= rank << (4 * i)
+    return board
+
+def score_at_depth(board, depth, token=None):
+    candidates = endgame_candidates(board)
+    return [score_move(board, move, depth, token, candidates) for move in range(4)]
+
+def analyze_board(board, depth=0, budget=None):
+    ''' Score the four moves of board. Returns (depth searched, scores).
+
+    Without a budget, search to depth (0: the engine's default depth for this board). With a budget
+    in seconds, deepen one move at a time from depth 1, up to depth (or MAX_DEPTH), and stop once
+    the next iteration is not expected to finish in time. An iteration that overruns the budget
+    anyway is cancelled, and the scores of the previous one are returned. '''
+    if budget is None:
+        return depth or ailib.default_search_depth(board), score_at_depth(board, depth)
+
+    maxdepth = depth or MAX_DEPTH
+    deadline = time.time() + budget
+    d = 0
+    prev = None
+    while d < maxdepth:
+        start = time.time()
+        if d == 0:
+            scores = score_at_depth(board, 1)
+        else:
+            try:
+                scores = score_at_depth(board, d + 1, SearchToken(deadline - start))
+            except SearchCancelled:
+                break
+        d += 1
+        if max(scores) == 0:
+            break
+        # Each iteration costs at least as much as the previous one, usually several times more
+        elapsed = time.time() - start
+        growth = max(elapsed / prev, 1.0) if prev else 4.0
+        prev = max(elapsed, 1e-6)
+        if time.time() + elapsed * growth > deadline:
+            break
+    return d, scores
+
+def format_result(board, depth, scores):
+    bestmove = max(range(4), key=lambda m: scores[m])
+    name = MOVE_NAMES[bestmove] if scores[bestmove] > 0 else 'none'
+    return '%016x\t%s\t%d\t%s' % (board, name, depth, '\t'.join('%.1f' % s for s in scores))
+
+def read_boards(lines, errors):
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            yield parse_board(line)
+        except ValueError as e:
+            print("line %d: %s" % (lineno, e), file=errors)
+
+def analyze_stream(lines, out, jobs=4, depth=0, budget=None, errors=sys.stderr):
+    ''' Analyze every board in lines, writing results to out in input order. Returns the number of boards. '''
+    window = deque()
+    count = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for board in read_boards(lines, errors):
+            if len(window) >= 2 * jobs:
+                b, future = window.popleft()
+                out.write(format_result(b, *future.result()) + '\n')
+            window.append((board, executor.submit(analyze_board, board, depth, budget)))
+            count += 1
+        while window:
+            b, future = window.popleft()
+            out.write(format_result(b, *future.result()) + '\n')
+    return count
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='2048.py analyze', description="Find the best move for each board in a file of positions")
+    parser.add_argument('input', help="File with one board per line (default: stdin)", nargs='?')
+    parser.add_argument('-o', '--output', help="Write results to this file (default: stdout)")
+    parser.add_argument('-j', '--jobs', help="Number of boards searched in parallel (default: 4)", type=int, default=4)
+    parser.add_argument('-d', '--depth', help="Search depth in moves (default: the engine's depth for each board; with --time, the maximum depth)", type=int, default=0)
+    parser.add_argument('-t', '--time', help="Time budget per board in seconds, searched by iterative deepening", type=float)
+    args = parser.parse_args(argv)
+
+    fin = open(args.input) if args.input else sys.stdin
+    fout = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        start = time.time()
+        count = analyze_stream(fin, fout, max(args.jobs, 1), args.depth, args.time)
+        print("Analyzed %d boards in %.1f seconds" % (count, time.time() - start), file=sys.stderr)
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+        if fout is not sys.stdout:
+            fout.close()
+    return 0
@@ -0,0 +1,84 @@
+''' Benchmark the CPU-specific builds of the engine: `2048.py bench [options]`.
+
+Every build of the library that the host CPU can run (see ailib.VARIANTS) is timed on the same
+positions, taken from random play:
+
+    eval     leaf evaluation, as done at the leaves of the search (ns per board)
+    search   a full search of all four moves (ms per position)
+
+Speedups are relative to the baseline build. The leaf values of every build are also checked
+against the baseline, since they must be identical.
+'''
+
+from __future__ import print_function
+
+import ctypes
+import random
+import time
+
+from ailib import GameSimulator, available_variants, select_variant, load_library, VARIANT_ENV
+
+def random_positions(n, seed=None):
+    ''' n boards from games played with uniformly random legal moves. '''
+    sim = GameSimulator(seed)
+    rnd = random.Random(seed)
+    boards = []
+    board = sim.new_game()
+    while len(boards) < n:
+        legal = sim.legal_moves(board)
+        moves = [m for m in range(4) if legal & (1 << m)]
+        board, _, done = sim.step(board, rnd.choice(moves))
+        boards.append(board)
+        if done:
+            board = sim.new_game()
+    return boards
+
+def time_eval(lib, boards, values, reps):
+    ''' Seconds per leaf evaluation. '''
+    start = time.perf_counter()
+    for _ in range(reps):
+        lib.evaluate_boards(boards, values, len(boards))
+    return (time.perf_counter() - start) / (reps * len(boards))
+
+def time_search(lib, positions):
+    ''' Seconds per search of all four moves. '''
+    scores = (ctypes.c_float * 4)()
+    start = time.perf_counter()
+    for board in positions:
+        lib.score_toplevel_moves(board, scores, None, None)
+    return (time.perf_counter() - start) / len(positions)
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='2048.py bench', description="Compare the CPU-specific builds of the engine on this host")
+    parser.add_argument('-n', '--boards', help="Number of boards for leaf evaluation (default: 100000)", type=int, default=100000)
+    parser.add_argument('-r', '--reps', help="Passes over the boards for leaf evaluation (default: 20)", type=int, default=20)
+    parser.add_argument('-p', '--positions', help="Number of positions to search (default: 40)", type=int, default=40)
+    parser.add_argument('-s', '--seed', help="Seed for the random positions (default: 1)", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    variants = available_variants()
+    boards = random_positions(args.boards, args.seed)
+    positions = boards[::max(len(boards) // args.positions, 1)][:args.positions]
+    c_boards = (ctypes.c_uint64 * len(boards))(*boards)
+    print("%d builds, %d boards, %d positions" % (len(variants), len(boards), len(positions)))
+
+    results = []
+    reference = None
+    for variant, dllfn in variants:
+        lib = load_library(dllfn)
+        values = (ctypes.c_float * len(boards))()
+        lib.evaluate_boards(c_boards, values, len(boards))
+        if reference is None:
+            reference = list(values)
+        elif list(values) != reference:
+            print("warning: %s leaf values differ from %s" % (variant, variants[0][0]))
+        results.append((variant, time_eval(lib, c_boards, values, args.reps), time_search(lib, positions)))
+
+    base = [r for r in results if r[0] == 'baseline']
+    base_eval, base_search = base[0][1:] if base else results[-1][1:]
+    print('%-10s %12s %8s %12s %8s' % ('build', 'eval ns', 'speedup', 'search ms', 'speedup'))
+    for variant, t_eval, t_search in results:
+        print('%-10s %12.2f %7.2fx %12.2f %7.2fx' % (variant, t_eval * 1e9, base_eval / t_eval, t_search * 1e3, base_search / t_search))
+    print("The AI loads the %s build (set %s to override)" % (select_variant(variants)[0], VARIANT_ENV))
+    return 0
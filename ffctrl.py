@@ -34,12 +34,30 @@ class FirefoxDebuggerControl(object):
     and the browser to be started with "--no-remote --start-debugger-server <port>"
     '''
 
+    # Initial size of the receive buffer; grown on demand for larger packets.
+    RECV_BUFSIZE = 65536
+
     def __init__(self, port):
         self.sock = socket.socket()
         self.sock.connect(('localhost', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # Receive buffer: bytes in self.rbuf[self.rstart:self.rend] are unconsumed.
+        self.rbuf = bytearray(self.RECV_BUFSIZE)
+        self.rstart = 0
+        self.rend = 0
 
-        # info = self._recv_msg()
         self.actors = {}
+        self.actors_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+
+        # evaluateJSAsync results, keyed by resultID
+        self.eval_results = {}
+        self.eval_cond = threading.Condition()
+        self.closed = False
+
+        # The server greets us with a packet from the root actor
+        self.info = self._recv_msg()
 
         self.thread = threading.Thread(target=self._receive_thread)
         self.thread.daemon = True
@@ -74,34 +92,66 @@ class FirefoxDebuggerControl(object):
         self.page = page
         self._send_recv(page['actor'], 'attach')
 
+    def _actor_queue(self, actor):
+        with self.actors_lock:
+            queue = self.actors.get(actor)
+            if queue is None:
+                queue = self.actors[actor] = Queue()
+            return queue
+
     def _actor_msgs(self, actor):
+        queue = self._actor_queue(actor)
         while True:
-            yield self.actors[actor].get()
+            yield queue.get()
+
+    def _fill(self):
+        ''' Read more data from the socket into the receive buffer. '''
+        if self.rstart == self.rend:
+            self.rstart = self.rend = 0
+        elif self.rend == len(self.rbuf):
+            if self.rstart > 0:
+                # Compact: move the unconsumed tail to the front of the buffer
+                n = self.rend - self.rstart
+                self.rbuf[:n] = self.rbuf[self.rstart:self.rend]
+                self.rstart, self.rend = 0, n
+            else:
+                self.rbuf.extend(bytes(len(self.rbuf)))
+        n = self.sock.recv_into(memoryview(self.rbuf)[self.rend:])
+        if not n:
+            raise EOFError()
+        self.rend += n
 
     def _recv_msg(self):
-        msgsz = b''
-        for i in range(10):
-            c = self.sock.recv(1)
-            if not c:
-                raise EOFError()
-            if c == b':':
+        # Length prefix: up to 10 decimal digits followed by ':'
+        while True:
+            colon = self.rbuf.find(b':', self.rstart, self.rend)
+            if colon >= 0:
                 break
-            msgsz += c
+            if self.rend - self.rstart > 10:
+                raise ValueError("invalid length field: %s" % bytes(self.rbuf[self.rstart:self.rend]))
+            self._fill()
+
+        msgsz = bytes(self.rbuf[self.rstart:colon])
         if not msgsz.isdigit():
             raise ValueError("invalid length field: %s" % msgsz)
-
         msgsz = int(msgsz)
-        msg = bytearray()
-        while len(msg) < msgsz:
-            chunk = self.sock.recv(msgsz - len(msg))
-            if not chunk:
-                raise EOFError()
-            msg += chunk
-        return json.loads(bytes(msg))
+        self.rstart = colon + 1
+
+        if self.rstart + msgsz > len(self.rbuf):
+            # Make room for the whole packet
+            n = self.rend - self.rstart
+            newbuf = bytearray(max(len(self.rbuf), msgsz))
+            newbuf[:n] = self.rbuf[self.rstart:self.rend]
+            self.rbuf, self.rstart, self.rend = newbuf, 0, n
+        while self.rend - self.rstart < msgsz:
+            self._fill()
+
+        msg = json.loads(self.rbuf[self.rstart:self.rstart + msgsz])
+        self.rstart += msgsz
+        return msg
 
     def _send_msg(self, actor, msgtype, obj=None):
-        if actor not in self.actors:
-            self.actors[actor] = Queue()
+        self._actor_queue(actor)
         if obj is None:
             obj = {}
         else:
@@ -109,8 +159,8 @@ class FirefoxDebuggerControl(object):
         obj['to'] = actor
         obj['type'] = msgtype
         msg = json.dumps(obj).encode()
-        self.sock.send(str(len(msg)).encode() + b':')
-        self.sock.send(msg)
+        with self.send_lock:
+            self.sock.sendall(b'%d:%s' % (len(msg), msg))
 
     def _send_recv(self, actor, msgtype, obj=None):
         self._send_msg(actor, msgtype, obj)
@@ -124,15 +174,34 @@ class FirefoxDebuggerControl(object):
         while 1:
             try:
                 msg = self._recv_msg()
-                self.actors[msg['from']].put(msg)
             except Exception as e:
                 print("disconnect: %s" % e)
+                with self.eval_cond:
+                    self.closed = True
+                    self.eval_cond.notify_all()
                 break
 
+            if msg.get('type') == 'evaluationResult':
+                # Asynchronous evaluation result; route to the waiting execute() call
+                with self.eval_cond:
+                    self.eval_results[msg['resultID']] = msg
+                    self.eval_cond.notify_all()
+            elif 'from' in msg:
+                self._actor_queue(msg['from']).put(msg)
+
     def execute(self, cmd):
-        # resp = self._send_recv(self.page['consoleActor'], 'evaluateJSAsync', {'text': cmd})
-        # resultID = resp['resultID']
-        for result in self._actor_msgs(self.page['consoleActor']):
-            if result['hasException']:
-                raise Exception(result['exceptionMessage'])
-            return result['result']
+        resp = self._send_recv(self.page['consoleActor'], 'evaluateJSAsync', {'text': cmd})
+        resultID = resp['resultID']
+        with self.eval_cond:
+            self.eval_cond.wait_for(lambda: resultID in self.eval_results or self.closed)
+            if resultID not in self.eval_results:
+                raise EOFError("connection closed while waiting for evaluation result")
+            result = self.eval_results.pop(resultID)
+
+        if result.get('hasException') or result.get('exception') is not None:
+            raise Exception(result.get('exceptionMessage', result.get('exception')))
+        result = result.get('result')
+        if isinstance(result, dict) and result.get('type') in ('undefined', 'null'):
+            # Grip for a value without a JSON representation
+            return None
+        return result
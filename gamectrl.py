@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
-import math
 import re
 import time
 import json
 
+from ailib import to_c_index
+
 class Generic2048Control(object):
+    # latency.MoveProfiler charged with the time of each command round trip, if any
+    profiler = None
+
     def __init__(self, ctrl):
         self.ctrl = ctrl
         self.setup()
@@ -13,7 +17,10 @@ class Generic2048Control(object):
         raise NotImplementedError()
 
     def execute(self, cmd):
-        return self.ctrl.execute(cmd)
+        if self.profiler is None:
+            return self.ctrl.execute(cmd)
+        with self.profiler.timed_roundtrip():
+            return self.ctrl.execute(cmd)
 
     def get_status(self):
         ''' Check if the game is in an unusual state. '''
@@ -95,7 +102,7 @@ class Fast2048Control(Generic2048Control):
                     continue
                 pos = cell['x'], cell['y']
                 tval = cell['value']
-                board[pos[1]][pos[0]] = int(round(math.log(tval, 2)))
+                board[pos[1]][pos[0]] = to_c_index(tval)
 
         return board
 
@@ -157,7 +164,7 @@ class Keyboard2048Control(Generic2048Control):
                 if m:
                     pos = int(m.group(1)), int(m.group(2))
             if pos is not None and tval is not None:
-                board[pos[1]-1][pos[0]-1] = int(round(math.log(tval, 2)))
+                board[pos[1]-1][pos[0]-1] = to_c_index(tval)
 
         return board
 
@@ -188,13 +195,17 @@ class Hybrid2048Control(Fast2048Control, Keyboard2048Control):
 class Play2048CoControl(object):
     """ Controller for Play2048.co """
 
+    profiler = None
+
     def __init__(self, ctrl):
         self.ctrl = ctrl
         self.setup()
 
+    execute = Generic2048Control.execute
+
     def setup(self):
         # Get a reference to the game manager object
-        self.ctrl.execute(
+        self.execute(
             """
             (async function() {
                 if(window._2048ai_manager)
@@ -226,7 +237,7 @@ class Play2048CoControl(object):
 
     def get_status(self):
         ''' Check if the game is in an unusual state. '''
-        return self.ctrl.execute('''
+        return self.execute('''
             if(window._2048ai_game.state == "fresh" || window._2048ai_game.state == "playing") { "running" }
             else if(window._2048ai_game.state == "gameOver") { "ended" }
             else if(window._2048ai_game.state == "gameWon") { "won" }
@@ -235,18 +246,18 @@ class Play2048CoControl(object):
         ''')
 
     def restart_game(self):
-        return self.ctrl.execute("window._2048ai_manager.reset()")
+        return self.execute("window._2048ai_manager.reset()")
 
     def continue_game(self):
         ''' Continue the game. Only works if the game is in the 'won' state. '''
-        return self.ctrl.execute("window._2048ai_manager.continueAfterWin()")
+        return self.execute("window._2048ai_manager.continueAfterWin()")
 
     def get_score(self):
-        return self.ctrl.execute("window._2048ai_game.score")
+        return self.execute("window._2048ai_game.score")
 
     def get_board(self):
         # Chrome refuses to serialize the Grid object directly through the debugger.
-        grid = json.loads(self.ctrl.execute('JSON.stringify(window._2048ai_game.board)'))
+        grid = json.loads(self.execute('JSON.stringify(window._2048ai_game.board)'))
 
         board = [[0]*4 for _ in range(4)]
         for row in grid:
@@ -255,11 +266,11 @@ class Play2048CoControl(object):
                     continue
                 pos = cell["position"]["x"], cell["position"]["y"]
                 tval = cell['value']
-                board[pos[1]][pos[0]] = int(round(math.log(tval, 2)))
+                board[pos[1]][pos[0]] = to_c_index(tval)
 
         return board
 
     def execute_move(self, move):
         # We use UDLR ordering; 2048 uses URDL ordering
         movename = ["up", "down", "left", "right"][move]
-        self.ctrl.execute("window._2048ai_manager.move('%s')" % movename)
+        self.execute("window._2048ai_manager.move('%s')" % movename)
@@ -0,0 +1,193 @@
+''' Record game trajectories in a compact binary file, and read them back as NumPy arrays.
+
+File layout (all little-endian):
+
+    header   MAGIC, version (u16), record size (u16), reserved (u32)
+    records  fixed-width RECORD_STRUCT records, written in chunks of up to CHUNK_RECORDS
+    index    one INDEX_STRUCT entry per chunk: file offset (u64), record count (u32), first game (u32)
+    trailer  index offset (u64), chunk count (u32), INDEX_MAGIC
+
+Chunks are contiguous, so all records form a single array that can be memory-mapped directly.
+The index and trailer are rewritten when the recorder is closed; a file whose recorder didn't
+close cleanly is recovered by keeping all complete records.
+'''
+
+import os
+import struct
+import threading
+
+MAGIC = b'2048REC\0'
+VERSION = 1
+INDEX_MAGIC = b'RIDX'
+
+HEADER_STRUCT = struct.Struct('<8sHHI')
+# board, scores[4], search time (s), game, turn, move, spawn position, spawn rank, padding
+RECORD_STRUCT = struct.Struct('<Q4ffIIbBBx')
+INDEX_STRUCT = struct.Struct('<QII')
+TRAILER_STRUCT = struct.Struct('<QI4s')
+
+CHUNK_RECORDS = 4096
+
+# spawn_pos value for "no spawned tile" (e.g. the first turn of a game)
+NO_SPAWN = 0xff
+
+def find_spawn(expected, actual):
+    ''' Locate the tile spawned between two turns.
+
+    expected is the board right after the previous move, actual the board the next turn starts from.
+    Returns (position, rank), or None if the boards don't differ by exactly one new tile. '''
+    diff = expected ^ actual
+    if diff == 0:
+        return None
+    shift = ((diff & -diff).bit_length() - 1) & ~3
+    if diff >> shift > 0xf or (expected >> shift) & 0xf:
+        return None
+    return shift // 4, (actual >> shift) & 0xf
+
+class GameRecorder(object):
+    ''' Append turns to a trajectory file.
+
+    Thread-safe: several games (e.g. web sessions) can record into one file concurrently,
+    each under its own game id from new_game(). '''
+
+    def __init__(self, path, chunk_records=CHUNK_RECORDS):
+        self.path = path
+        self.chunk_records = chunk_records
+        self.lock = threading.Lock()
+        self.index = []
+        self.buf = bytearray()
+        self.nbuffered = 0
+        self.next_game = 0
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.f = open(path, 'r+b')
+            self._reopen()
+        else:
+            self.f = open(path, 'w+b')
+            self.f.write(HEADER_STRUCT.pack(MAGIC, VERSION, RECORD_STRUCT.size, 0))
+            self.data_end = HEADER_STRUCT.size
+
+    def _reopen(self):
+        ''' Continue an existing file: drop its index, and keep appending after the last record. '''
+        magic, version, recsize, _ = HEADER_STRUCT.unpack(self.f.read(HEADER_STRUCT.size))
+        if magic != MAGIC or version != VERSION or recsize != RECORD_STRUCT.size:
+            raise ValueError("%s is not a compatible trajectory file" % self.path)
+
+        index, data_end = _read_index(self.f)
+        if index is None:
+            # Not closed cleanly: keep every complete record, as one chunk
+            nrecords = (data_end - HEADER_STRUCT.size) // RECORD_STRUCT.size
+            data_end = HEADER_STRUCT.size + nrecords * RECORD_STRUCT.size
+            index = [(HEADER_STRUCT.size, nrecords, 0)] if nrecords else []
+        self.index = index
+        self.data_end = data_end
+        self.f.truncate(data_end)
+
+        if data_end > HEADER_STRUCT.size:
+            self.f.seek(data_end - RECORD_STRUCT.size)
+            last = RECORD_STRUCT.unpack(self.f.read(RECORD_STRUCT.size))
+            self.next_game = last[6] + 1
+
+    def new_game(self):
+        ''' Return a fresh game id. '''
+        with self.lock:
+            game = self.next_game
+            self.next_game += 1
+            return game
+
+    def record(self, game, turn, board, move, scores=None, search_time=0.0, spawn=None):
+        ''' Append one turn.
+
+        scores are the per-direction search scores (NaN if unknown); spawn is the (position, rank)
+        of the tile that appeared before this turn, if known. '''
+        if scores is None:
+            scores = (float('nan'),) * 4
+        spawn_pos, spawn_rank = spawn if spawn is not None else (NO_SPAWN, 0)
+        rec = RECORD_STRUCT.pack(board, *scores, search_time, game, turn, move, spawn_pos, spawn_rank)
+        with self.lock:
+            if self.nbuffered == 0:
+                self.chunk_game = game
+            self.buf += rec
+            self.nbuffered += 1
+            if self.nbuffered >= self.chunk_records:
+                self._flush_chunk()
+
+    def _flush_chunk(self):
+        if not self.nbuffered:
+            return
+        self.f.seek(self.data_end)
+        self.f.write(self.buf)
+        self.index.append((self.data_end, self.nbuffered, self.chunk_game))
+        self.data_end += len(self.buf)
+        self.buf = bytearray()
+        self.nbuffered = 0
+
+    def flush(self):
+        ''' Write buffered records and an up-to-date index. '''
+        with self.lock:
+            self._flush_chunk()
+            self.f.seek(self.data_end)
+            for entry in self.index:
+                self.f.write(INDEX_STRUCT.pack(*entry))
+            self.f.write(TRAILER_STRUCT.pack(self.data_end, len(self.index), INDEX_MAGIC))
+            self.f.truncate()
+            self.f.flush()
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _read_index(f):
+    ''' Return (index entries, end of record data), or (None, file size) without a valid trailer. '''
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size >= HEADER_STRUCT.size + TRAILER_STRUCT.size:
+        f.seek(size - TRAILER_STRUCT.size)
+        index_offset, nchunks, magic = TRAILER_STRUCT.unpack(f.read(TRAILER_STRUCT.size))
+        if magic == INDEX_MAGIC and index_offset + nchunks * INDEX_STRUCT.size + TRAILER_STRUCT.size == size:
+            f.seek(index_offset)
+            data = f.read(nchunks * INDEX_STRUCT.size)
+            return [INDEX_STRUCT.unpack_from(data, i * INDEX_STRUCT.size) for i in range(nchunks)], index_offset
+    return None, size
+
+def read_index(path):
+    ''' Return the chunk index of a trajectory file as a list of (offset, count, first game). '''
+    with open(path, 'rb') as f:
+        index, data_end = _read_index(f)
+    if index is None:
+        raise ValueError("%s has no index (recorder not closed?)" % path)
+    return index
+
+def record_dtype():
+    ''' NumPy structured dtype matching RECORD_STRUCT. '''
+    import numpy as np
+    return np.dtype([
+        ('board', '<u8'),
+        ('scores', '<f4', (4,)),
+        ('search_time', '<f4'),
+        ('game', '<u4'),
+        ('turn', '<u4'),
+        ('move', 'i1'),
+        ('spawn_pos', 'u1'),
+        ('spawn_rank', 'u1'),
+        ('_pad', 'u1'),
+    ])
+
+def read_records(path):
+    ''' Memory-map all records of a trajectory file as a read-only NumPy structured array. '''
+    import numpy as np
+    index = read_index(path)
+    nrecords = sum(count for _, count, _ in index)
+    dtype = record_dtype()
+    assert dtype.itemsize == RECORD_STRUCT.size
+    if nrecords == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=HEADER_STRUCT.size, shape=(nrecords,))
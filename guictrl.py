@@ -1,8 +1,15 @@
+import queue
+import threading
+import time
 import tkinter as tk
 from tkinter import messagebox, font
 import numpy as np
-from ailib import to_c_board, from_c_board, from_c_index, ailib
+from ailib import to_c_board, from_c_board, to_c_board_values, from_c_board_values, RANK_OF, GameSimulator, ailib, SearchToken, SearchCancelled, \
+    SearchProgress
 from functools import lru_cache
+from gamerec import find_spawn
+from latency import MoveProfiler
+from ponder import Ponderer
 
 # 使用缓存装饰器避免重复计算颜色值
 @lru_cache(maxsize=32)
@@ -35,11 +42,49 @@ def get_tile_color(value):
     else:
         return "#3c3a32", "#f9f6f2"  # 更高的值
 
+def _tile_style(rank):
+    """根据方块的对数值返回(文字, 背景色, 文字色, 字体)"""
+    if rank == 0:
+        return "", "#ccc0b3", "#776e65", ("Arial", 24, "bold")
+    value = 1 << rank
+    bg_color, text_color = get_tile_color(value)
+    # 根据数字位数调整字体大小
+    if value < 100:
+        font_size = 24
+    elif value < 1000:
+        font_size = 20
+    elif value < 10000:
+        font_size = 16
+    else:
+        font_size = 14
+    return str(value), bg_color, text_color, ("Arial", font_size, "bold")
+
+# 按对数值预先计算好的方块样式，渲染时无需重复计算
+TILE_STYLES = [_tile_style(rank) for rank in range(16)]
+
+# 单个方块的最大值（board_t中每个格子只有4位）
+MAX_TILE = 1 << 15
+
 class GUI2048Control:
     """GUI控制界面，可以手动设置局面并让AI执行下一步"""
     
-    def __init__(self, ai_solver_func):
+    # 轮询搜索结果的间隔（毫秒），约60帧/秒
+    POLL_INTERVAL_MS = 16
+    # 自动运行时的重绘帧率上限，None表示每一步都立即重绘
+    MAX_REDRAW_FPS = 60
+    # 编辑棋盘后停顿多久开始预先搜索（毫秒）
+    PONDER_DELAY_MS = 300
+    
+    def __init__(self, ai_solver_func, ai_scores_func=None, recorder=None):
         self.ai_solver_func = ai_solver_func
+        # ai_scores_func(board, token)返回board_t四个方向的分数，提供时记录中包含搜索分数
+        # 两个函数都接受SearchToken，取消时抛出SearchCancelled
+        self.ai_scores_func = ai_scores_func
+        # 可选的对局记录器（gamerec.GameRecorder），记录自动运行的每一步
+        self.recorder = recorder
+        self._record_game = None
+        # AI移动各阶段（搜索、执行）的耗时统计，自动运行的对局结束时输出
+        self.profiler = MoveProfiler('game2048_gui')
         self.window = tk.Tk()
         self.window.title("2048 AI 控制界面")
         self.window.geometry("600x650")
@@ -53,8 +98,31 @@ class GUI2048Control:
         self.board = [[0 for _ in range(4)] for _ in range(4)]
         self.cells = []
         self.score = 0
+        self.sim = GameSimulator()  # 游戏核心：移动、计分和生成新方块
+        
+        # 上一次渲染的棋盘（board_t打包形式）和分数，用于增量重绘
+        self._rendered_board = 0
+        self._rendered_score = 0
+        self._redraw_scheduled = False
+        self._last_redraw = 0.0
+        
+        # 后台AI搜索：搜索在工作线程中进行，结果由Tk主线程通过window.after取回
+        self._search_requests = queue.Queue()
+        self._search_results = queue.Queue()
+        self._search_generation = 0  # 每次编辑棋盘后递增，用于丢弃过期的搜索结果
+        self._search_pending = False
+        self._search_token = None  # 当前搜索的SearchToken，编辑棋盘时取消
+        self._search_progress = None  # 手动请求的搜索进度（SearchProgress），轮询时显示
+        self._progress_text = None
+        # 用户思考时在后台预先搜索接下来可能的局面（需要ai_scores_func）
+        self.ponderer = Ponderer(ai_scores_func) if ai_scores_func else None
+        self._ponder_after_id = None
+        self.autoplay = False
+        self._search_thread = threading.Thread(target=self._search_worker, daemon=True)
+        self._search_thread.start()
         
         self._initialize_ui()
+        self.window.after(self.POLL_INTERVAL_MS, self._poll_search_results)
     
     def _initialize_ui(self):
         # 设置顶部信息区域
@@ -111,19 +179,24 @@ class GUI2048Control:
                   **button_style).grid(row=0, column=1, padx=15)
         tk.Button(control_frame, text="随机棋盘", command=self._random_board, 
                   **button_style).grid(row=0, column=2, padx=15)
+        self.autoplay_button = tk.Button(control_frame, text="自动运行", command=self._toggle_autoplay,
+                                         **button_style)
+        self.autoplay_button.grid(row=0, column=3, padx=15)
     
     def _increase_value(self, i, j):
         """增大单元格的值"""
+        self._cancel_search()
         current = self.board[i][j]
         if current == 0:
             self.board[i][j] = 2
         else:
-            self.board[i][j] = current * 2
+            self.board[i][j] = min(current * 2, MAX_TILE)
         # 只更新修改的单元格而不是整个棋盘
         self._update_cell(i, j)
     
     def _decrease_value(self, i, j):
         """减小单元格的值"""
+        self._cancel_search()
         current = self.board[i][j]
         if current <= 2:
             self.board[i][j] = 0
@@ -132,41 +205,63 @@ class GUI2048Control:
         # 只更新修改的单元格而不是整个棋盘
         self._update_cell(i, j)
     
+    def _packed_board(self):
+        """返回当前棋盘的board_t打包形式（每个格子为4位对数值）"""
+        return to_c_board_values(self.board)
+    
+    def _set_packed_board(self, packed):
+        """从board_t打包形式设置棋盘"""
+        self.board = from_c_board_values(packed)
+    
+    def _render_cell(self, index, rank):
+        """按对数值渲染单个单元格"""
+        text, bg_color, text_color, cell_font = TILE_STYLES[rank]
+        label = self.cells[index >> 2][index & 3]
+        label.configure(text=text, bg=bg_color, fg=text_color, font=cell_font)
+        label.master.configure(bg=bg_color)
+    
     def _update_cell(self, i, j):
         """更新单个单元格的显示"""
-        value = self.board[i][j]
-        if value == 0:
-            self.cells[i][j].configure(text="", bg="#ccc0b3")
-            self.cells[i][j].master.configure(bg="#ccc0b3")
-        else:
-            self.cells[i][j].configure(text=str(value))
-            bg_color, text_color = get_tile_color(value)
-            self.cells[i][j].configure(bg=bg_color, fg=text_color)
-            self.cells[i][j].master.configure(bg=bg_color)
-            
-            # 根据数字位数调整字体大小
-            if value < 100:
-                font_size = 24
-            elif value < 1000:
-                font_size = 20
-            elif value < 10000:
-                font_size = 16
-            else:
-                font_size = 14
-                
-            self.cells[i][j].configure(font=("Arial", font_size, "bold"))
+        rank = RANK_OF[self.board[i][j]]
+        shift = 4 * (4 * i + j)
+        self._render_cell(4 * i + j, rank)
+        self._rendered_board = (self._rendered_board & ~(0xf << shift)) | (rank << shift)
     
     def _update_display(self):
-        """更新界面显示"""
-        for i in range(4):
-            for j in range(4):
-                self._update_cell(i, j)
+        """更新界面显示：只重绘与上一次渲染不同的单元格"""
+        packed = self._packed_board()
+        diff = packed ^ self._rendered_board
+        while diff:
+            shift = ((diff & -diff).bit_length() - 1) & ~3
+            self._render_cell(shift >> 2, (packed >> shift) & 0xf)
+            diff &= ~(0xf << shift)
+        self._rendered_board = packed
+        
+        if self.score != self._rendered_score:
+            self.score_label.configure(text=str(self.score))
+            self._rendered_score = self.score
+        self._last_redraw = time.monotonic()
+    
+    def _schedule_redraw(self):
+        """合并多次更新，按MAX_REDRAW_FPS限制重绘频率"""
+        if self.MAX_REDRAW_FPS is None:
+            self._update_display()
+            return
+        if self._redraw_scheduled:
+            return
+        self._redraw_scheduled = True
+        delay = self._last_redraw + 1.0 / self.MAX_REDRAW_FPS - time.monotonic()
+        self.window.after(max(0, int(delay * 1000)), self._flush_redraw)
+    
+    def _flush_redraw(self):
+        self._redraw_scheduled = False
+        self._update_display()
     
     def _clear_board(self):
         """清空棋盘"""
+        self._cancel_search()
         self.board = [[0 for _ in range(4)] for _ in range(4)]
         self.score = 0
-        self.score_label.configure(text="0")
         self._update_display()
     
     def _random_board(self):
@@ -186,90 +281,211 @@ class GUI2048Control:
         self._update_display()
     
     def _ai_next_move(self):
-        """AI执行下一步"""
+        """AI执行下一步（在后台线程中搜索）"""
+        if self._search_pending:
+            return
         # 检查棋盘是否有足够的方块
         if not any(any(row) for row in self.board):
             messagebox.showinfo("提示", "请先设置棋盘", font=self.default_font)
             return
-        
-        # 将棋盘转换为AI可用的格式 - 使用列表推导式优化
-        log2_board = [[int(np.log2(max(tile, 1))) for tile in row] for row in self.board]
-        
-        # 获取AI的最佳移动
-        move = self.ai_solver_func(log2_board)
+        self._submit_search()
+    
+    def _toggle_autoplay(self):
+        """切换自动运行模式：以引擎允许的最快速度连续执行AI移动"""
+        if self.autoplay:
+            self._stop_autoplay()
+            return
+        if not any(any(row) for row in self.board):
+            messagebox.showinfo("提示", "请先设置棋盘")
+            return
+        self.autoplay = True
+        self.autoplay_button.configure(text="停止运行")
+        if self.ponderer is not None:
+            # 自动运行不等待用户，预先搜索只会争抢CPU
+            self.ponderer.stop()
+        if self.recorder is not None:
+            # 每次开始自动运行记为一局新的对局
+            self._record_game = self.recorder.new_game()
+            self._record_turn = 0
+            self._record_expected = None
+        if not self._search_pending:
+            self._submit_search()
+    
+    def _stop_autoplay(self):
+        """停止自动运行；正在进行的搜索一并取消，其结果不再执行"""
+        self.autoplay = False
+        self.autoplay_button.configure(text="自动运行")
+        if self._search_pending:
+            self._drop_search()
+            self.last_move_label.configure(text="等待操作")
+    
+    def _submit_search(self):
+        """将当前局面提交给后台搜索线程"""
+        packed = self._packed_board()
+        # 只保留最新的请求
+        while True:
+            try:
+                self._search_requests.get_nowait()
+            except queue.Empty:
+                break
+        self._search_pending = True
+        self._search_token = SearchToken()
+        # 自动运行时不显示进度：逐层加深会多花一些时间
+        self._search_progress = None if self.autoplay else SearchProgress()
+        self._progress_text = None
+        self._search_requests.put((self._search_generation, packed, self._search_token, self._search_progress))
+        self.last_move_label.configure(text="AI思考中...")
+    
+    def _drop_search(self):
+        """丢弃正在进行的搜索：其结果的generation已过期，不会被执行"""
+        self._search_generation += 1
+        self._search_pending = False
+        self._search_progress = None
+        if self._search_token is not None:
+            # 让C++搜索尽快返回，而不是算完后再丢弃结果
+            self._search_token.cancel()
+            self._search_token = None
+    
+    def _cancel_search(self):
+        """棋盘被编辑：丢弃正在进行的搜索结果并停止自动运行"""
+        self._schedule_ponder()
+        self._drop_search()
+        if self.autoplay:
+            self._stop_autoplay()
+    
+    def _schedule_ponder(self):
+        """编辑停顿PONDER_DELAY_MS后，从编辑后的局面开始预先搜索"""
+        if self.ponderer is None:
+            return
+        if self._ponder_after_id is not None:
+            self.window.after_cancel(self._ponder_after_id)
+        self._ponder_after_id = self.window.after(self.PONDER_DELAY_MS, self._ponder_board)
+    
+    def _ponder_board(self):
+        self._ponder_after_id = None
+        if not self.autoplay and not self._search_pending and any(any(row) for row in self.board):
+            self.ponderer.ponder(self._packed_board())
+    
+    def _search_worker(self):
+        """后台搜索线程：不得访问任何Tk对象"""
+        while True:
+            generation, packed, token, progress = self._search_requests.get()
+            start = time.perf_counter()
+            scores = None
+            try:
+                if self.ponderer is not None:
+                    scores = self.ponderer.scores(packed, token, progress)
+                elif self.ai_scores_func:
+                    if progress is not None:
+                        scores = list(self.ai_scores_func(packed, token, progress))
+                    else:
+                        scores = list(self.ai_scores_func(packed, token))
+                else:
+                    move = self.ai_solver_func(from_c_board(packed), token)
+                if scores is not None:
+                    move = max(range(4), key=lambda m: scores[m])
+                    if scores[move] <= 0:
+                        move = -1
+            except SearchCancelled:
+                # 棋盘已被编辑，结果本来就会被丢弃
+                continue
+            except Exception as e:
+                move = e
+            self._search_results.put((generation, packed, move, scores, time.perf_counter() - start))
+    
+    def _poll_search_results(self):
+        """在Tk主线程中取回后台搜索结果"""
+        try:
+            while True:
+                generation, packed, move, scores, elapsed = self._search_results.get_nowait()
+                if generation == self._search_generation:
+                    self._search_pending = False
+                    self._search_progress = None
+                    if self.autoplay and self._record_game is not None and isinstance(move, int) and move >= 0:
+                        self._record_move(packed, move, scores, elapsed)
+                    self._apply_ai_move(move, elapsed)
+        except queue.Empty:
+            pass
+        if self._search_pending and self._search_progress is not None:
+            self._show_progress(self._search_progress.read())
+        self.window.after(self.POLL_INTERVAL_MS, self._poll_search_results)
+    
+    def _show_progress(self, info):
+        """在状态栏显示正在进行的搜索的进度：已完成的深度、节点数和当前最佳移动"""
+        if info["depth"] == 0 and info["nodes"] == 0:
+            return
+        move_names = ['上移', '下移', '左移', '右移']
+        text = f"AI思考中... 深度{info['depth']} {info['nodes'] // 1000}千节点"
+        if info["best_move"] >= 0:
+            text += f" 最佳: {move_names[info['best_move']]}"
+        if text != self._progress_text:
+            self._progress_text = text
+            self.last_move_label.configure(text=text)
+    
+    def _record_move(self, packed, move, scores, elapsed):
+        """将自动运行的一步写入对局记录"""
+        expected = self._record_expected
+        spawn = find_spawn(expected, packed) if expected is not None else None
+        self.recorder.record(self._record_game, self._record_turn, packed, move, scores, elapsed, spawn)
+        self._record_turn += 1
+        self._record_expected = GameSimulator.move(packed, move)[0]
+    
+    def _apply_ai_move(self, move, search_time=0.0):
+        """执行后台搜索得到的移动"""
+        if isinstance(move, Exception):
+            self._stop_autoplay()
+            self.last_move_label.configure(text="等待操作")
+            messagebox.showerror("AI分析", f"搜索失败: {move}")
+            return
         if move < 0:
-            messagebox.showinfo("AI分析", "当前局面没有可行的移动")
+            self.last_move_label.configure(text="游戏结束" if self.autoplay else "等待操作")
+            if self.autoplay:
+                self._stop_autoplay()
+                print("AI移动耗时统计（毫秒）：")
+                print(self.profiler.summary())
+            else:
+                messagebox.showinfo("AI分析", "当前局面没有可行的移动")
             return
         
         # 执行移动而不是显示建议
         move_names = ['上移', '下移', '左移', '右移']
+        execute_start = time.perf_counter()
         self._execute_move(move)
+        execute_time = time.perf_counter() - execute_start
+        self.profiler.record({"search": search_time, "execute": execute_time, "total": search_time + execute_time})
         
         # 更新状态栏显示最后执行的移动
         self.last_move_label.configure(text=f"上一步: {move_names[move]}")
+        
+        if self.autoplay:
+            # 自动运行时模拟完整的游戏：生成新方块后立即开始下一次搜索，
+            # 重绘按帧率合并
+            self._add_new_tile()
+            self._schedule_redraw()
+            self._submit_search()
+        else:
+            self._update_display()
+            if self.ponderer is not None:
+                # 用户接下来会放置新方块，预先搜索各种可能的新方块
+                self.ponderer.ponder(self._packed_board(), spawn_pending=True)
     
     def _execute_move(self, direction):
-        """执行移动操作，使用C接口"""
-        # 将当前棋盘转换为C接口可用格式
-        log2_board = [[int(np.log2(max(tile, 1))) for tile in row] for row in self.board]
-        c_board = to_c_board(log2_board)
-        
-        # 使用C接口执行移动
-        new_c_board = ailib.execute_move(direction, c_board)
+        """执行移动操作，使用C接口；只更新棋盘状态，由调用者负责重绘"""
+        c_board = self._packed_board()
         
-        # 将结果转换回Python格式
-        new_board = from_c_board(new_c_board)
+        # 使用C接口执行移动并计算合并得分
+        new_c_board, score_increase = GameSimulator.move(c_board, direction)
+        if new_c_board == c_board:
+            return False
+        self.score += score_increase
         
-        # 检查棋盘是否有变化
-        board_changed = False
-        for i in range(4):
-            for j in range(4):
-                if new_board[i][j] != log2_board[i][j]:
-                    board_changed = True
-                    break
-            if board_changed:
-                break
-                
-        if board_changed:
-            # 更新棋盘
-            for i in range(4):
-                for j in range(4):
-                    if new_board[i][j] > 0:
-                        self.board[i][j] = 2 ** new_board[i][j]
-                    else:
-                        self.board[i][j] = 0
-                        
-            # 添加新方块
-            # self._add_new_tile()
-            
-            # 计算得分差异并更新分数
-            # 这里简化处理，直接从UI中读取分数不太可能，所以计算合并格子产生的分数
-            old_sum = sum(sum(log2_board, []))
-            new_sum = sum(sum(new_board, []))
-            # 差值中不包括新增的方块(通常为1或2)
-            score_increase = 0
-            for i in range(4):
-                for j in range(4):
-                    if new_board[i][j] > log2_board[i][j] and log2_board[i][j] > 0:
-                        # 有合并发生
-                        score_increase += 2 ** new_board[i][j]
-            
-            self.score += score_increase
-            self.score_label.configure(text=str(self.score))
-            
-            # 更新界面显示
-            self._update_display()
+        # 更新棋盘
+        self._set_packed_board(new_c_board)
+        return True
     
     def _add_new_tile(self):
         """在随机空位添加一个新的2或4方块"""
-        # 找到所有空位 - 使用列表推导式
-        empty_cells = [(i, j) for i in range(4) for j in range(4) if self.board[i][j] == 0]
-        
-        if empty_cells:
-            # 随机选择一个空位
-            i, j = empty_cells[np.random.randint(0, len(empty_cells))]
-            # 90%概率为2，10%概率为4
-            self.board[i][j] = 2 if np.random.random() < 0.9 else 4
+        self._set_packed_board(self.sim.spawn(self._packed_board()))
     
     def run(self):
         """运行GUI"""
@@ -283,8 +499,10 @@ class GUI2048Control:
 class GUIGameControl:
     """为主程序提供的游戏控制接口"""
     
-    def __init__(self, ai_solver_func):
+    def __init__(self, ai_solver_func, ai_scores_func=None, recorder=None):
         self.ai_solver_func = ai_solver_func
+        self.ai_scores_func = ai_scores_func
+        self.recorder = recorder
         self.gui = None
         from ailib import ailib
         self.ailib = ailib
@@ -303,27 +521,17 @@ class GUIGameControl:
         """获取当前棋盘状态"""
         if self.gui:
             # 直接返回棋盘的对数形式
-            return [[int(np.log2(max(tile, 1))) for tile in row] for row in self.gui.board]
+            return from_c_board(self.gui._packed_board())
         return [[0 for _ in range(4)] for _ in range(4)]
     
     def execute_move(self, move):
         """使用C接口执行移动"""
         if self.gui:
-            # 将当前棋盘转换为C接口可用格式
-            from ailib import to_c_board, from_c_board
-            c_board = to_c_board(self.get_board())
+            c_board = self.gui._packed_board()
             # 使用C接口执行移动
             new_c_board = self.ailib.execute_move(move, c_board)
-            # 将结果转换回Python格式
-            new_board = from_c_board(new_c_board)
-            # 将对数形式转换回原始值
-            for i in range(4):
-                for j in range(4):
-                    if new_board[i][j] > 0:
-                        self.gui.board[i][j] = 2 ** new_board[i][j]
-                    else:
-                        self.gui.board[i][j] = 0
-            # 更新界面
+            self.gui._set_packed_board(new_c_board)
+            # 只重绘发生变化的单元格
             self.gui._update_display()
             # 更新状态标签
             move_names = ['上移', '下移', '左移', '右移']
@@ -340,5 +548,5 @@ class GUIGameControl:
     
     def setup_gui(self):
         """设置并启动GUI"""
-        self.gui = GUI2048Control(self.ai_solver_func)
+        self.gui = GUI2048Control(self.ai_solver_func, self.ai_scores_func, self.recorder)
         self.gui.run()
@@ -0,0 +1,199 @@
+''' Per-move latency histograms.
+
+A MoveProfiler splits the time of each move into phases:
+
+    roundtrip  waiting for the browser (or other game backend) to answer commands
+    decode     turning the game state into a board_t, excluding round trips
+    search     running the move searcher
+    execute    sending the move, excluding round trips
+    total      wall time of the whole move
+
+and keeps a LatencyHistogram per phase, which can be summarized as text, JSON or Prometheus
+exposition format.
+'''
+
+from __future__ import print_function
+
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+PHASES = ('roundtrip', 'decode', 'search', 'execute', 'total')
+QUANTILES = (0.5, 0.95, 0.99)
+
+class LatencyHistogram(object):
+    ''' Histogram of durations with logarithmic buckets.
+
+    Bucket i holds durations in [MIN_SECONDS * GROWTH**i, MIN_SECONDS * GROWTH**(i+1)), so
+    percentiles are accurate to within GROWTH (about 19%). Thread-safe. '''
+
+    MIN_SECONDS = 1e-6
+    GROWTH = 2 ** 0.25
+    NBUCKETS = 112  # up to MIN_SECONDS * 2**28, about 4.5 minutes
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.buckets = [0] * self.NBUCKETS
+            self.count = 0
+            self.sum = 0.0
+            self.min = float('inf')
+            self.max = 0.0
+
+    def record(self, seconds):
+        if seconds < self.MIN_SECONDS:
+            i = 0
+        else:
+            i = min(int(math.log(seconds / self.MIN_SECONDS, self.GROWTH)), self.NBUCKETS - 1)
+        with self.lock:
+            self.buckets[i] += 1
+            self.count += 1
+            self.sum += seconds
+            self.min = min(self.min, seconds)
+            self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        ''' Estimate the q-quantile (0 <= q <= 1), or None if empty. '''
+        with self.lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            seen = 0
+            for i, n in enumerate(self.buckets):
+                seen += n
+                if n and seen >= rank:
+                    break
+            # Geometric middle of the bucket, clamped to the observed range
+            value = self.MIN_SECONDS * self.GROWTH ** (i + 0.5)
+            return min(max(value, self.min), self.max)
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def to_dict(self):
+        d = {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.mean(),
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+        }
+        for q in QUANTILES:
+            d['p%d' % round(q * 100)] = self.percentile(q)
+        return d
+
+class MoveTiming(object):
+    ''' Time spent in each phase of one move. '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.cancelled = False
+
+    def cancel(self):
+        ''' Don't record this move (e.g. the game ended before a move was made). '''
+        self.cancelled = True
+
+    @contextmanager
+    def phase(self, name):
+        ''' Time a block as part of phase name. Round trips inside it count as roundtrip instead. '''
+        roundtrip = self.phases.get('roundtrip', 0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add(name, elapsed - (self.phases.get('roundtrip', 0.0) - roundtrip))
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+class MoveProfiler(object):
+    ''' Collects MoveTimings into per-phase histograms.
+
+    Use `with profiler.move() as timing:` around each move and `timing.phase(...)` around its
+    parts. Backends report their round trips with profiler.roundtrip(seconds), which is charged to
+    the move in progress on the calling thread. '''
+
+    def __init__(self, name='game2048'):
+        self.name = name
+        self.histograms = {phase: LatencyHistogram() for phase in PHASES}
+        self.local = threading.local()
+
+    @contextmanager
+    def move(self):
+        timing = MoveTiming()
+        self.local.current = timing
+        try:
+            yield timing
+        finally:
+            self.local.current = None
+            if not timing.cancelled:
+                timing.phases['total'] = time.perf_counter() - timing.start
+                self.record(timing.phases)
+
+    def record(self, phases):
+        ''' Record one move given as {phase: seconds}; missing phases are not recorded. '''
+        for phase, seconds in phases.items():
+            self.histograms[phase].record(seconds)
+
+    def roundtrip(self, seconds):
+        timing = getattr(self.local, 'current', None)
+        if timing is not None:
+            timing.add('roundtrip', seconds)
+
+    @contextmanager
+    def timed_roundtrip(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.roundtrip(time.perf_counter() - start)
+
+    def reset(self):
+        for h in self.histograms.values():
+            h.reset()
+
+    def to_dict(self):
+        return {phase: self.histograms[phase].to_dict() for phase in PHASES}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        ''' Prometheus text exposition format, as one summary metric labelled by phase. '''
+        metric = '%s_move_phase_seconds' % self.name
+        lines = [
+            '# HELP %s Time spent per move in each phase.' % metric,
+            '# TYPE %s summary' % metric,
+        ]
+        for phase in PHASES:
+            h = self.histograms[phase]
+            if not h.count:
+                continue
+            for q in QUANTILES:
+                lines.append('%s{phase="%s",quantile="%s"} %r' % (metric, phase, q, h.percentile(q)))
+            lines.append('%s_sum{phase="%s"} %r' % (metric, phase, h.sum))
+            lines.append('%s_count{phase="%s"} %d' % (metric, phase, h.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        ''' Human-readable table of the phase histograms, in milliseconds. '''
+        lines = ['%-10s %7s %9s %9s %9s %9s %9s' % ('phase', 'moves', 'mean', 'p50', 'p95', 'p99', 'max')]
+        for phase in PHASES:
+            h = self.histograms[phase]
+            if not h.count:
+                continue
+            lines.append('%-10s %7d %9.2f %9.2f %9.2f %9.2f %9.2f' % (phase, h.count, h.mean() * 1000,
+                h.percentile(0.5) * 1000, h.percentile(0.95) * 1000, h.percentile(0.99) * 1000, h.max * 1000))
+        return '\n'.join(lines)
+
+    def export(self, path):
+        ''' Write the histograms to path: JSON if it ends in .json, else Prometheus text. '''
+        with open(path, 'w') as f:
+            f.write(self.to_json() if path.endswith('.json') else self.to_prometheus())
@@ -0,0 +1,141 @@
+''' Train n-tuple network weights for the native engine by self-play TD(0) learning.
+
+The network scores afterstates (boards after a move, before the tile spawn) as the sum of
+per-tuple weights over the 8 symmetries of the board, exactly as score_ntuple_board in 2048.cpp
+does, and learns to predict the score still to be gained from there. Moves during training are
+chosen greedily: the move maximizing reward + value of the resulting afterstate.
+
+    python ntuple_train.py weights.ntw --games 100000
+    python 2048.py --weights weights.ntw ...
+'''
+
+from __future__ import print_function
+
+import struct
+import time
+
+import numpy as np
+
+from ailib import GameSimulator, from_c_boards
+
+MAGIC = b'NTW1'
+
+# Cell indices (4*row + col); every tuple is also applied to the 7 other symmetries of the board.
+TUPLE_SETS = {
+    # rows, 2x2 squares: 5 x 64K weights
+    'small': [(0, 1, 2, 3), (4, 5, 6, 7), (0, 1, 4, 5), (1, 2, 5, 6), (5, 6, 9, 10)],
+    # Szubert & Jaskowski's 6-tuples: 4 x 16M weights
+    'large': [(0, 1, 2, 3, 4, 5), (4, 5, 6, 7, 8, 9), (0, 1, 2, 4, 5, 6), (4, 5, 6, 8, 9, 10)],
+}
+
+class NTupleNetwork(object):
+    def __init__(self, tuples, weights=None):
+        self.tuples = [tuple(t) for t in tuples]
+        if weights is None:
+            weights = [np.zeros(16 ** len(t), dtype=np.float32) for t in self.tuples]
+        self.weights = weights
+        self._powers = [16 ** np.arange(len(t), dtype=np.int64) for t in self.tuples]
+
+    def indices(self, boards):
+        ''' Weight indices for an array of board_t: one (N, 8) index array per tuple. '''
+        r = from_c_boards(boards)
+        syms = [r, r[:, :, ::-1], r[:, ::-1, :], r[:, ::-1, ::-1]]
+        syms += [s.transpose(0, 2, 1) for s in syms]
+        cells = np.stack(syms, axis=1).reshape(len(r), 8, 16).astype(np.int64)
+        return [cells[:, :, list(t)] @ p for t, p in zip(self.tuples, self._powers)]
+
+    def evaluate(self, boards):
+        ''' Values of an array of afterstates. '''
+        idx = self.indices(boards)
+        return sum(w[i].sum(axis=1, dtype=np.float64) for w, i in zip(self.weights, idx))
+
+    def update(self, board, delta):
+        ''' Add delta to every weight used by board. '''
+        for w, i in zip(self.weights, self.indices(np.array([board], dtype=np.uint64))):
+            np.add.at(w, i.ravel(), delta)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(MAGIC + struct.pack('<I', len(self.tuples)))
+            for t in self.tuples:
+                f.write(struct.pack('<I%dB' % len(t), len(t), *t))
+            for w in self.weights:
+                f.write(w.astype('<f4').tobytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            if f.read(4) != MAGIC:
+                raise ValueError("%s is not an n-tuple weight file" % path)
+            count, = struct.unpack('<I', f.read(4))
+            tuples = []
+            for _ in range(count):
+                ncells, = struct.unpack('<I', f.read(4))
+                tuples.append(struct.unpack('<%dB' % ncells, f.read(ncells)))
+            weights = [np.fromfile(f, dtype='<f4', count=16 ** len(t)).astype(np.float32) for t in tuples]
+        return cls(tuples, weights)
+
+def play_training_game(net, sim, alpha):
+    ''' Play one greedy game, updating the weights after every move. Returns (score, max rank, moves). '''
+    board = sim.new_game()
+    prev = None
+    score = moves = 0
+    while True:
+        afters = []
+        rewards = []
+        for move in range(4):
+            after, reward = GameSimulator.move(board, move)
+            if after != board:
+                afters.append(after)
+                rewards.append(reward)
+        if not afters:
+            break
+        values = net.evaluate(np.array(afters, dtype=np.uint64))
+        best = int(np.argmax(values + rewards))
+        after, reward = afters[best], rewards[best]
+
+        if prev is not None:
+            # TD(0): V(prev) <- V(prev) + alpha * (r + V(after) - V(prev))
+            net.update(prev, alpha * (reward + values[best] - net.evaluate(np.array([prev], dtype=np.uint64))[0]))
+        prev = after
+        score += reward
+        moves += 1
+        board = sim.spawn(after)
+
+    if prev is not None:
+        # The game ended after prev: nothing more to gain from it
+        net.update(prev, -alpha * net.evaluate(np.array([prev], dtype=np.uint64))[0])
+    maxrank = int(from_c_boards([board]).max())
+    return score, maxrank, moves
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Train n-tuple network weights for the 2048 engine by self-play")
+    parser.add_argument('weights', help="Weight file to write (and to continue training from, with --resume)")
+    parser.add_argument('-g', '--games', help="Number of training games (default: 10000)", type=int, default=10000)
+    parser.add_argument('-t', '--tuples', help="Tuple set for a new network (default: small)", choices=sorted(TUPLE_SETS), default='small')
+    parser.add_argument('-a', '--alpha', help="Learning rate per weight (default: 0.0025)", type=float, default=0.0025)
+    parser.add_argument('-s', '--seed', help="Self-play RNG seed", type=int)
+    parser.add_argument('--resume', help="Continue training the weights in the output file", action='store_true')
+    parser.add_argument('--report', help="Print statistics and save the weights every REPORT games (default: 1000)", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    net = NTupleNetwork.load(args.weights) if args.resume else NTupleNetwork(TUPLE_SETS[args.tuples])
+    sim = GameSimulator(args.seed)
+    start = time.time()
+    window = []
+    for game in range(1, args.games + 1):
+        window.append(play_training_game(net, sim, args.alpha))
+        if game % args.report == 0 or game == args.games:
+            scores, maxranks, moves = zip(*window)
+            reached = sum(1 for r in maxranks if r >= 11)
+            print("games %d: mean score %.0f, max score %d, 2048 reached %.1f%%, %.0f moves/s" % (
+                game, np.mean(scores), max(scores), 100.0 * reached / len(window), sum(moves) / (time.time() - start)))
+            net.save(args.weights)
+            window = []
+            start = time.time()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    exit(main(sys.argv[1:]))
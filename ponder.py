@@ -0,0 +1,191 @@
+''' Pondering: search the positions a user is likely to ask about next, while they think.
+
+In the GUI and web front ends, moves are played without spawning a tile; the user then places the
+new tile by editing the board and asks for the next move. A Ponderer uses that idle time to search
+the likely next positions in a background thread:
+
+    after a move        the board with each possible spawned tile (2s first, as they are 9x likelier)
+    on the user's turn  the board itself, then each legal move followed by each possible spawn,
+                        best-scored moves first
+
+Results go into a bounded LRU cache keyed by board_t, which scores() consults before searching.
+A foreground search pre-empts pondering: the speculative search in progress is cancelled, and
+resumes once no foreground search is running.
+
+The cached scores are only valid for the score function that made them; call clear() when its
+settings (engine, evaluator, depth) change.
+'''
+
+from __future__ import print_function
+
+import threading
+from collections import OrderedDict, deque
+
+from ailib import GameSimulator, SearchToken, SearchCancelled
+
+# Boards whose scores are kept
+CACHE_SIZE = 4096
+# Most positions searched speculatively per ponder() call
+MAX_POSITIONS = 64
+
+def spawn_children(board):
+    ''' Boards reachable from board by spawning a tile: all 2s, then all 4s. '''
+    empty = [4 * i for i in range(16) if not (board >> (4 * i)) & 0xf]
+    return [board | (1 << s) for s in empty] + [board | (2 << s) for s in empty]
+
+class Ponderer(object):
+    ''' Background speculative search around the current position.
+
+    score_func(board, token) returns the four move scores of board, and raises SearchCancelled
+    once token is cancelled. Thread-safe. '''
+
+    def __init__(self, score_func, capacity=CACHE_SIZE, max_positions=MAX_POSITIONS):
+        self.score_func = score_func
+        self.capacity = capacity
+        self.max_positions = max_positions
+        self.hits = 0
+        self.misses = 0
+        self.pondered = 0  # speculative searches completed
+        self._cache = OrderedDict()  # board_t -> scores, least recently used first
+        self._cond = threading.Condition()
+        self._queue = deque()  # (board, expand): expand to its moves + spawns once scored
+        self._generation = 0  # incremented by ponder() and stop() to drop stale work
+        self._budget = 0  # speculative searches left for the current generation
+        self._busy = 0  # foreground searches running
+        self._token = None  # token of the speculative search in progress
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='ponder', daemon=True)
+        self._thread.start()
+
+    def lookup(self, board):
+        ''' Return the cached scores of board, or None. '''
+        with self._cond:
+            scores = self._cache.get(board)
+            if scores is None:
+                return None
+            self._cache.move_to_end(board)
+            return list(scores)
+
+    def scores(self, board, token=None, progress=None):
+        ''' Score the four moves of board, from the cache if it was pondered.
+
+        progress (a SearchProgress) is passed on to score_func, if given. '''
+        with self._cond:
+            scores = self._cache.get(board)
+            if scores is not None:
+                self._cache.move_to_end(board)
+                self.hits += 1
+                return list(scores)
+            self.misses += 1
+            self._busy += 1
+            if self._token is not None:
+                self._token.cancel()
+        try:
+            if progress is not None:
+                scores = list(self.score_func(board, token, progress))
+            else:
+                scores = list(self.score_func(board, token))
+        finally:
+            with self._cond:
+                self._busy -= 1
+                self._cond.notify_all()
+        if token is None or not token.cancelled:
+            # A search stopped early with progress returns shallower scores; don't keep those
+            self._store(board, scores)
+        return scores
+
+    def ponder(self, board, spawn_pending=False):
+        ''' Replace the speculative work with the positions likely to follow board.
+
+        spawn_pending: a move was just played on board, and a tile is yet to be spawned. '''
+        with self._cond:
+            self._generation += 1
+            self._budget = self.max_positions
+            self._queue.clear()
+            if spawn_pending:
+                self._queue.extend((child, False) for child in spawn_children(board))
+            else:
+                self._queue.append((board, True))
+            self._cond.notify_all()
+
+    def stop(self):
+        ''' Drop the speculative work, cancelling the search in progress. '''
+        with self._cond:
+            self._generation += 1
+            self._queue.clear()
+            if self._token is not None:
+                self._token.cancel()
+
+    def clear(self):
+        ''' Forget all cached scores, e.g. after changing the search settings. '''
+        self.stop()
+        with self._cond:
+            self._cache.clear()
+
+    def close(self):
+        self.stop()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def stats(self):
+        with self._cond:
+            return {"cached": len(self._cache), "hits": self.hits, "misses": self.misses,
+                    "pondered": self.pondered, "queued": len(self._queue)}
+
+    def _store(self, board, scores):
+        with self._cond:
+            self._cache[board] = scores
+            self._cache.move_to_end(board)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def _expand(self, board, scores):
+        ''' Queue the moves of board, best first, each followed by every spawn. '''
+        moves = sorted((m for m in range(4) if scores[m] > 0), key=lambda m: -scores[m])
+        for m in moves:
+            after, _ = GameSimulator.move(board, m)
+            self._queue.extend((child, False) for child in spawn_children(after))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or (self._queue and not self._busy))
+                if self._closed:
+                    return
+                board, expand = self._queue.popleft()
+                generation = self._generation
+                token = None
+                scores = self._cache.get(board)
+                if scores is None:
+                    if self._budget <= 0:
+                        self._queue.clear()
+                        continue
+                    self._budget -= 1
+                    self._token = token = SearchToken()
+
+            if scores is None:
+                try:
+                    scores = list(self.score_func(board, token))
+                except SearchCancelled:
+                    # Pre-empted by a foreground search (or stopped): retry it later if still wanted
+                    with self._cond:
+                        self._token = None
+                        if generation == self._generation:
+                            self._budget += 1
+                            self._queue.appendleft((board, expand))
+                    continue
+                except Exception:
+                    # Speculative: the foreground search will report the error, if it matters
+                    with self._cond:
+                        self._token = None
+                    continue
+                self._store(board, scores)
+
+            with self._cond:
+                self._token = None
+                if token is not None:
+                    self.pondered += 1
+                if expand and generation == self._generation:
+                    self._expand(board, scores)
@@ -0,0 +1,274 @@
+''' Persistent position cache: canonical board_t -> per-move search scores.
+
+Boards that differ only by one of the 8 symmetries of the square search identically (with the
+moves permuted), so each position is stored once under its canonical form, the smallest of its
+8 symmetric board_t values, with the scores permuted to match.
+
+File layout (all little-endian):
+
+    header   MAGIC, version (u16), scoring revision (u16), engine tag (4 bytes), entry count (u64),
+             engine name (16 bytes, NUL-padded), evaluator id (20 bytes), 4 bytes padding
+    keys     entry count canonical board_t (u64), sorted ascending
+    scores   entry count x 4 float32 scores, in canonical move order
+
+The file is memory-mapped read-only, so any number of processes share one copy through the page
+cache. Lookups binary-search the key array. Caches are rebuilt by writing a new file and renaming
+it over the old one, so processes that still map the old file are unaffected.
+
+The search depth is not stored: the engine picks its depth from the board itself, so entries are
+valid for searches with the same settings, which the header records and PositionCache checks:
+
+    scoring revision  engine_scoring_revision() of the library, bumped whenever scores change
+    engine name       the search engine (2048.py --engine); the pruned engine scores non-best
+                      moves differently, for instance
+    evaluator id      SHA-1 of the n-tuple weights file the leaves were evaluated with (2048.py
+                      --weights), or all zeros for the built-in heuristic
+
+Run this module to build or extend a cache from self-play:
+
+    python poscache.py opening.cache --games 1000 --turns 40 [--engine E] [--weights W]
+'''
+
+from __future__ import print_function
+
+import hashlib
+import mmap
+import os
+import struct
+from bisect import bisect_left
+
+MAGIC = b'2048POS\0'
+VERSION = 2
+ENGINE_TAG = b'EXPM'
+ENGINES = ('expectimax', 'pruned')
+
+HEADER_STRUCT = struct.Struct('<8sHH4sQ16s20s4x')
+
+_MASK = (1 << 64) - 1
+
+def transpose(x):
+    ''' Swap rows and columns of a board_t. '''
+    a1 = x & 0xF0F00F0FF0F00F0F
+    a2 = x & 0x0000F0F00000F0F0
+    a3 = x & 0x0F0F00000F0F0000
+    a = a1 | ((a2 << 12) & _MASK) | (a3 >> 12)
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+    return b1 | (b2 >> 24) | ((b3 << 24) & _MASK)
+
+def flip_rows(x):
+    ''' Reverse the order of the rows (upside down). '''
+    x = ((x & 0x00000000FFFFFFFF) << 32) | (x >> 32)
+    return ((x & 0x0000FFFF0000FFFF) << 16) | ((x >> 16) & 0x0000FFFF0000FFFF)
+
+def flip_cols(x):
+    ''' Reverse the order of the cells in each row (mirror image). '''
+    x = ((x & 0x00FF00FF00FF00FF) << 8) | ((x >> 8) & 0x00FF00FF00FF00FF)
+    return ((x & 0x0F0F0F0F0F0F0F0F) << 4) | ((x >> 4) & 0x0F0F0F0F0F0F0F0F)
+
+# Move permutations (up, down, left, right) for each elementary symmetry.
+_TRANSPOSE_MOVES = (2, 3, 0, 1)
+_FLIP_ROWS_MOVES = (1, 0, 2, 3)
+_FLIP_COLS_MOVES = (0, 1, 3, 2)
+
+def symmetries(board):
+    ''' Yield (board', moves) for the 8 symmetries of board; moves[m] is the image of move m. '''
+    moves = (0, 1, 2, 3)
+    for t in range(2):
+        if t:
+            board = transpose(board)
+            moves = tuple(_TRANSPOSE_MOVES[m] for m in moves)
+        for h in range(2):
+            b1, m1 = board, moves
+            if h:
+                b1 = flip_cols(b1)
+                m1 = tuple(_FLIP_COLS_MOVES[m] for m in m1)
+            yield b1, m1
+            yield flip_rows(b1), tuple(_FLIP_ROWS_MOVES[m] for m in m1)
+
+def canonical(board):
+    ''' Return (canonical board, moves) where moves[m] is the canonical image of move m. '''
+    return min(symmetries(board))
+
+def evaluator_id(weights=None):
+    ''' Identity of the leaf evaluator: SHA-1 of the n-tuple weights file, or zeros for the heuristic. '''
+    if weights is None:
+        return b'\0' * 20
+    with open(weights, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+def scoring_revision():
+    from ailib import ailib
+    return ailib.engine_scoring_revision()
+
+class PositionCache(object):
+    ''' Read-only, memory-mapped view of a cache file.
+
+    Raises ValueError unless the file was built with the given search settings (engine, as in
+    2048.py --engine, and n-tuple weights file or None) and the current scoring revision. '''
+
+    def __init__(self, path, engine='expectimax', weights=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_STRUCT.size)
+            if len(header) < HEADER_STRUCT.size:
+                raise ValueError("%s is not a position cache" % path)
+            magic, version, revision, tag, count, cache_engine, cache_evaluator = HEADER_STRUCT.unpack(header)
+            if magic != MAGIC:
+                raise ValueError("%s is not a position cache" % path)
+            if version != VERSION or tag != ENGINE_TAG:
+                raise ValueError("%s has an unsupported format; rebuild it with poscache.py" % path)
+            if revision != scoring_revision():
+                raise ValueError("%s was built by an engine that scores differently; rebuild it with poscache.py" % path)
+            cache_engine = cache_engine.rstrip(b'\0').decode('ascii', 'replace')
+            if cache_engine != engine:
+                raise ValueError("%s was built with the %s engine, not %s" % (path, cache_engine, engine))
+            if cache_evaluator != evaluator_id(weights):
+                raise ValueError("%s was built with %s leaf evaluation" %
+                                 (path, "heuristic" if cache_evaluator == evaluator_id() else "other n-tuple weights"))
+            self.engine = engine
+            self.weights = weights
+            self.count = count
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if count else None
+
+        if count:
+            keys_end = HEADER_STRUCT.size + 8 * count
+            view = memoryview(self.map)
+            self.keys = view[HEADER_STRUCT.size:keys_end].cast('Q')
+            self.scores = view[keys_end:keys_end + 16 * count].cast('f')
+        else:
+            self.keys = self.scores = ()
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, board):
+        ''' Return the 4 move scores of board, or None if it isn't cached. '''
+        key, moves = canonical(board)
+        i = bisect_left(self.keys, key)
+        if i == self.count or self.keys[i] != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        s = self.scores[4 * i:4 * i + 4]
+        return [s[moves[m]] for m in range(4)]
+
+    def items(self):
+        ''' Iterate over (canonical board, canonical scores). '''
+        for i in range(self.count):
+            yield self.keys[i], list(self.scores[4 * i:4 * i + 4])
+
+    def close(self):
+        if self.map is not None:
+            self.keys = self.scores = ()
+            self.map.close()
+            self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_entries(path, engine='expectimax', weights=None):
+    ''' Read a cache file into a dict {canonical board: canonical scores}. '''
+    if not os.path.exists(path):
+        return {}
+    with PositionCache(path, engine, weights) as cache:
+        return dict(cache.items())
+
+def write_cache(path, entries, engine='expectimax', weights=None):
+    ''' Write {canonical board: canonical scores}, searched with these settings, to path, replacing it atomically. '''
+    keys = sorted(entries)
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER_STRUCT.pack(MAGIC, VERSION, scoring_revision(), ENGINE_TAG, len(keys),
+                                   engine.encode('ascii'), evaluator_id(weights)))
+        f.write(struct.pack('<%dQ' % len(keys), *keys))
+        for key in keys:
+            f.write(struct.pack('<4f', *entries[key]))
+    os.replace(tmp, path)
+
+def add_position(entries, board, scores):
+    ''' Store the move scores of board under its canonical form. '''
+    key, moves = canonical(board)
+    canon = [0.0] * 4
+    for m in range(4):
+        canon[moves[m]] = scores[m]
+    entries[key] = canon
+
+def selfplay_positions(entries, ngames, max_turns, seed=None, engine='expectimax'):
+    ''' Play the first max_turns turns of ngames games with the AI, adding every position searched.
+
+    Positions already in entries are not searched again. '''
+    from ailib import GameSimulator, score_move, endgame_candidates, score_moves_pruned
+
+    def score_moves(board):
+        candidates = endgame_candidates(board)
+        return [score_move(board, m, candidates=candidates) for m in range(4)]
+
+    search = {
+        'expectimax': score_moves,
+        'pruned': score_moves_pruned,
+    }[engine]
+    sim = GameSimulator(seed)
+    for _ in range(ngames):
+        board = sim.new_game()
+        for _ in range(max_turns):
+            key, moves = canonical(board)
+            canon = entries.get(key)
+            if canon is None:
+                scores = search(board)
+                add_position(entries, board, scores)
+            else:
+                scores = [canon[moves[m]] for m in range(4)]
+            move = max(range(4), key=lambda m: scores[m])
+            if scores[move] == 0:
+                break
+            board, _, done = sim.step(board, move)
+            if done:
+                break
+
+def record_positions(entries, path, max_turns):
+    ''' Add the searched positions of the first max_turns turns of a trajectory file (see gamerec). '''
+    import numpy as np
+    from gamerec import read_records
+    recs = read_records(path)
+    recs = recs[(recs['turn'] < max_turns) & ~np.isnan(recs['scores']).any(axis=1)]
+    for board, scores in zip(recs['board'].tolist(), recs['scores'].tolist()):
+        add_position(entries, board, scores)
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Build or extend a position cache from self-play and recorded games")
+    parser.add_argument('cache', help="Cache file to create or extend")
+    parser.add_argument('-g', '--games', help="Number of self-play games (default: 0)", type=int, default=0)
+    parser.add_argument('-t', '--turns', help="Cache positions from the first TURNS turns of each game (default: 40)", type=int, default=40)
+    parser.add_argument('-s', '--seed', help="Self-play RNG seed", type=int)
+    parser.add_argument('-r', '--records', help="Also add positions from this trajectory file (recorded with the same settings)", action='append', default=[])
+    parser.add_argument('-e', '--engine', help="Search engine, as in 2048.py --engine (default: expectimax)", default='expectimax', choices=ENGINES)
+    parser.add_argument('-W', '--weights', help="Evaluate search leaves with these n-tuple network weights, as in 2048.py --weights")
+    args = parser.parse_args(argv)
+
+    if args.weights:
+        from ailib import use_ntuple_weights
+        use_ntuple_weights(args.weights)
+    try:
+        entries = load_entries(args.cache, args.engine, args.weights)
+    except ValueError as e:
+        print("error: %s" % e)
+        return 1
+    before = len(entries)
+    for path in args.records:
+        record_positions(entries, path, args.turns)
+    if args.games:
+        selfplay_positions(entries, args.games, args.turns, args.seed, args.engine)
+    write_cache(args.cache, entries, args.engine, args.weights)
+    print("%s: %d positions (%d new)" % (args.cache, len(entries), len(entries) - before))
+
+if __name__ == '__main__':
+    import sys
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,140 @@
+''' Tests of the GUI's background search: `python -m unittest test_guictrl`.
+
+The worker never touches Tk, so these run without a display: the control is built without its
+window, with just the state the worker uses, and stand-ins for the widgets the main thread updates.
+'''
+
+import queue
+import threading
+import time
+import unittest
+
+from ailib import SearchToken, SearchCancelled
+from guictrl import GUI2048Control
+from ponder import Ponderer
+
+BOARD = 0x1234000000000000
+
+class SearchWorkerTest(unittest.TestCase):
+    def start_worker(self, ai_scores_func=None, ai_solver_func=None, ponder=True):
+        gui = object.__new__(GUI2048Control)
+        gui.ai_scores_func = ai_scores_func
+        gui.ai_solver_func = ai_solver_func
+        gui.ponderer = Ponderer(ai_scores_func) if ponder and ai_scores_func else None
+        if gui.ponderer is not None:
+            self.addCleanup(gui.ponderer.close)
+        gui._search_requests = queue.Queue()
+        gui._search_results = queue.Queue()
+        threading.Thread(target=gui._search_worker, daemon=True).start()
+        return gui
+
+    def search(self, gui, board=BOARD, token=None):
+        gui._search_requests.put((1, board, token, None))
+        generation, packed, move, scores, elapsed = gui._search_results.get(timeout=10)
+        self.assertEqual((generation, packed), (1, board))
+        return move, scores
+
+    def test_ponderer_scores(self):
+        gui = self.start_worker(lambda board, token: [1.0, 3.0, 2.0, 0.0])
+        self.assertEqual(self.search(gui), (1, [1.0, 3.0, 2.0, 0.0]))
+        # Served from the ponderer's cache the second time
+        self.assertEqual(self.search(gui), (1, [1.0, 3.0, 2.0, 0.0]))
+        self.assertEqual(gui.ponderer.stats()['hits'], 1)
+
+    def test_ponderer_no_move(self):
+        gui = self.start_worker(lambda board, token: [0.0] * 4)
+        self.assertEqual(self.search(gui), (-1, [0.0] * 4))
+
+    def test_scores_without_ponderer(self):
+        gui = self.start_worker(lambda board, token: [0.0, 0.0, 5.0, 4.0], ponder=False)
+        self.assertEqual(self.search(gui), (2, [0.0, 0.0, 5.0, 4.0]))
+
+    def test_solver(self):
+        gui = self.start_worker(ai_solver_func=lambda board, token: 3)
+        self.assertEqual(self.search(gui), (3, None))
+
+    def test_error_is_reported(self):
+        def fail(board, token):
+            raise ValueError("no engine")
+        gui = self.start_worker(fail)
+        move, scores = self.search(gui)
+        self.assertIsInstance(move, ValueError)
+
+    def test_cancelled_search_is_dropped(self):
+        def score(board, token):
+            if board == BOARD:
+                raise SearchCancelled()
+            return [0.0, 1.0, 0.0, 0.0]
+        gui = self.start_worker(score)
+        gui._search_requests.put((1, BOARD, SearchToken(), None))
+        # No result for the cancelled search, and the worker serves the next request
+        self.assertEqual(self.search(gui, BOARD + 1), (1, [0.0, 1.0, 0.0, 0.0]))
+        self.assertTrue(gui._search_results.empty())
+
+class Widget(object):
+    ''' Stand-in for a Tk widget or window. '''
+    def configure(self, **options):
+        self.options = options
+
+    def after(self, ms, func):
+        return None
+
+class StopAutoplayTest(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.scored = threading.Event()
+
+        def score(board, token, progress=None):
+            # Finish regardless of the token, as a search completing just as it is stopped
+            self.release.wait(10)
+            self.scored.set()
+            return [0.0, 0.0, 1.0, 0.0]
+
+        gui = object.__new__(GUI2048Control)
+        gui.ai_scores_func = score
+        gui.ai_solver_func = None
+        gui.ponderer = None
+        gui.window = gui.autoplay_button = gui.last_move_label = Widget()
+        gui.board = [[2, 4, 0, 0], [0] * 4, [0] * 4, [0] * 4]
+        gui._search_requests = queue.Queue()
+        gui._search_results = queue.Queue()
+        gui._search_generation = 0
+        gui._search_pending = False
+        gui._search_token = None
+        gui._search_progress = None
+        gui._record_game = None
+        gui.applied = []
+        gui._apply_ai_move = lambda move, elapsed=0.0: gui.applied.append(move)
+        threading.Thread(target=gui._search_worker, daemon=True).start()
+        self.gui = gui
+
+    def finish_search(self):
+        self.release.set()
+        self.assertTrue(self.scored.wait(10))
+        # Let the worker post the result, then poll for it as the Tk main loop would
+        deadline = time.monotonic() + 10
+        while self.gui._search_results.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.gui._poll_search_results()
+
+    def test_stop_drops_search_in_progress(self):
+        gui = self.gui
+        gui.autoplay = True
+        gui._submit_search()
+        token = gui._search_token
+        gui._stop_autoplay()
+        self.assertFalse(gui.autoplay)
+        self.assertFalse(gui._search_pending)
+        self.assertTrue(token.cancelled)
+        self.finish_search()
+        self.assertEqual(gui.applied, [])
+
+    def test_manual_search_is_applied(self):
+        gui = self.gui
+        gui.autoplay = False
+        gui._submit_search()
+        self.finish_search()
+        self.assertEqual(gui.applied, [2])
+
+if __name__ == '__main__':
+    unittest.main()
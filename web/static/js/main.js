@@ -47,8 +47,102 @@ function isMobileDevice() {
     return /Android|webOS|iPhone|iPad|iPod|BlackBerry|IEMobile|Opera Mini/i.test(navigator.userAgent);
 }
 
+// 服务器推送通道（Server-Sent Events），连接后状态变化由服务器主动推送
+let eventSource = null;
+let pushConnected = false;
+
+// 连接推送通道；浏览器不支持时退回到定期轮询
+function connectEvents() {
+    if (!window.EventSource) {
+        setInterval(updateGameStateWithoutAI, 1000);
+        return;
+    }
+    eventSource = new EventSource('/api/events');
+    eventSource.onopen = () => {
+        pushConnected = true;
+    };
+    eventSource.onmessage = (e) => {
+        applyStateDelta(JSON.parse(e.data));
+    };
+    eventSource.onerror = () => {
+        // EventSource会自动重连，断开期间通过请求获取状态
+        pushConnected = false;
+    };
+}
+
+// 应用推送的状态变化（只包含发生变化的字段）
+function applyStateDelta(delta) {
+    if ('score' in delta) {
+        document.getElementById('score').textContent = delta.score;
+    }
+    if ('last_move' in delta) {
+        document.getElementById('status').textContent = delta.last_move;
+    }
+    if ('board' in delta) {
+        updateBoard(boardFromPacked(delta.board));
+    }
+    if ('autoplay' in delta) {
+        updateAutoplay(delta.autoplay);
+    }
+}
+
+// 服务器端自动运行的当前状态（running / paused / stopped）
+let autoplayState = 'stopped';
+
+// 更新自动运行按钮和速度统计
+function updateAutoplay(autoplay) {
+    autoplayState = autoplay ? autoplay.state : 'stopped';
+    const button = document.getElementById('autoplay-btn');
+    const stats = document.getElementById('autoplay-stats');
+    if (autoplayState === 'running') {
+        button.textContent = '暂停';
+    } else if (autoplayState === 'paused') {
+        button.textContent = '继续';
+    } else {
+        button.textContent = '自动运行';
+    }
+    stats.textContent = autoplay ? `${autoplay.moves}步, ${autoplay.moves_per_sec}步/秒` : '';
+}
+
+// 切换服务器端自动运行
+function toggleAutoplay() {
+    const action = {running: 'pause', paused: 'resume', stopped: 'start'}[autoplayState];
+    const rate = parseFloat(document.getElementById('autoplay-rate').value);
+    fetch('/api/autoplay', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ action, rate }),
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.status === 'error') {
+            alert(data.message);
+        } else {
+            updateAutoplay(data.autoplay);
+        }
+    });
+}
+
+// 将16位十六进制的board_t转换为4x4数值棋盘（第0个格子在最低位）
+function boardFromPacked(hex) {
+    const board = [];
+    for (let i = 0; i < 4; i++) {
+        const row = [];
+        for (let j = 0; j < 4; j++) {
+            const rank = parseInt(hex[15 - (i * 4 + j)], 16);
+            row.push(rank === 0 ? 0 : 1 << rank);
+        }
+        board.push(row);
+    }
+    return board;
+}
+
 // 更新游戏状态 - 修改此函数以处理手动编辑模式
 function updateGameState() {
+    if (pushConnected) {
+        // 状态变化会通过推送通道到达
+        return;
+    }
     fetch('/api/get_state')
         .then(response => response.json())
         .then(data => {
@@ -65,6 +159,9 @@ function updateGameState() {
 
 // 仅更新游戏状态UI，不执行AI移动
 function updateGameStateWithoutAI() {
+    if (pushConnected) {
+        return;
+    }
     fetch('/api/get_state')
         .then(response => response.json())
         .then(data => {
@@ -179,9 +276,21 @@ function aiMove() {
         headers: {
             'Content-Type': 'application/json',
         },
+        body: JSON.stringify({}),
     })
-    .then(response => response.json())
-    .then(data => {
+    .then(handleAIResponse);
+}
+
+// 处理AI请求的响应：429表示服务器繁忙，202表示结果尚未完成需要轮询
+function handleAIResponse(response) {
+    if (response.status === 429) {
+        alert('服务器繁忙，请稍后再试');
+        return;
+    }
+    return response.json().then(data => {
+        if (data.status === 'pending') {
+            return fetch(`/api/ai_job/${data.job_id}?wait=5`).then(handleAIResponse);
+        }
         if (data.status === 'error') {
             alert(data.message);
         }
@@ -256,6 +365,7 @@ document.addEventListener('DOMContentLoaded', () => {
     document.getElementById('ai-move-btn').addEventListener('click', aiMove);
     document.getElementById('clear-board-btn').addEventListener('click', clearBoard);
     document.getElementById('random-board-btn').addEventListener('click', randomBoard);
+    document.getElementById('autoplay-btn').addEventListener('click', toggleAutoplay);
     
     // 添加方向按钮事件处理
     document.getElementById('dir-up')?.addEventListener('click', () => {
@@ -324,6 +434,6 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
     
-    // 设置定期更新游戏状态，但不触发AI
-    setInterval(updateGameStateWithoutAI, 1000);
+    // 通过推送通道接收状态更新，代替定期轮询
+    connectEvents();
 });
@@ -1,100 +1,627 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request, session
 import numpy as np
 import json
+import math
 import os
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 import webbrowser
-from ailib import to_c_board, from_c_board, from_c_index, ailib
+from ailib import to_c_board, from_c_board, from_c_board_values, RANK_OF, GameSimulator, ailib, score_move, endgame_candidates, \
+    SearchToken, SearchCancelled, SearchProgress, score_moves_deepening
+from gamerec import find_spawn
+from latency import MoveProfiler
+from ponder import Ponderer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 app = Flask(__name__, 
            static_folder='web/static',
            template_folder='web/templates')
+# 会话cookie签名密钥；多进程部署时应通过环境变量提供固定值
+app.secret_key = os.environ.get('WEB2048_SECRET_KEY') or os.urandom(24)
+
+# 会话空闲多久后被回收（秒）
+SESSION_IDLE_TIMEOUT = 30 * 60
+# 两次空闲会话清理之间的最短间隔（秒）
+SESSION_SWEEP_INTERVAL = 60
+
+# AI搜索线程数，以及在此之外允许排队等待的最大请求数
+SEARCH_WORKERS = 2
+SEARCH_QUEUE_LIMIT = 8
+# AI请求的默认截止时间与允许的最大截止时间（秒）
+SEARCH_DEADLINE = 30.0
+SEARCH_DEADLINE_MAX = 120.0
+# 已完成的AI任务结果保留多久以供轮询（秒）
+JOB_RESULT_TTL = 60
+# 相同局面的搜索结果缓存多久（秒），以及最多缓存多少个局面
+SEARCH_RESULT_TTL = 10.0
+SEARCH_RESULT_CACHE_SIZE = 1024
+# 推送通道在没有状态变化时发送保活注释的间隔（秒）
+EVENT_KEEPALIVE = 15
+# 流式分析推送搜索进度的间隔（秒）
+ANALYZE_PROGRESS_INTERVAL = 0.1
+# 同时运行的服务器端自动运行会话数上限
+AUTOPLAY_MAX_SESSIONS = 2
+# 自动运行的最大速度（步/秒）；0表示不限速
+AUTOPLAY_MAX_RATE = 1000
 
-# 全局游戏状态
-game_state = {
-    "board": [[0 for _ in range(4)] for _ in range(4)],
-    "score": 0,
-    "last_move": "等待操作",
-    "manual_edit": False  # 新增标记，指示是否正在手动编辑
-}
+# 紧凑API格式：棋盘直接以board_t传递
+# binary格式的状态：board(u64) score(u32) version(u32)，小端
+STATE_STRUCT = struct.Struct('<QII')
+# binary格式的分析结果：board(u64) move(i8) 四个方向的分数(f32)，小端
+ANALYSIS_STRUCT = struct.Struct('<Qb4f')
+BINARY_MIMETYPE = 'application/octet-stream'
+MSGPACK_MIMETYPE = 'application/msgpack'
 
 # 游戏控制器实例，将在主程序中初始化
 game_controller = None
 
+def value_to_rank(value):
+    """将方块数值转换为对数值，非法数值返回None"""
+    return RANK_OF.get(value)
+
+class GameSession:
+    """单个玩家的游戏状态，棋盘以board_t打包形式保存
+    
+    所有字段的读写都必须持有self.lock。"""
+    
+    def __init__(self, sid):
+        self.sid = sid
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(self.lock)  # 状态变化时通知推送通道
+        self.board = 0
+        self.score = 0
+        self.last_move = "等待操作"
+        self.manual_edit = False  # 标记是否正在手动编辑
+        self.version = 0  # 每次状态变化递增，用于检测并发修改
+        self.autoplay = None  # 服务器端自动运行（AutoplayRunner）
+        self.sim = GameSimulator()  # 本会话的游戏核心（独立的随机数发生器）
+        self.search_tokens = set()  # 依赖当前状态的搜索，状态变化时取消
+        self.last_access = time.monotonic()
+    
+    def touch(self):
+        self.last_access = time.monotonic()
+    
+    def changed(self):
+        """记录一次状态变化并唤醒推送通道（调用者需持有self.lock）
+        
+        基于旧状态的搜索结果会被丢弃，因此同时取消这些搜索。"""
+        self.version += 1
+        for token in self.search_tokens:
+            token.cancel()
+        self.search_tokens.clear()
+        self.cond.notify_all()
+    
+    def close(self):
+        """会话被回收时停止其自动运行"""
+        with self.lock:
+            if self.autoplay:
+                self.autoplay.stop()
+    
+    def push_state(self):
+        """返回推送通道使用的状态（棋盘为16位十六进制的board_t）"""
+        with self.lock:
+            return {
+                "version": self.version,
+                "board": "%016x" % self.board,
+                "score": self.score,
+                "last_move": self.last_move,
+                "autoplay": self.autoplay.status() if self.autoplay else None,
+            }
+    
+    def to_dict(self):
+        """返回前端使用的状态（棋盘为4x4原始数值）"""
+        with self.lock:
+            return {
+                "board": from_c_board_values(self.board),
+                "score": self.score,
+                "last_move": self.last_move,
+                "manual_edit": self.manual_edit,
+            }
+
+class SessionStore:
+    """按会话ID保存游戏状态，并回收长时间不活动的会话"""
+    
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+    
+    def get(self, sid):
+        """返回会话ID对应的游戏状态，不存在时创建"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep > SESSION_SWEEP_INTERVAL:
+                self._evict_idle(now)
+            sess = self._sessions.get(sid)
+            if sess is None:
+                sess = self._sessions[sid] = GameSession(sid)
+        sess.touch()
+        return sess
+    
+    def _evict_idle(self, now):
+        self._last_sweep = now
+        expired = [sid for sid, sess in self._sessions.items()
+                   if now - sess.last_access > self.idle_timeout]
+        for sid in expired:
+            self._sessions.pop(sid).close()
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+class SearchQueueFull(Exception):
+    """AI搜索队列已满"""
+
+class SearchJob:
+    """一次提交到SearchPool的AI搜索任务
+    
+    token在截止时间到达时自动取消，任务应将其传给搜索函数。"""
+    
+    def __init__(self, sid, fn, deadline):
+        self.id = uuid.uuid4().hex
+        self.sid = sid
+        self.fn = fn
+        self.deadline = deadline
+        self.token = SearchToken(deadline - time.monotonic())
+        self.status = "pending"  # pending -> running -> done / expired / error
+        self.result = None
+        self.finished_at = None
+        self.done = threading.Event()
+    
+    def expired(self):
+        return time.monotonic() > self.deadline
+    
+    def finish(self, status, result):
+        self.status = status
+        self.result = result
+        self.finished_at = time.monotonic()
+        self.done.set()
+
+class SearchPool:
+    """有界的AI搜索线程池
+    
+    同时运行的搜索不超过workers个，排队的请求不超过queue_limit个；
+    队列已满时submit抛出SearchQueueFull，由调用者返回429。"""
+    
+    def __init__(self, workers=SEARCH_WORKERS, queue_limit=SEARCH_QUEUE_LIMIT):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ai-search')
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+        self._jobs = {}
+        self._lock = threading.Lock()
+    
+    def submit(self, sid, fn, timeout=SEARCH_DEADLINE):
+        """提交任务fn(job)，其返回值作为任务结果"""
+        if not self._slots.acquire(blocking=False):
+            raise SearchQueueFull()
+        job = SearchJob(sid, fn, time.monotonic() + timeout)
+        with self._lock:
+            self._purge_finished()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job)
+        return job
+    
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def _purge_finished(self):
+        now = time.monotonic()
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job.finished_at is not None and now - job.finished_at > JOB_RESULT_TTL]
+        for job_id in finished:
+            del self._jobs[job_id]
+    
+    def _run(self, job):
+        try:
+            if job.expired():
+                # 排队时间超过截止时间，不再搜索
+                job.finish("expired", {"status": "error", "message": "AI请求已超时"})
+                return
+            job.status = "running"
+            try:
+                result = job.fn(job)
+            except SearchCancelled:
+                job.finish("expired", {"status": "error", "message": "AI请求已超时"})
+                return
+            if job.expired():
+                job.finish("expired", {"status": "error", "message": "AI请求已超时"})
+            else:
+                job.finish("done", result)
+        except Exception as e:
+            job.finish("error", {"status": "error", "message": f"搜索失败: {e}"})
+        finally:
+            self._slots.release()
+
+class _SearchFlight:
+    """一次正在进行、可被多个请求共用的搜索"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.scores = None
+        self.error = None
+
+class SearchCoalescer:
+    """合并相同的AI搜索
+    
+    以(board_t, 搜索设置)为键：同一键的并发请求共用一次正在进行的搜索，
+    完成的结果在ttl秒内直接返回。settings_func()返回当前的搜索设置（可哈希）。
+    
+    搜索使用第一个请求的token；该请求被取消时，仍在等待的请求会重新搜索。"""
+    
+    # 等待其他请求的搜索时检查自身token的间隔（秒）
+    WAIT_POLL = 0.02
+    
+    def __init__(self, score_func, settings_func=None, ttl=SEARCH_RESULT_TTL, capacity=SEARCH_RESULT_CACHE_SIZE):
+        self.score_func = score_func
+        self.settings_func = settings_func or (lambda: None)
+        self.ttl = ttl
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._flights = {}  # 键 -> _SearchFlight
+        self._results = OrderedDict()  # 键 -> (过期时间, 分数)，按过期时间排序
+        self.hits = 0  # 直接返回缓存结果
+        self.coalesced = 0  # 共用了其他请求的搜索
+        self.searches = 0  # 实际进行的搜索
+    
+    def scores(self, board, token=None):
+        """返回board_t上四个方向的分数；token被取消时抛出SearchCancelled"""
+        key = (board, self.settings_func())
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                entry = self._results.get(key)
+                if entry is not None and entry[0] > now:
+                    self.hits += 1
+                    return list(entry[1])
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _SearchFlight()
+                    self.searches += 1
+                else:
+                    self.coalesced += 1
+            if leader:
+                return self._search(key, flight, board, token)
+            
+            while not flight.done.wait(self.WAIT_POLL):
+                if token is not None and token.cancelled:
+                    raise SearchCancelled()
+            if flight.scores is not None:
+                return list(flight.scores)
+            if not isinstance(flight.error, SearchCancelled):
+                raise flight.error
+            # 发起搜索的请求被取消了
+            if token is not None and token.cancelled:
+                raise SearchCancelled()
+    
+    def _search(self, key, flight, board, token):
+        try:
+            flight.scores = list(self.score_func(board, token))
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.scores is not None:
+                    self._store(key, flight.scores)
+            flight.done.set()
+        return list(flight.scores)
+    
+    def _store(self, key, scores):
+        """缓存结果并清除过期或超出容量的条目（调用者需持有self._lock）"""
+        now = time.monotonic()
+        self._results.pop(key, None)
+        self._results[key] = (now + self.ttl, scores)
+        while self._results:
+            oldest_key, (expires, _) = next(iter(self._results.items()))
+            if expires > now and len(self._results) <= self.capacity:
+                break
+            del self._results[oldest_key]
+    
+    def stats(self):
+        with self._lock:
+            return {"cached": len(self._results), "in_flight": len(self._flights),
+                    "hits": self.hits, "coalesced": self.coalesced, "searches": self.searches}
+
+class AutoplayRunner:
+    """服务器端自动运行：在后台线程中连续执行AI移动并生成新方块
+    
+    rate为每秒步数，0表示以引擎允许的最快速度运行。"""
+    
+    def __init__(self, controller, sess, rate=0):
+        self.controller = controller
+        self.session = sess
+        self.rate = rate
+        self.state = "running"  # running / paused / stopped
+        self.moves = 0
+        self.active_time = 0.0  # 处于运行状态的累计时间，用于计算步/秒
+        self._wake = threading.Condition()
+        self._thread = Thread(target=self._run, daemon=True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def _set_state(self, state):
+        with self._wake:
+            if self.state != "stopped":
+                self.state = state
+            self._wake.notify_all()
+        with self.session.lock:
+            self.session.changed()
+    
+    def pause(self):
+        self._set_state("paused")
+    
+    def resume(self):
+        self._set_state("running")
+    
+    def stop(self):
+        self._set_state("stopped")
+    
+    def set_rate(self, rate):
+        with self._wake:
+            self.rate = rate
+            self._wake.notify_all()
+    
+    def status(self):
+        return {
+            "state": self.state,
+            "rate": self.rate,
+            "moves": self.moves,
+            "moves_per_sec": round(self.moves / self.active_time, 1) if self.active_time else 0.0,
+        }
+    
+    def _run(self):
+        sess = self.session
+        recorder = self.controller.recorder
+        if recorder is not None:
+            game = recorder.new_game()
+            expected = None  # 上一步移动后、生成新方块前的棋盘
+        while True:
+            with self._wake:
+                self._wake.wait_for(lambda: self.state != "paused")
+                if self.state == "stopped":
+                    break
+            
+            start = time.monotonic()
+            token = SearchToken()
+            with sess.lock:
+                board = sess.board
+                sess.search_tokens.add(token)
+            try:
+                move, scores = self.controller.search(board, token, cached=False)
+            except SearchCancelled:
+                # 暂停/停止或修改棋盘时取消
+                continue
+            finally:
+                with sess.lock:
+                    sess.search_tokens.discard(token)
+            search_time = time.monotonic() - start
+            
+            with sess.lock:
+                if self.state != "running" or sess.board != board:
+                    # 搜索期间被暂停/停止或棋盘被修改，丢弃本次结果
+                    continue
+                if move < 0:
+                    sess.last_move = "游戏结束"
+                    self.state = "stopped"
+                    sess.changed()
+                    break
+                if recorder is not None:
+                    spawn = find_spawn(expected, board) if expected is not None else None
+                    recorder.record(game, self.moves, board, move, scores, search_time, spawn)
+                    expected = GameSimulator.move(board, move)[0]
+                execute_start = time.monotonic()
+                self.controller.execute_move(sess, move, spawn=True)
+                execute_time = time.monotonic() - execute_start
+                self.controller.profiler.record({"search": search_time, "execute": execute_time,
+                                                 "total": execute_start + execute_time - start})
+                self.moves += 1
+                sess.touch()
+                if not GameSimulator.legal_moves(sess.board):
+                    sess.last_move = "游戏结束"
+                    self.state = "stopped"
+                    sess.changed()
+            
+            with self._wake:
+                if self.rate:
+                    # 限速：等待到下一步的时间点，期间可被暂停/停止唤醒
+                    delay = start + 1.0 / self.rate - time.monotonic()
+                    if delay > 0:
+                        self._wake.wait(delay)
+                self.active_time += time.monotonic() - start
+        
+        with self.controller.autoplay_lock:
+            self.controller.autoplay_count -= 1
+
 class WebGameControl:
-    """为主程序提供的Web游戏控制接口"""
+    """为主程序提供的Web游戏控制接口
+    
+    每个浏览器会话拥有独立的游戏状态，操作状态的方法都以GameSession为参数。"""
     
-    def __init__(self, ai_solver_func):
+    def __init__(self, ai_solver_func, ai_scores_func=None, recorder=None, search_settings=None):
         self.ai_solver_func = ai_solver_func
+        # ai_scores_func(board)返回board_t四个方向的分数，未提供时逐个调用C接口
+        self.ai_scores_func = ai_scores_func
+        # 可选的对局记录器（gamerec.GameRecorder），记录服务器端自动运行的每一步
+        self.recorder = recorder
         from ailib import ailib
         self.ailib = ailib
+        self.sessions = SessionStore()
+        self.search_pool = SearchPool()
+        self.autoplay_lock = threading.Lock()
+        self.autoplay_count = 0
+        # AI移动（包括自动运行）各阶段的耗时统计，由/metrics导出
+        self.profiler = MoveProfiler('game2048_web')
+        # 用户思考时在后台预先搜索接下来可能的局面（所有会话共用，最近一次请求优先）
+        self.ponderer = Ponderer(ai_scores_func) if ai_scores_func else None
+        # 合并各会话对相同局面的搜索；search_settings()返回影响搜索结果的设置
+        self.coalescer = SearchCoalescer(self._score_moves, search_settings)
     
     def get_status(self):
         """始终返回'running'状态以保持游戏进行"""
         return 'running'
     
-    def get_score(self):
+    def get_score(self, sess):
         """获取当前分数"""
-        return game_state["score"]
+        with sess.lock:
+            return sess.score
     
-    def get_board(self):
+    def get_board(self, sess):
         """获取当前棋盘状态，返回对数形式的棋盘"""
-        board = game_state["board"]
-        # 直接返回棋盘的对数形式
-        return [[int(np.log2(max(tile, 1))) for tile in row] for row in board]
-    
-    def execute_move(self, move):
-        """使用C接口执行移动"""
-        # 重置手动编辑标记
-        game_state["manual_edit"] = False
-        
-        # 将当前棋盘转换为C接口可用格式
-        c_board = to_c_board(self.get_board())
-        # 使用C接口执行移动
-        new_c_board = self.ailib.execute_move(move, c_board)
-        # 将结果转换回Python格式
-        new_board = from_c_board(new_c_board)
-        
-        # 检查棋盘是否有变化
-        board_changed = False
-        orig_board = self.get_board()
-        for i in range(4):
-            for j in range(4):
-                if new_board[i][j] != orig_board[i][j]:
-                    board_changed = True
-                    break
-            if board_changed:
-                break
+        with sess.lock:
+            return from_c_board(sess.board)
+    
+    def execute_move(self, sess, move, spawn=False):
+        """使用C接口执行移动，返回棋盘是否发生变化
         
-        if board_changed:
-            # 更新棋盘
-            for i in range(4):
-                for j in range(4):
-                    if new_board[i][j] > 0:
-                        game_state["board"][i][j] = 2 ** new_board[i][j]
-                    else:
-                        game_state["board"][i][j] = 0
+        spawn为True时在移动后随机生成新方块（完整的游戏流程）。"""
+        with sess.lock:
+            # 重置手动编辑标记
+            sess.manual_edit = False
             
-            # 添加新方块
-            # self._add_new_tile()
+            c_board = sess.board
+            new_c_board, score_increase = GameSimulator.move(c_board, move)
+            if new_c_board == c_board:
+                return False
             
-            # 计算得分差异并更新分数
-            score_increase = 0
-            for i in range(4):
-                for j in range(4):
-                    if new_board[i][j] > orig_board[i][j] and orig_board[i][j] > 0:
-                        # 有合并发生
-                        score_increase += 2 ** new_board[i][j]
+            if spawn:
+                # 添加新方块
+                new_c_board = sess.sim.spawn(new_c_board)
             
-            game_state["score"] += score_increase
+            sess.board = new_c_board
+            sess.score += score_increase
             
             # 更新最后一步
             move_names = ['上移', '下移', '左移', '右移']
-            game_state["last_move"] = f"上一步: {move_names[move]}"
+            sess.last_move = f"上一步: {move_names[move]}"
+            sess.changed()
+            return True
+    
+    def _ai_move_job(self, sess):
+        """返回在搜索线程中执行的AI移动任务"""
+        with sess.lock:
+            # 重置手动编辑标记
+            sess.manual_edit = False
+            board = sess.board
+            version = sess.version
+        
+        def run(job):
+            with sess.lock:
+                if sess.version != version:
+                    return {"status": "error", "message": "搜索期间棋盘已被修改"}
+                # 棋盘被修改时取消搜索
+                sess.search_tokens.add(job.token)
+            with self.profiler.move() as timing:
+                # 搜索期间不持有会话锁，其他请求仍可访问该会话
+                try:
+                    with timing.phase('search'):
+                        move, _ = self.search(board, job.token)
+                except SearchCancelled:
+                    timing.cancel()
+                    with sess.lock:
+                        if sess.version != version:
+                            return {"status": "error", "message": "搜索期间棋盘已被修改"}
+                    return {"status": "error", "message": "AI请求已超时"}
+                finally:
+                    with sess.lock:
+                        sess.search_tokens.discard(job.token)
+                if move < 0:
+                    timing.cancel()
+                    return {"status": "error", "message": "当前局面没有可行的移动"}
+                with sess.lock:
+                    if sess.version != version or job.expired():
+                        timing.cancel()
+                        if sess.version != version:
+                            return {"status": "error", "message": "搜索期间棋盘已被修改"}
+                        return {"status": "error", "message": "AI请求已超时"}
+                    # 执行移动
+                    with timing.phase('execute'):
+                        self.execute_move(sess, move)
+            self.ponder(sess, spawn_pending=True)
+            return {"status": "success", "move": move}
+        return run
+    
+    def search(self, board, token=None, cached=True):
+        """搜索board_t的最佳移动，返回(移动, 四个方向的分数)；无法得到分数时分数为None
+        
+        token（SearchToken）被取消时抛出SearchCancelled。cached为False时直接搜索，不经过
+        预先搜索和合并请求的缓存（自动运行的局面不会重复出现，不应占用缓存）。"""
+        if self.ai_scores_func:
+            if cached:
+                scores = self.coalescer.scores(board, token)
+            else:
+                scores = list(self.ai_scores_func(board, token))
+            best = max(range(4), key=lambda move: scores[move])
+            return (best if scores[best] > 0 else -1), scores
+        return self.ai_solver_func(board, token), None
+    
+    def score_moves(self, board, token=None):
+        """返回board_t上四个方向的分数，无法移动的方向为0（相同的并发请求共用一次搜索）"""
+        return self.coalescer.scores(board, token)
+    
+    def score_moves_progress(self, board, token, progress):
+        """与score_moves相同，但把逐层加深的进度报告给progress（SearchProgress）
+        
+        不经过合并请求的缓存，以便每个请求都能收到进度。token到期时返回已完成的最深一层的分数。"""
+        if self.ponderer is not None:
+            return self.ponderer.scores(board, token, progress)
+        if self.ai_scores_func:
+            return list(self.ai_scores_func(board, token, progress))
+        return score_moves_deepening(board, 0, progress, token)
     
-    def restart_game(self):
+    def _score_moves(self, board, token=None):
+        if self.ponderer is not None:
+            return self.ponderer.scores(board, token)
+        if self.ai_scores_func:
+            return list(self.ai_scores_func(board, token))
+        candidates = endgame_candidates(board)
+        return [score_move(board, move, token=token, candidates=candidates) for move in range(4)]
+    
+    def ponder(self, sess, spawn_pending=False):
+        """从会话的当前局面开始预先搜索；会话正在自动运行时不搜索
+        
+        spawn_pending为True表示刚执行了移动，用户接下来会放置新方块。"""
+        if self.ponderer is None:
+            return
+        with sess.lock:
+            if sess.autoplay and sess.autoplay.state == "running":
+                return
+            board = sess.board
+        if board:
+            self.ponderer.ponder(board, spawn_pending)
+    
+    def start_autoplay(self, sess, rate=0):
+        """为会话启动服务器端自动运行，超过并发上限时返回None"""
+        with sess.lock:
+            if sess.autoplay and sess.autoplay.state != "stopped":
+                sess.autoplay.set_rate(rate)
+                sess.autoplay.resume()
+                return sess.autoplay
+            with self.autoplay_lock:
+                if self.autoplay_count >= AUTOPLAY_MAX_SESSIONS:
+                    return None
+                self.autoplay_count += 1
+            sess.autoplay = AutoplayRunner(self, sess, rate)
+            sess.manual_edit = False
+            sess.changed()
+        sess.autoplay.start()
+        return sess.autoplay
+    
+    def restart_game(self, sess):
         """重新开始游戏"""
-        self._clear_board()
+        self._clear_board(sess)
     
     def continue_game(self):
         """继续游戏"""
@@ -110,7 +637,7 @@ class WebGameControl:
         
         # 在新线程中启动Flask服务器
         def run_server():
-            app.run(host='0.0.0.0', port=port, debug=False)  # 使用0.0.0.0允许外部设备访问
+            app.run(host='0.0.0.0', port=port, debug=False, threaded=True)  # 使用0.0.0.0允许外部设备访问
         
         server_thread = Thread(target=run_server)
         server_thread.daemon = True
@@ -133,7 +660,6 @@ class WebGameControl:
         # 保持主线程运行
         try:
             while True:
-                import time
                 time.sleep(1)
         except KeyboardInterrupt:
             print("Web服务器已关闭")
@@ -148,23 +674,99 @@ class WebGameControl:
         for dir_path in dirs:
             os.makedirs(dir_path, exist_ok=True)
     
-    def _clear_board(self):
+    def _clear_board(self, sess):
         """清空棋盘"""
-        game_state["board"] = [[0 for _ in range(4)] for _ in range(4)]
-        game_state["score"] = 0
-        game_state["last_move"] = "等待操作"
-        game_state["manual_edit"] = False  # 重置手动编辑标记
-    
-    def _add_new_tile(self):
-        """在随机空位添加一个新的2或4方块"""
-        # 找到所有空位
-        empty_cells = [(i, j) for i in range(4) for j in range(4) if game_state["board"][i][j] == 0]
+        with sess.lock:
+            sess.board = 0
+            sess.score = 0
+            sess.last_move = "等待操作"
+            sess.manual_edit = False  # 重置手动编辑标记
+            sess.changed()
+    
+    def _random_board(self, sess):
+        """生成随机棋盘"""
+        # 放置8-12个非零方块
+        num_tiles = np.random.randint(8, 13)
+        positions = np.random.permutation(16)[:num_tiles]
+        board = 0
+        for pos in positions:
+            # 生成2的幂次方（2到2048）
+            power = np.random.randint(1, 11)  # 1到10之间的随机数
+            board |= int(power) << (4 * int(pos))
         
-        if empty_cells:
-            # 随机选择一个空位
-            i, j = empty_cells[np.random.randint(0, len(empty_cells))]
-            # 90%概率为2，10%概率为4
-            game_state["board"][i][j] = 2 if np.random.random() < 0.9 else 4
+        with sess.lock:
+            sess.board = board
+            sess.score = 0
+            # 重置手动编辑标记
+            sess.manual_edit = False
+            sess.last_move = "随机棋盘"
+            sess.changed()
+    
+def response_format():
+    """返回请求的API格式: json（默认，4x4数值）、packed、binary或msgpack"""
+    fmt = request.args.get('format')
+    if fmt is None:
+        best = request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE, MSGPACK_MIMETYPE])
+        fmt = {BINARY_MIMETYPE: 'binary', MSGPACK_MIMETYPE: 'msgpack'}.get(best, 'json')
+    if fmt == 'msgpack' and msgpack is None:
+        fmt = 'packed'
+    return fmt
+
+def packed_response(obj, encode_binary=None):
+    """按请求的格式编码包含board_t的结果；encode_binary(obj)返回binary格式的字节串"""
+    fmt = response_format()
+    if fmt == 'binary' and encode_binary is not None:
+        return Response(encode_binary(obj), mimetype=BINARY_MIMETYPE)
+    if fmt == 'msgpack':
+        return Response(msgpack.packb(obj), mimetype=MSGPACK_MIMETYPE)
+    # JSON中的整数超过2^53会丢失精度，board以十六进制字符串传递
+    obj = dict(obj, board="%016x" % obj["board"])
+    return jsonify(obj)
+
+def request_board():
+    """从请求中读取board_t：8字节小端二进制、msgpack，或JSON中的十六进制字符串/整数"""
+    if request.mimetype == BINARY_MIMETYPE:
+        body = request.get_data()
+        if len(body) != 8:
+            raise ValueError("binary board must be 8 bytes")
+        return int.from_bytes(body, 'little')
+    if request.mimetype == MSGPACK_MIMETYPE and msgpack is not None:
+        data = msgpack.unpackb(request.get_data())
+    else:
+        data = request.get_json(silent=True) or {}
+    board = data.get('board')
+    if isinstance(board, str):
+        board = int(board, 16)
+    if not isinstance(board, int) or not 0 <= board < 1 << 64:
+        raise ValueError("invalid board")
+    return board
+
+def request_float(data, name, default):
+    """读取数值参数（数字或数字字符串）；缺失时返回default，非法值（包括null、NaN、无穷大）抛出ValueError"""
+    value = data.get(name, default)
+    if isinstance(value, bool):
+        raise ValueError(f"{name} must be a number")
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number")
+    if not math.isfinite(value):
+        raise ValueError(f"{name} must be finite")
+    return value
+
+def request_deadline(data):
+    """读取deadline参数（秒），必须为正数，超过SEARCH_DEADLINE_MAX时取SEARCH_DEADLINE_MAX"""
+    deadline = request_float(data, 'deadline', SEARCH_DEADLINE)
+    if deadline <= 0:
+        raise ValueError("deadline must be positive")
+    return min(deadline, SEARCH_DEADLINE_MAX)
+
+def current_session():
+    """返回当前请求所属的游戏会话"""
+    sid = session.get('sid')
+    if sid is None:
+        sid = session['sid'] = uuid.uuid4().hex
+    return game_controller.sessions.get(sid)
 
 # Flask路由
 
@@ -175,38 +777,185 @@ def index():
 
 @app.route('/api/get_state')
 def get_state():
-    """获取当前游戏状态"""
-    return jsonify(game_state)
+    """获取当前游戏状态；format=packed/binary/msgpack时棋盘为board_t"""
+    if not game_controller:
+        return jsonify({"status": "error", "message": "游戏未初始化"})
+    sess = current_session()
+    if response_format() == 'json':
+        return jsonify(sess.to_dict())
+    with sess.lock:
+        state = {"board": sess.board, "score": sess.score, "version": sess.version,
+                 "last_move": sess.last_move}
+    return packed_response(state, lambda o: STATE_STRUCT.pack(o["board"], o["score"], o["version"]))
+
+@app.route('/api/set_board', methods=['POST'])
+def set_board():
+    """以board_t设置整个棋盘"""
+    if not game_controller:
+        return jsonify({"status": "error", "message": "游戏未初始化"})
+    try:
+        board = request_board()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    sess = current_session()
+    with sess.lock:
+        sess.board = board
+        sess.manual_edit = True
+        sess.last_move = "手动编辑"
+        sess.changed()
+    game_controller.ponder(sess)
+    return jsonify({"status": "success"})
+
+@app.route('/api/analyze', methods=['POST'])
+def analyze():
+    """分析给定的board_t（不修改会话状态），返回最佳移动和四个方向的分数"""
+    if not game_controller:
+        return jsonify({"status": "error", "message": "AI未初始化"})
+    try:
+        board = request_board()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    def run(job):
+        scores = game_controller.score_moves(board, job.token)
+        if game_controller.ponderer is not None:
+            # 接下来很可能分析这个局面之后的局面
+            game_controller.ponderer.ponder(board)
+        best = max(range(4), key=lambda move: scores[move])
+        return {"status": "success", "board": board, "move": best if scores[best] > 0 else -1,
+                "scores": scores}
+    
+    try:
+        job = game_controller.search_pool.submit(current_session().sid, run)
+    except SearchQueueFull:
+        response = jsonify({"status": "error", "message": "服务器繁忙，请稍后再试"})
+        response.headers['Retry-After'] = '1'
+        return response, 429
+    job.done.wait(max(0.0, job.deadline - time.monotonic()))
+    if not job.done.is_set():
+        job.token.cancel()
+    if not job.done.is_set() or job.result.get("status") != "success":
+        return jsonify(job.result or {"status": "error", "message": "AI请求已超时"}), 504
+    return packed_response(job.result, lambda o: ANALYSIS_STRUCT.pack(o["board"], o["move"], *o["scores"]))
+
+@app.route('/api/analyze_stream', methods=['GET', 'POST'])
+def analyze_stream():
+    """以Server-Sent Events推送分析进度，客户端可以不等搜索结束就采用足够好的结果
+    
+    搜索逐层加深：progress事件报告已完成的深度、已搜索的节点数、当前最佳移动和四个方向的分数，
+    搜索结束时发送result事件（complete为False表示截止时间到达，结果来自已完成的最深一层；
+    depth为null表示结果来自缓存或搜索引擎不报告进度）。客户端断开连接时停止搜索。
+    
+    参数（GET查询参数或POST JSON）: board（十六进制board_t，缺省为会话的当前棋盘），
+    deadline（截止时间，秒）。"""
+    if not game_controller:
+        return jsonify({"status": "error", "message": "AI未初始化"})
+    sess = current_session()
+    data = request.args if request.method == 'GET' else (request.get_json(silent=True) or {})
+    try:
+        if 'board' in data:
+            board = request_board() if request.method == 'POST' else int(data['board'], 16)
+            if not 0 <= board < 1 << 64:
+                raise ValueError("invalid board")
+        else:
+            with sess.lock:
+                board = sess.board
+        deadline = request_deadline(data)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    progress = SearchProgress()
+    outcome = {}
+    
+    def run(job):
+        outcome["scores"] = game_controller.score_moves_progress(board, job.token, progress)
+        # 截止时间到达时搜索提前返回
+        outcome["complete"] = not job.token.cancelled
+        return {"status": "success"}
+    
+    try:
+        job = game_controller.search_pool.submit(sess.sid, run, deadline)
+    except SearchQueueFull:
+        response = jsonify({"status": "error", "message": "服务器繁忙，请稍后再试"})
+        response.headers['Retry-After'] = '1'
+        return response, 429
+    
+    def event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    
+    def stream():
+        start = time.monotonic()
+        last = None
+        try:
+            while True:
+                finished = job.done.wait(ANALYZE_PROGRESS_INTERVAL)
+                info = progress.read()
+                if (info["version"], info["nodes"]) != last and info["depth"] and not finished:
+                    last = (info["version"], info["nodes"])
+                    yield event("progress", {"depth": info["depth"], "nodes": info["nodes"],
+                                             "move": info["best_move"], "scores": info["scores"],
+                                             "elapsed": round(time.monotonic() - start, 3)})
+                if finished:
+                    break
+            scores = outcome.get("scores")
+            complete = outcome.get("complete", False)
+            if scores is None and info["depth"]:
+                scores = info["scores"]
+            if scores is None:
+                yield event("result", job.result or {"status": "error", "message": "AI请求已超时"})
+                return
+            best = max(range(4), key=lambda move: scores[move])
+            # 与packed_response一样，board以十六进制字符串传递，避免JSON整数超过2^53丢失精度
+            yield event("result", {"status": "success", "board": "%016x" % board, "move": best if scores[best] > 0 else -1,
+                                   "scores": scores, "depth": info["depth"] or None, "nodes": info["nodes"],
+                                   "complete": complete,
+                                   "elapsed": round(time.monotonic() - start, 3)})
+        finally:
+            # 客户端断开连接（或推送结束）时停止搜索
+            job.token.cancel()
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/events')
+def events():
+    """Server-Sent Events推送通道：状态变化时只推送发生变化的字段"""
+    if not game_controller:
+        return jsonify({"status": "error", "message": "游戏未初始化"})
+    sess = current_session()
+    
+    def stream():
+        last = {}
+        while True:
+            with sess.lock:
+                version = last.get("version")
+                if not sess.cond.wait_for(lambda: sess.version != version, timeout=EVENT_KEEPALIVE):
+                    state = None
+                else:
+                    state = sess.push_state()
+                sess.touch()
+            if state is None:
+                yield ": keepalive\n\n"
+                continue
+            delta = {k: v for k, v in state.items() if last.get(k) != v}
+            last = state
+            yield f"data: {json.dumps(delta, ensure_ascii=False)}\n\n"
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/clear_board', methods=['POST'])
 def clear_board():
     """清空棋盘"""
     if game_controller:
-        game_controller._clear_board()
+        game_controller._clear_board(current_session())
     return jsonify({"status": "success"})
 
 @app.route('/api/random_board', methods=['POST'])
 def random_board():
     """生成随机棋盘"""
     if game_controller:
-        # 清空棋盘
-        game_controller._clear_board()
-        
-        # 放置8-12个非零方块
-        num_tiles = np.random.randint(8, 13)
-        available_positions = [(i, j) for i in range(4) for j in range(4)]
-        np.random.shuffle(available_positions)
-        
-        for k in range(min(num_tiles, len(available_positions))):
-            i, j = available_positions[k]
-            # 生成2的幂次方（2到2048）
-            power = np.random.randint(1, 11)  # 1到10之间的随机数
-            game_state["board"][i][j] = 2 ** power
-        
-        # 重置手动编辑标记
-        game_state["manual_edit"] = False
-        game_state["last_move"] = "随机棋盘"
-    
+        game_controller._random_board(current_session())
     return jsonify({"status": "success"})
 
 @app.route('/api/set_cell', methods=['POST'])
@@ -214,55 +963,136 @@ def set_cell():
     """设置特定单元格的值"""
     data = request.json
     i, j, value = data['row'], data['col'], data['value']
+    rank = value_to_rank(value)
     
-    # 确保索引在有效范围内
-    if 0 <= i < 4 and 0 <= j < 4:
-        # 设置手动编辑标记
-        game_state["manual_edit"] = True
-        game_state["board"][i][j] = value
-        game_state["last_move"] = "手动编辑"
+    # 确保索引和数值在有效范围内
+    if game_controller and 0 <= i < 4 and 0 <= j < 4 and rank is not None:
+        sess = current_session()
+        shift = 4 * (4 * i + j)
+        with sess.lock:
+            # 设置手动编辑标记
+            sess.manual_edit = True
+            sess.board = (sess.board & ~(0xf << shift)) | (rank << shift)
+            sess.last_move = "手动编辑"
+            sess.changed()
+        game_controller.ponder(sess)
+        return jsonify({"status": "success"})
     
-    return jsonify({"status": "success"})
+    return jsonify({"status": "error", "message": "无效的单元格或数值"})
+
+def _job_response(job, wait):
+    """等待任务最多wait秒；未完成时返回202和任务ID以便轮询"""
+    job.done.wait(max(0.0, min(wait, job.deadline - time.monotonic())))
+    if job.done.is_set():
+        return jsonify(job.result)
+    if job.expired():
+        # 截止时间已过，任务结束后其结果也会被丢弃
+        return jsonify({"status": "error", "message": "AI请求已超时"}), 504
+    return jsonify({"status": "pending", "job_id": job.id}), 202
 
 @app.route('/api/ai_move', methods=['POST'])
 def ai_move():
-    """AI执行下一步"""
-    if game_controller and game_controller.ai_solver_func:
-        # 重置手动编辑标记
-        game_state["manual_edit"] = False
-        
-        # 获取AI的最佳移动
-        board = game_controller.get_board()
-        move = game_controller.ai_solver_func(board)
-        
-        if move >= 0:
-            # 执行移动
-            game_controller.execute_move(move)
-            return jsonify({"status": "success", "move": move})
+    """AI执行下一步
+    
+    可选参数: wait（是否等待结果，默认true），deadline（截止时间，秒）。"""
+    if not (game_controller and game_controller.ai_solver_func):
+        return jsonify({"status": "error", "message": "AI未初始化"})
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        deadline = request_deadline(data)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    sess = current_session()
+    try:
+        job = game_controller.search_pool.submit(sess.sid, game_controller._ai_move_job(sess), deadline)
+    except SearchQueueFull:
+        response = jsonify({"status": "error", "message": "服务器繁忙，请稍后再试"})
+        response.headers['Retry-After'] = '1'
+        return response, 429
+    
+    return _job_response(job, deadline if data.get('wait', True) else 0)
+
+@app.route('/api/ai_job/<job_id>')
+def ai_job(job_id):
+    """轮询AI任务结果，可选参数wait为最长等待秒数"""
+    job = game_controller.search_pool.get(job_id) if game_controller else None
+    if job is None or job.sid != session.get('sid'):
+        return jsonify({"status": "error", "message": "任务不存在"}), 404
+    try:
+        wait = max(0.0, min(request_float(request.args, 'wait', 0), SEARCH_DEADLINE_MAX))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return _job_response(job, wait)
+
+@app.route('/api/autoplay', methods=['GET', 'POST'])
+def autoplay():
+    """服务器端自动运行
+    
+    POST参数: action（start / pause / resume / stop），rate（步/秒，0表示尽可能快）。
+    GET返回当前自动运行状态。"""
+    if not (game_controller and game_controller.ai_solver_func):
+        return jsonify({"status": "error", "message": "AI未初始化"})
+    sess = current_session()
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        action = data.get('action', 'start')
+        try:
+            rate = max(0.0, min(request_float(data, 'rate', 0), AUTOPLAY_MAX_RATE))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        runner = sess.autoplay
+        if action == 'start':
+            if game_controller.start_autoplay(sess, rate) is None:
+                response = jsonify({"status": "error", "message": "自动运行的会话过多，请稍后再试"})
+                response.headers['Retry-After'] = '5'
+                return response, 429
+        elif runner is None:
+            return jsonify({"status": "error", "message": "自动运行未启动"})
+        elif action == 'pause':
+            runner.pause()
+        elif action == 'resume':
+            runner.set_rate(rate)
+            runner.resume()
+        elif action == 'stop':
+            runner.stop()
         else:
-            return jsonify({"status": "error", "message": "当前局面没有可行的移动"})
+            return jsonify({"status": "error", "message": "未知操作"}), 400
     
-    return jsonify({"status": "error", "message": "AI未初始化"})
+    with sess.lock:
+        runner = sess.autoplay
+    return jsonify({"status": "success", "autoplay": runner.status() if runner else None})
+
+@app.route('/metrics')
+def metrics():
+    """以Prometheus文本格式导出AI移动各阶段的耗时统计"""
+    if not game_controller:
+        return Response("", mimetype='text/plain')
+    return Response(game_controller.profiler.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/metrics')
+def api_metrics():
+    """以JSON格式返回AI移动各阶段的耗时统计"""
+    if not game_controller:
+        return jsonify({"status": "error", "message": "游戏未初始化"})
+    ponderer = game_controller.ponderer
+    return jsonify({"status": "success", "metrics": game_controller.profiler.to_dict(),
+                    "ponder": ponderer.stats() if ponderer else None,
+                    "coalesce": game_controller.coalescer.stats()})
 
 @app.route('/api/execute_direction', methods=['POST'])
 def execute_direction():
     """根据指定方向执行移动"""
     if game_controller:
-        # 重置手动编辑标记
-        game_state["manual_edit"] = False
-        
         data = request.json
         move = data.get('move', -1)
         
         if 0 <= move < 4:
-            board = game_controller.get_board()
-            # 检查指定方向是否是有效移动
-            c_board = to_c_board(board)
-            new_c_board = ailib.execute_move(move, c_board)
-            
             # 如果棋盘发生变化，则为有效移动
-            if c_board != new_c_board:
-                game_controller.execute_move(move)
+            sess = current_session()
+            if game_controller.execute_move(sess, move):
+                game_controller.ponder(sess, spawn_pending=True)
                 return jsonify({"status": "success", "move": move})
             else:
                 return jsonify({"status": "error", "message": "该方向无法移动"})